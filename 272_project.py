@@ -17,6 +17,8 @@ from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import accuracy_score, classification_report
 import joblib
 from openai import OpenAI
+from retention_model import FeatureEncoder
+from retraining import FileFeedbackStore, Retrainer, RetrainWorker
 
 df = pd.read_csv('/content/HR_comma_sep.csv')  # Adjust the path if needed
 # Display basic information about the dataset
@@ -80,22 +82,9 @@ def predict_retention(candidate_data):
     scaler = joblib.load('scaler.joblib')
     X_columns = joblib.load('X_columns.joblib')
 
-    # Prepare the input data
-    input_df = pd.DataFrame([candidate_data])
-    if 'salary' in input_df.columns:
-        input_df['salary'] = input_df['salary'].map({'low': 0, 'medium': 1, 'high': 2})
-    input_df = pd.get_dummies(input_df, columns=['department'])
-
-    # Ensure all columns from training are present
-    for col in X_columns:
-        if col not in input_df.columns:
-            input_df[col] = 0
-
-    # Reorder columns to match training data
-    input_df = input_df[X_columns]
-
-    # Scale the input data
-    input_scaled = scaler.transform(input_df)
+    # Encode and scale the input data
+    encoder = FeatureEncoder(X_columns, scaler)
+    input_scaled = encoder.encode_one(candidate_data)
 
     # Make predictions
     prediction = rf_model.predict(input_scaled)
@@ -131,35 +120,19 @@ def generate_recommendations(prediction, probability, employee_data):
     except Exception as e:
         return f"Error generating recommendations: {str(e)}"
 
-def update_model(new_data, actual_outcome):
-    # Load existing model, scaler, and feature columns
-    rf_model = joblib.load('rf_model.joblib')
-    scaler = joblib.load('scaler.joblib')
-    X_columns = joblib.load('X_columns.joblib')
-
-    # Prepare new data
-    new_df = pd.DataFrame([new_data])
-    if 'salary' in new_df.columns:
-        new_df['salary'] = new_df['salary'].map({'low': 0, 'medium': 1, 'high': 2})
-    new_df = pd.get_dummies(new_df, columns=['department'])
-
-    # Ensure all columns from original training data are present
-    for col in X_columns:
-        if col not in new_df.columns:
-            new_df[col] = 0
-
-    # Reorder columns to match original training data
-    new_df = new_df[X_columns]
-
-    # Scale the new data
-    new_data_scaled = scaler.transform(new_df)
+feedback_store = FileFeedbackStore()
+retrain_worker = None
 
-    # Update the model with the new data
-    rf_model.fit(new_data_scaled, [actual_outcome])
-
-    # Save the updated model
-    joblib.dump(rf_model, 'rf_model.joblib')
-    print("Model updated successfully!")
+def update_model(new_data, actual_outcome):
+    # Record the outcome; the model is retrained in the background once a
+    # batch of feedback has accumulated (see retraining.py), not refit on one row
+    global retrain_worker
+    feedback_store.append(new_data, actual_outcome)
+    if retrain_worker is None:
+        retrain_worker = RetrainWorker(Retrainer(feedback_store, dataset_path='/content/HR_comma_sep.csv'))
+        retrain_worker.start()
+    retrain_worker.notify()
+    print(f"Feedback recorded ({retrain_worker.retrainer.pending()} waiting for the next retraining cycle)")
 
 def get_candidate_data():
     print("Enter candidate information:")
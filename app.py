@@ -1,42 +1,155 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session, send_from_directory
+from flask import Flask, request, jsonify, render_template, redirect, url_for, session, send_from_directory, Response, stream_with_context, g
 from pymongo import MongoClient
-from werkzeug.security import generate_password_hash, check_password_hash
 from firebase_admin import credentials, auth
 from flask_mail import Mail, Message
 import firebase_admin
 import joblib
-import pandas as pd
-from sklearn.preprocessing import StandardScaler
 from flask_cors import CORS
 import openai
 import os
 import json
 import re
+import time
+from fused_model import load_model, RoutedModel, DEFAULT_SKLEARN_MIN_ROWS
+from retention_model import FeatureEncoder, leaving_probability, score_records, iter_ndjson, DEFAULT_CHUNK_SIZE
+from user_store import UserStore, mongo_client_options
+from password_hashing import PasswordHasher, HasherBusy, DEFAULT_METHOD, DEFAULT_SALT_LENGTH, DEFAULT_WORKERS as DEFAULT_HASH_WORKERS
+from token_verification import IdTokenVerifier, DEFAULT_MAX_TOKENS
+from retraining import build_feedback_store, validate_feedback, FEEDBACK_PATH
+from model_registry import ActiveModel, LoadedModel, ModelRegistry, open_store, DEFAULT_POLL_INTERVAL
+from startup import StartupManager, ResourceUnavailable, EAGER, DEFAULT_WAIT_TIMEOUT
+from recommendations import (
+    build_recommendation_cache, build_job_store, default_job_store, ensure_recommendation_indexes,
+    recommendation_key, stub_chat_completion, format_sse,
+    RecommendationJobs, DEFAULT_MAX_SIZE, DEFAULT_TTL, DEFAULT_WORKERS,
+)
 
 app = Flask(__name__)
 CORS(app)
 
+# Heavy resources are loaded by a StartupManager (STARTUP_MODE 'eager', 'background'
+# or 'lazy', see startup.py); gunicorn.conf.py preloads them in the master
+resources = StartupManager(
+    mode=os.environ.get('STARTUP_MODE', EAGER),
+    wait_timeout=float(os.environ.get('STARTUP_WAIT_TIMEOUT', DEFAULT_WAIT_TIMEOUT)),
+)
+
 # Firebase setup
 service_account_info = json.loads(os.environ.get("GOOGLE_APPLICATION_CREDENTIALS_JSON"))
-cred = credentials.Certificate(service_account_info)
-firebase_admin.initialize_app(cred)
+
+def init_firebase():
+    return firebase_admin.initialize_app(credentials.Certificate(service_account_info))
+
+resources.register('firebase', init_firebase)
+
+# ID tokens are checked locally against cached Google certificates, and a token
+# already verified is remembered until it expires. The Auth emulator issues
+# unsigned tokens, so it keeps going through firebase_admin.
+if os.environ.get('FIREBASE_AUTH_EMULATOR_HOST'):
+    def verify_id_token(id_token):
+        resources.get('firebase')
+        return auth.verify_id_token(id_token)
+else:
+    token_verifier = IdTokenVerifier(
+        service_account_info['project_id'],
+        max_tokens=int(os.environ.get('ID_TOKEN_CACHE_SIZE', DEFAULT_MAX_TOKENS)),
+    )
+    verify_id_token = token_verifier.verify
 
 # Secret key for session management
 app.secret_key = os.environ.get('SECRET_KEY', 'default_secret_key')
 
-# MongoDB Connection
-client = MongoClient(os.environ.get('MONGO_URI', 'your_connection_string'))
+# MongoDB Connection (pool size and timeouts come from MONGO_* variables, see user_store.py)
+MONGO_URI = os.environ.get('MONGO_URI', 'your_connection_string')
+client = MongoClient(MONGO_URI, **mongo_client_options())
 db = client['my_database']  # Replace 'my_database' with your database name
 users_collection = db['users']  # Replace 'users' with your collection name
-
-# Load the model and scaler
-rf_model = joblib.load('rf_model.joblib')
-scaler = joblib.load('scaler.joblib')
-X_columns = joblib.load('X_columns.joblib')
+users = UserStore(users_collection)
+
+# Where LLM recommendations are cached ('memory', 'mongo' or 'none') and their
+# background jobs kept ('memory' or 'mongo'), see below
+recommendation_cache_backend = os.environ.get('RECOMMENDATION_CACHE_BACKEND', 'memory')
+recommendation_job_store = os.environ.get('RECOMMENDATION_JOB_STORE') or default_job_store(recommendation_cache_backend)
+
+def create_indexes():
+    # A client of its own, closed afterwards, so a preloading master never
+    # forks its workers with open Mongo connections
+    with MongoClient(MONGO_URI, **mongo_client_options()) as index_client:
+        index_db = index_client[db.name]
+        created = UserStore(index_db[users_collection.name]).ensure_indexes()
+        return ensure_recommendation_indexes(index_db, recommendation_cache_backend, recommendation_job_store) and created
+
+resources.register('mongo_indexes', create_indexes, required=False)
+
+# Password hashes run on a small process pool; changing the method or salt
+# length upgrades stored hashes as users log in
+password_hasher = PasswordHasher(
+    method=os.environ.get('PASSWORD_HASH_METHOD', DEFAULT_METHOD),
+    salt_length=int(os.environ.get('PASSWORD_SALT_LENGTH', DEFAULT_SALT_LENGTH)),
+    max_workers=int(os.environ.get('PASSWORD_HASH_WORKERS', DEFAULT_HASH_WORKERS)),
+)
+
+def load_predictor():
+    # With MODEL_REGISTRY (a directory or s3://bucket/prefix) new model versions
+    # are picked up while running, see model_registry.py. Otherwise the model
+    # (scaler folded into the forest, see fused_model.py) and the precompiled
+    # encoder (raw employee record -> unscaled feature row) come from the working directory.
+    # Batches of BATCH_SKLEARN_MIN_ROWS rows or more are scored by rf_model +
+    # scaler instead, which is faster at that size (0 turns this off).
+    sklearn_min_rows = int(os.environ.get('BATCH_SKLEARN_MIN_ROWS', DEFAULT_SKLEARN_MIN_ROWS))
+    registry_location = os.environ.get('MODEL_REGISTRY')
+    if registry_location:
+        return ActiveModel.from_registry(
+            ModelRegistry(open_store(registry_location), sklearn_min_rows),
+            poll_interval=float(os.environ.get('MODEL_REGISTRY_POLL_INTERVAL', DEFAULT_POLL_INTERVAL)),
+        )
+    model = load_model()
+    # A mapped forest exported with --scaler expects scaled rows: its own
+    # encoder scales them, and rf_model + scaler would scale them a second time
+    if getattr(model, 'scaler', None) is not None:
+        return ActiveModel(LoadedModel('local', model, model.feature_encoder()))
+    if sklearn_min_rows and os.path.exists('rf_model.joblib') and os.path.exists('scaler.joblib'):
+        model = RoutedModel(model, lambda: (joblib.load('rf_model.joblib'), joblib.load('scaler.joblib')), sklearn_min_rows)
+    return ActiveModel(LoadedModel('local', model, FeatureEncoder(joblib.load('X_columns.joblib'))))
+
+resources.register('model', load_predictor)
+resources.start()
 
 # Set OpenAI API key directly
 openai.api_key = os.environ.get('OPENAI_API_KEY')
 
+# 'stub' swaps OpenAI for a canned local response (tests, offline development)
+if os.environ.get('RECOMMENDATION_PROVIDER', 'openai') == 'stub':
+    stub_delay = float(os.environ.get('RECOMMENDATION_STUB_DELAY', 0))
+    create_chat_completion = lambda **kwargs: stub_chat_completion(delay=stub_delay, **kwargs)
+else:
+    create_chat_completion = openai.ChatCompletion.create
+
+# Cache for LLM recommendations; a 'mongo' cache gets its indexes from create_indexes
+recommendation_cache = build_recommendation_cache(
+    recommendation_cache_backend,
+    db,
+    max_size=int(os.environ.get('RECOMMENDATION_CACHE_SIZE', DEFAULT_MAX_SIZE)),
+    ttl=int(os.environ.get('RECOMMENDATION_CACHE_TTL', DEFAULT_TTL)),
+)
+
+# Background pool that generates recommendations after /predict has returned.
+# Jobs must be in the 'mongo' store when running more than one gunicorn worker;
+# it is the default whenever the cache is in MongoDB (gunicorn.conf.py warns
+# about an in-memory store with several workers).
+recommendation_jobs = RecommendationJobs(
+    build_job_store(recommendation_job_store, db),
+    max_workers=int(os.environ.get('RECOMMENDATION_WORKERS', DEFAULT_WORKERS)),
+)
+
+# Labelled outcomes for retraining ('file' or 'mongo'); retraining.py folds
+# them into the model in batches, outside the web process
+feedback_store = build_feedback_store(
+    os.environ.get('FEEDBACK_STORE', 'file'),
+    db,
+    path=os.environ.get('FEEDBACK_PATH', FEEDBACK_PATH),
+)
+
 # Email configuration
 app.config['MAIL_SERVER'] = 'smtp.gmail.com'
 app.config['MAIL_PORT'] = 587
@@ -49,6 +162,37 @@ app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('EMAIL_USER')  # Default send
 mail = Mail(app)
 app.config['MAIL_ASCII_ATTACHMENTS'] = False 
 
+@app.after_request
+def add_password_hash_timing(response):
+    # Time spent hashing passwords for this request, visible in browser dev tools
+    if 'password_hash_seconds' in g:
+        response.headers['Server-Timing'] = f"pwhash;dur={g.password_hash_seconds * 1000:.1f}"
+    return response
+
+@app.errorhandler(ResourceUnavailable)
+def resource_unavailable(e):
+    return jsonify({'error': str(e)}), 503, {'Retry-After': '5'}
+
+@app.route('/ready')
+def ready():
+    # Readiness probe: 200 once every required resource has loaded (or, in lazy mode, can load)
+    status = resources.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+@app.route('/model')
+def model_status():
+    return jsonify(resources.get('model').status())
+
+@app.route('/auth/hash-stats')
+def password_hash_stats():
+    return jsonify(password_hasher.stats())
+
+@app.route('/auth/token-stats')
+def id_token_stats():
+    if os.environ.get('FIREBASE_AUTH_EMULATOR_HOST'):
+        return jsonify({'emulator': True})
+    return jsonify(token_verifier.stats())
+
 @app.route('/favicon.ico')
 def favicon():
     return send_from_directory(os.path.join(app.root_path, 'static'), 'favicon.ico')
@@ -76,23 +220,20 @@ def signup():
         try:
             if id_token:
                 # Google Signup
-                decoded_token = auth.verify_id_token(id_token)
+                decoded_token = verify_id_token(id_token)
                 email = decoded_token['email']
                 name = decoded_token.get('name', '')
             elif name and 'email' in data and 'password' in data:
                 # Email/Password Signup
                 email = data['email']
                 password = data['password']
-                # Check if email already exists
-                if users_collection.find_one({"email": email}):
+                # Check if email already exists (before paying for the hash)
+                if users.exists(email):
                     return jsonify({"error": "Email already registered. Please log in."}), 400
                 # Hash password before saving to the database
-                hashed_password = generate_password_hash(password)
-                users_collection.insert_one({
-                    "name": name,
-                    "email": email,
-                    "password": hashed_password
-                })
+                hashed_password, g.password_hash_seconds = password_hasher.hash(password)
+                if not users.create(name, email, hashed_password):
+                    return jsonify({"error": "Email already registered. Please log in."}), 400
             else:
                 return jsonify({"error": "Invalid signup data"}), 400
 
@@ -100,6 +241,8 @@ def signup():
             session['user_logged_in'] = True
             session['user_email'] = email
             return jsonify({"message": "Signup successful"}), 200
+        except HasherBusy as e:
+            return jsonify({"error": str(e)}), 503
         except Exception as e:
             return jsonify({"error": str(e)}), 401
 
@@ -116,13 +259,18 @@ def login():
         try:
             if id_token:
                 # Google Login
-                decoded_token = auth.verify_id_token(id_token)
+                decoded_token = verify_id_token(id_token)
                 email = decoded_token['email']
             elif email and password:
                 # Email/Password Login
-                user = users_collection.find_one({"email": email})
-                if not user or not check_password_hash(user['password'], password):
+                password_hash = users.password_hash(email)
+                if not password_hash:
                     return jsonify({"error": "Invalid credentials"}), 401
+                ok, new_hash, g.password_hash_seconds = password_hasher.verify(password_hash, password)
+                if not ok:
+                    return jsonify({"error": "Invalid credentials"}), 401
+                if new_hash:
+                    users.update_password(email, new_hash)
             else:
                 return jsonify({"error": "No authentication method provided"}), 400
 
@@ -131,6 +279,8 @@ def login():
             session['user_email'] = email
             return jsonify({"message": "Login successful"}), 200
 
+        except HasherBusy as e:
+            return jsonify({"error": str(e)}), 503
         except Exception as e:
             return jsonify({"error": str(e)}), 401
 
@@ -192,7 +342,7 @@ def verify_token():
     id_token = request.json.get('idToken')
     try:
         # Verify the token with Firebase Admin
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = verify_id_token(id_token)
         user_id = decoded_token['uid']
         return jsonify({'status': 'success', 'uid': user_id})
     except Exception as e:
@@ -200,63 +350,138 @@ def verify_token():
 
 @app.route('/predict', methods=['POST'])
 def predict():
+    version, model, encoder = resources.get('model').current()
     try:
         data = request.json
-        input_df = pd.DataFrame([data])
-        
-        # Convert numeric strings to float
-        numeric_columns = ['satisfaction_level', 'last_evaluation', 'average_monthly_hours']
-        for col in numeric_columns:
-            if col in input_df.columns:
-                input_df[col] = input_df[col].astype(float)
-        
-        # Convert salary to numeric if present
-        if 'salary' in input_df.columns:
-            input_df['salary'] = input_df['salary'].map({'low': 0, 'medium': 1, 'high': 2})
-        
-        # Handle department one-hot encoding
-        if 'department' in input_df.columns:
-            input_df = pd.get_dummies(input_df, columns=['department'])
-        
-        # Ensure all required columns exist
-        for col in X_columns:
-            if col not in input_df.columns:
-                input_df[col] = 0
-        
-        # Select only the columns used during training
-        input_df = input_df[X_columns]
         
-        # Scale the features
-        input_scaled = scaler.transform(input_df)
+        # Encode the features
+        input_features = encoder.encode_one(data)
         
-        # Make prediction
-        prediction = rf_model.predict(input_scaled)[0]
-        probabilities = rf_model.predict_proba(input_scaled)[0]
+        # Make prediction (class and probabilities from a single forest pass)
+        predictions, probabilities = model.predict_with_proba(input_features)
+        prediction = predictions[0]
+        probability = leaving_probability(probabilities[0])
         
-        # Handle probability calculation
-        leaving_probability = float(probabilities[1]) if len(probabilities) > 1 else 0.0
-        
-        # Ensure probability is not NaN
-        if pd.isna(leaving_probability):
-            leaving_probability = 0.0
-        
-        recommendations = generate_recommendations(prediction, leaving_probability, data)
+        # Recommendations are generated in the background; poll recommendations_url for them
+        job_id = recommendation_jobs.submit(generate_recommendations, prediction, probability, data)
         
         return jsonify({
             'prediction': int(prediction),
-            'probability': leaving_probability,
-            'recommendations': recommendations,
+            'probability': probability,
+            'model_version': version,
+            'recommendation_job_id': job_id,
+            'recommendations_url': url_for('get_recommendations', job_id=job_id),
             'employee_data': data
         })
     except Exception as e:
         print(f"Error in prediction: {str(e)}")  # For debugging
         return jsonify({'error': str(e)}), 500
 
-def generate_recommendations(prediction, probability, employee_data):
+@app.route('/feedback', methods=['POST'])
+def feedback():
     """
-    Generate concise recommendations for employee retention.
-    Limits output to 4 lines with complete sentences.
+    Record whether an employee actually left: {"employee_data": {...}, "left": 0 or 1}.
+    """
+    data = request.get_json(silent=True) or {}
+    employee_data = data.get('employee_data')
+    left = data.get('left')
+    try:
+        validate_feedback(employee_data, left)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    feedback_store.append(employee_data, left)
+    return jsonify({'status': 'recorded'}), 202
+
+@app.route('/predict/batch', methods=['POST'])
+def predict_batch():
     """
+    Score many employees in one request.
+
+    Accepts either a JSON array of employee records or an NDJSON body
+    (Content-Type: application/x-ndjson, one record per line) and streams
+    back one NDJSON result line per record. No recommendations are generated.
+    """
+    version, model, encoder = resources.get('model').current()
+    chunk_size = request.args.get('chunk_size', DEFAULT_CHUNK_SIZE, type=int)
+    if chunk_size < 1:
+        return jsonify({'error': 'chunk_size must be a positive integer'}), 400
+
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        records = iter_ndjson(request.stream)
+    else:
+        records = request.get_json(silent=True)
+        if not isinstance(records, list):
+            return jsonify({'error': 'Expected a JSON array of employee records'}), 400
+
+    def generate():
+        # Malformed records and NDJSON lines get an error line at their index
+        for result in score_records(records, model, encoder, chunk_size):
+            result['model_version'] = version
+            yield json.dumps(result) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/predict/stream', methods=['POST'])
+def predict_stream():
+    """
+    Predict with recommendations inline, as server-sent events: a 'prediction'
+    event with the score first, then one 'token' event per recommendation
+    chunk as the model produces it, then 'done'.
+    """
+    version, model, encoder = resources.get('model').current()
+    try:
+        data = request.json
+        predictions, probabilities = model.predict_with_proba(encoder.encode_one(data))
+        prediction = predictions[0]
+        probability = leaving_probability(probabilities[0])
+    except Exception as e:
+        print(f"Error in prediction: {str(e)}")  # For debugging
+        return jsonify({'error': str(e)}), 500
+
+    def generate():
+        yield format_sse('prediction', {
+            'prediction': int(prediction),
+            'probability': probability,
+            'model_version': version,
+            'employee_data': data
+        })
+        for token in stream_recommendations(prediction, probability, data):
+            yield format_sse('token', token)
+        yield format_sse('done', {})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/recommendations/<job_id>')
+def get_recommendations(job_id):
+    job = recommendation_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired recommendation job'}), 404
+    return jsonify(job)
+
+@app.route('/recommendations/<job_id>/events')
+def recommendation_events(job_id):
+    """
+    Server-sent events for a recommendation job: one event per status change,
+    ending with the finished job.
+    """
+    if recommendation_jobs.get(job_id) is None:
+        return jsonify({'error': 'Unknown or expired recommendation job'}), 404
+
+    def generate():
+        for job in recommendation_jobs.wait(job_id, timeout=60):
+            yield format_sse(job['status'], job)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/recommendations/cache-stats')
+def recommendation_cache_stats():
+    if recommendation_cache is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(recommendation_cache.stats(), enabled=True))
+
+def recommendation_messages(prediction, probability, employee_data):
     prompt = f"""
     Prediction: {'Likely to leave' if prediction == 1 else 'Likely to stay'}.
     Probability of leaving: {probability:.2f}.
@@ -264,20 +489,76 @@ def generate_recommendations(prediction, probability, employee_data):
 
     Provide 3-4 actionable HR recommendations to improve retention or engagement in no more than 4 sentences.
     """
+    return [
+        {"role": "system", "content": "You are an HR assistant providing concise retention advice."},
+        {"role": "user", "content": prompt}
+    ]
+
+def generate_recommendations(prediction, probability, employee_data):
+    """
+    Generate concise recommendations for employee retention.
+    Limits output to 4 lines with complete sentences.
+    """
+    cache_key = None
+    if recommendation_cache is not None:
+        cache_key = recommendation_key(prediction, probability, employee_data)
+        cached = recommendation_cache.lookup(cache_key)
+        if cached is not None:
+            return cached
+
+    # Provider errors propagate, so the background job is recorded as failed
+    start = time.perf_counter()
+    response = create_chat_completion(
+        model="gpt-4",
+        messages=recommendation_messages(prediction, probability, employee_data),
+        max_tokens=450,
+        temperature=0.7
+    )
+    recommendations = response.choices[0].message.content.strip()
+    if cache_key is not None:
+        usage = response.get('usage') or {}
+        recommendation_cache.store(
+            cache_key,
+            recommendations,
+            latency=time.perf_counter() - start,
+            tokens=usage.get('total_tokens', 0),
+        )
+    return recommendations
+
+def stream_recommendations(prediction, probability, employee_data):
+    """
+    Streaming variant of generate_recommendations: yields the text in chunks
+    as the model produces them. A cache hit is yielded as a single chunk.
+    """
+    cache_key = None
+    if recommendation_cache is not None:
+        cache_key = recommendation_key(prediction, probability, employee_data)
+        cached = recommendation_cache.lookup(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+    parts = []
     try:
-        response = openai.ChatCompletion.create(
+        start = time.perf_counter()
+        for chunk in create_chat_completion(
             model="gpt-4",
-            messages=[
-                {"role": "system", "content": "You are an HR assistant providing concise retention advice."},
-                {"role": "user", "content": prompt}
-            ],
+            messages=recommendation_messages(prediction, probability, employee_data),
             max_tokens=450,
-            temperature=0.7
-        )
-        recommendations = response.choices[0].message.content.strip()
-        return recommendations
+            temperature=0.7,
+            stream=True
+        ):
+            content = chunk.choices[0].get('delta', {}).get('content')
+            if content:
+                parts.append(content)
+                yield content
     except Exception as e:
-        return f"Error generating recommendations: {str(e)}"
+        yield f"Error generating recommendations: {str(e)}"
+        return
+
+    if cache_key is not None and parts:
+        # Streamed responses carry no token usage
+        recommendation_cache.store(cache_key, ''.join(parts).strip(), latency=time.perf_counter() - start)
 
 if __name__ == '__main__':
     app.run(debug=True)
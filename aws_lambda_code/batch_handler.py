@@ -0,0 +1,576 @@
+import boto3
+import csv
+import io
+import json
+import os
+import posixpath
+import tempfile
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import bedrock_handler
+import document_status
+import relevance_filter
+import result_index
+import textract_handler
+
+# Bulk screening: rank many resumes against one job description.
+#
+# Accepts either a list of resume keys or a zip of PDFs in S3 (uploaded under
+# BATCH_UPLOAD_PREFIX when the batch comes through the API). No invocation
+# holds the whole batch: the coordinator stages the resumes, writes
+# batches/<batch_id>/manifest.json and fans out one task per resume through
+# the batch queue (or an asynchronous invocation of this function):
+#
+#   prepare   OCR or index lookup for one resume -> prepared/<n>.json
+#   (last)    pre-filter every prepared resume   -> prefilter.json, then one
+#   analyze   task per resume that passed        -> analyzed/<n>.json
+#   (last)    rank by batch_id                   -> ranking.json, ranking.csv
+#
+# The task that completes a stage starts the next one under a claim, so each
+# stage runs once however the tasks interleave or are redelivered. Work is
+# also recorded in the result index as it finishes, so a retried task only
+# redoes what is still missing.
+
+s3_client = boto3.client('s3')
+lambda_client = boto3.client('lambda')
+sqs_client = boto3.client('sqs')
+
+RESUME_BUCKET = "candidate-resume-processing-bucket"
+RESULTS_BUCKET = "resume-analysis-results-bucket"
+BATCH_PREFIX = "batches/"
+RESUMES_DIR = "resumes/"
+
+# Tasks go to this queue when set, otherwise to asynchronous invocations of
+# this function. How many resumes run at once is the queue's maximum
+# concurrency (or the function's reserved concurrency).
+BATCH_QUEUE_URL = os.environ.get('BATCH_QUEUE_URL')
+BATCH_FUNCTION = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'batch_handler')
+
+# Threads the coordinating steps use for their S3 reads and task dispatches
+BATCH_IO_WORKERS = int(os.environ.get('BATCH_IO_WORKERS', '16'))
+# Progress is written to status.json every this many finished tasks
+STATUS_EVERY = 25
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', '1000'))
+
+# Batches requested over HTTP read only from RESUME_BUCKET, and only keys
+# under this prefix; other buckets are for direct invocations
+BATCH_UPLOAD_PREFIX = os.environ.get('BATCH_UPLOAD_PREFIX', 'batch-uploads/')
+
+# Limits on a zip, checked before anything is unpacked: its own size, each
+# PDF's uncompressed size (the same cap as a single upload) and their total
+MAX_ZIP_BYTES = int(os.environ.get('MAX_ZIP_BYTES', str(256 * 1024 * 1024)))
+MAX_ZIP_MEMBER_BYTES = int(os.environ.get('MAX_ZIP_MEMBER_BYTES', str(10 * 1024 * 1024)))
+MAX_ZIP_TOTAL_BYTES = int(os.environ.get('MAX_ZIP_TOTAL_BYTES', str(1024 * 1024 * 1024)))
+
+# Only resumes scoring at least PREFILTER_THRESHOLD on the local relevance
+# check and, when PREFILTER_TOP_K is set, among the top K go to Bedrock. The
+# threshold applies to the same score as bedrock_handler.prefilter; the top K
+# are picked by the IDF-weighted score across the batch.
+PREFILTER_THRESHOLD = float(os.environ.get('PREFILTER_THRESHOLD', '0'))
+PREFILTER_TOP_K = int(os.environ.get('PREFILTER_TOP_K', '0'))
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type'
+}
+
+# Columns of the ranked table, in order
+TABLE_COLUMNS = ["rank", "file_name", "status", "relevancy_score", "prefilter_score", "skills", "education_level", "work experience", "candidate_relevancy", "error"]
+
+
+def batch_key(batch_id, name):
+    return f"{BATCH_PREFIX}{batch_id}/{name}"
+
+
+def resume_name(key):
+    # Resumes unpacked from a zip are named by their path inside it
+    if key.startswith(BATCH_PREFIX):
+        _, staged, path = key.partition(f"/{RESUMES_DIR}")
+        if staged:
+            return path
+    return posixpath.basename(key)
+
+
+def stage_zip(batch_id, bucket, zip_key):
+    """
+    Unpack the PDFs of a zip in S3 to batches/<batch_id>/resumes/, one member
+    at a time, and return their keys. Textract reads documents from S3, so
+    every resume needs a key of its own; members keep their path inside the
+    zip, so a/cv.pdf and b/cv.pdf do not overwrite each other.
+    """
+    size = s3_client.head_object(Bucket=bucket, Key=zip_key)['ContentLength']
+    if size > MAX_ZIP_BYTES:
+        raise ValueError(f"The zip is {size} bytes, the limit is {MAX_ZIP_BYTES}")
+
+    keys = []
+    with tempfile.TemporaryFile() as archive:
+        s3_client.download_fileobj(bucket, zip_key, archive)
+        archive.seek(0)
+        with zipfile.ZipFile(archive) as zf:
+            members = []
+            for member in zf.infolist():
+                path = posixpath.normpath(member.filename.replace('\\', '/')).lstrip('/')
+                if (member.is_dir() or not path.lower().endswith('.pdf') or path.startswith('__MACOSX/')
+                        or path.startswith('../')):
+                    continue
+                if member.file_size > MAX_ZIP_MEMBER_BYTES:
+                    raise ValueError(f"{path} unpacks to {member.file_size} bytes, the limit is {MAX_ZIP_MEMBER_BYTES}")
+                members.append((member, path))
+            # Sizes come from the zip's directory; reads below are capped too,
+            # so a member that lies about its size cannot get past the limit
+            if len(members) > MAX_BATCH_SIZE:
+                raise ValueError(f"A batch holds at most {MAX_BATCH_SIZE} resumes")
+            total = sum(member.file_size for member, _ in members)
+            if total > MAX_ZIP_TOTAL_BYTES:
+                raise ValueError(f"The zip unpacks to {total} bytes, the limit is {MAX_ZIP_TOTAL_BYTES}")
+
+            for member, path in members:
+                key = batch_key(batch_id, f"{RESUMES_DIR}{path}")
+                with zf.open(member) as pdf:
+                    body = pdf.read(MAX_ZIP_MEMBER_BYTES + 1)
+                if len(body) > MAX_ZIP_MEMBER_BYTES:
+                    raise ValueError(f"{path} unpacks to more than {MAX_ZIP_MEMBER_BYTES} bytes")
+                s3_client.put_object(Bucket=RESULTS_BUCKET, Key=key, Body=body, ContentType='application/pdf')
+                keys.append(key)
+    print(f"Unpacked {len(keys)} resumes from {bucket}/{zip_key}")
+    return keys
+
+
+def extract_resume_text(bucket, key, pdf_hash):
+    """
+    OCR text of one resume, from the result index when this PDF was seen
+    before, otherwise from a Textract job polled with backoff.
+    """
+    text = result_index.load_text(pdf_hash)
+    if text is not None:
+        return text
+
+    # No notification channel: this worker waits for its own job
+    response = textract_handler.textract_client.start_document_text_detection(
+        DocumentLocation={'S3Object': {'Bucket': bucket, 'Name': key}},
+        ClientRequestToken=textract_handler.upload_token(bucket, key, pdf_hash),
+        JobTag=pdf_hash
+    )
+    job_id = response['JobId']
+    status = textract_handler.wait_for_job(job_id)
+    if status != 'SUCCEEDED':
+        raise RuntimeError(f"Text extraction {status.lower()}")
+    text = "\n".join(line for _, line in textract_handler.iter_lines(job_id))
+    result_index.store_text(pdf_hash, text)
+    return text
+
+
+def prepare_resume(bucket, key, jd_hash):
+    """
+    First pass over one resume: its content hash and either a stored
+    analysis for this job description or its OCR text.
+    """
+    item = {"file_name": resume_name(key), "key": key}
+    try:
+        item["pdf_hash"] = result_index.content_hash(s3_client.get_object(Bucket=bucket, Key=key)['Body'])
+        item["responses"] = result_index.load_result(item["pdf_hash"], jd_hash)
+        if item["responses"] is None:
+            item["text"] = extract_resume_text(bucket, key, item["pdf_hash"])
+    except Exception as e:
+        print(f"Preparing {key} failed: {str(e)}")
+        item["error"] = str(e)
+    return item
+
+
+def analyze_resume(item, job_description, jd_hash):
+    try:
+        responses, errors = bedrock_handler.analyze_text(item["text"], job_description)
+        responses["_prefilter"] = item["prefilter"]
+        if not errors:
+            result_index.store_result(item["pdf_hash"], jd_hash, json.dumps(responses))
+        elif len(errors) == len(bedrock_handler.PROMPTS):
+            raise RuntimeError(f"Every prompt failed: {errors}")
+        item["responses"] = responses
+    except Exception as e:
+        print(f"Analyzing {item['key']} failed: {str(e)}")
+        item["error"] = str(e)
+    return item
+
+
+def to_row(item):
+    """
+    One row of the ranked table (before ranking).
+    """
+    row = {"file_name": item["file_name"], "key": item["key"], "relevancy_score": None}
+    responses = item.get("responses") or {}
+    row.update({k: v for k, v in responses.items() if not k.startswith('_')})
+    check = item.get("prefilter") or responses.get("_prefilter")
+    row["prefilter_score"] = check["score"] if check else None
+    if item.get("error"):
+        row["status"] = "failed"
+        row["error"] = item["error"]
+    elif not responses:
+        row["status"] = "filtered"
+    else:
+        row["status"] = "analyzed" if "prefilter" in item else "cached"
+        # Older index entries predate the parsed score
+        score = responses.get("_relevancy_score")
+        if score is None and "candidate_relevancy" in responses:
+            score = bedrock_handler.parse_relevancy_score(responses["candidate_relevancy"])
+        row["relevancy_score"] = score
+    return row
+
+
+def apply_prefilter(items, job_description, threshold, top_k):
+    """
+    Score the resumes that still need an analysis against the job description
+    locally and mark which go on to Bedrock: at least `threshold` and, when
+    top_k is set, among the top_k. Returns the items that passed.
+    """
+    pending = [item for item in items if "text" in item and not item.get("error")]
+    texts = [item["text"] for item in pending]
+    scores = [relevance_filter.similarity(job_description, text) for text in texts]
+    idf_scores = relevance_filter.similarities(job_description, texts) if top_k else None
+    chosen = set(relevance_filter.select(scores, threshold, top_k, order_by=idf_scores))
+    for i, (item, score) in enumerate(zip(pending, scores)):
+        item["prefilter"] = {"score": round(score, 4), "method": relevance_filter.METHOD,
+                             "threshold": threshold, "top_k": top_k, "passed": i in chosen}
+        if idf_scores is not None:
+            item["prefilter"]["idf_score"] = round(idf_scores[i], 4)
+            item["prefilter"]["idf_method"] = relevance_filter.IDF_METHOD
+    print(f"Pre-filter passed {len(chosen)} of {len(pending)} resumes (threshold {threshold}, top_k {top_k or 'all'})")
+    return [item for item in pending if item["prefilter"]["passed"]]
+
+
+def rank(rows):
+    """
+    Sort by relevancy score, highest first; unscored, filtered and failed
+    resumes go last, ordered by their pre-filter score.
+    """
+    ranked = sorted(rows, key=lambda row: (
+        row["relevancy_score"] is None,
+        -(row["relevancy_score"] or 0),
+        -(row["prefilter_score"] or 0),
+        row["file_name"]
+    ))
+    for position, row in enumerate(ranked, 1):
+        row["rank"] = position
+    return ranked
+
+
+def to_csv(rows):
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=TABLE_COLUMNS, extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(rows)
+    return out.getvalue()
+
+
+def write_batch_status(batch_id, status, **fields):
+    record = dict(fields, batch_id=batch_id, status=status, updated_at=time.time())
+    s3_client.put_object(
+        Bucket=RESULTS_BUCKET,
+        Key=batch_key(batch_id, "status.json"),
+        Body=json.dumps(record),
+        ContentType='application/json',
+        CacheControl='no-cache'
+    )
+    return record
+
+
+def read_json(key):
+    return json.loads(s3_client.get_object(Bucket=RESULTS_BUCKET, Key=key)['Body'].read())
+
+
+def write_json(key, record):
+    s3_client.put_object(Bucket=RESULTS_BUCKET, Key=key, Body=json.dumps(record), ContentType='application/json')
+
+
+def item_key(batch_id, stage, index):
+    return batch_key(batch_id, f"{stage}/{index:05d}.json")
+
+
+def count_items(batch_id, stage):
+    """
+    Number of tasks of this stage that have written their result.
+    """
+    paginator = s3_client.get_paginator('list_objects_v2')
+    pages = paginator.paginate(Bucket=RESULTS_BUCKET, Prefix=batch_key(batch_id, f"{stage}/"))
+    return sum(page.get('KeyCount', 0) for page in pages)
+
+
+def load_items(batch_id, stage, indices):
+    with ThreadPoolExecutor(max_workers=BATCH_IO_WORKERS) as executor:
+        return list(executor.map(lambda i: read_json(item_key(batch_id, stage, i)), indices))
+
+
+def dispatch_task(task):
+    """
+    Queue one task of a batch without waiting for it.
+    """
+    if BATCH_QUEUE_URL:
+        sqs_client.send_message(QueueUrl=BATCH_QUEUE_URL, MessageBody=json.dumps(task))
+        return
+    response = lambda_client.invoke(FunctionName=BATCH_FUNCTION, InvocationType='Event', Payload=json.dumps(task))
+    if response.get('StatusCode') != 202:
+        raise RuntimeError(f"Async invoke returned status {response.get('StatusCode')}")
+
+
+def dispatch_tasks(tasks):
+    with ThreadPoolExecutor(max_workers=BATCH_IO_WORKERS) as executor:
+        list(executor.map(dispatch_task, tasks))
+
+
+def claim_step(batch_id, step):
+    # Only the task that wins the claim runs the step (see document_status.claim)
+    outcome = document_status.claim(f"{batch_id}/steps/{step}", bucket=RESULTS_BUCKET, prefix=BATCH_PREFIX)
+    return outcome == document_status.CLAIMED
+
+
+def complete_step(batch_id, step):
+    document_status.complete(f"{batch_id}/steps/{step}", bucket=RESULTS_BUCKET, prefix=BATCH_PREFIX)
+
+
+def release_step(batch_id, step):
+    # Let a redelivered task run the step again after a failure
+    document_status.release(f"{batch_id}/steps/{step}", bucket=RESULTS_BUCKET, prefix=BATCH_PREFIX)
+
+
+def run_step(batch_id, step, work):
+    if not claim_step(batch_id, step):
+        print(f"Batch {batch_id}: {step} already claimed")
+        return
+    try:
+        work()
+    except Exception:
+        release_step(batch_id, step)
+        raise
+    complete_step(batch_id, step)
+
+
+def start_batch(batch_id, job_description, resume_keys=None, zip_key=None, bucket=RESUME_BUCKET,
+                prefilter_threshold=PREFILTER_THRESHOLD, prefilter_top_k=PREFILTER_TOP_K):
+    """
+    Stage the resumes, write the manifest and queue one prepare task per
+    resume. Returns the number of resumes in the batch.
+    """
+    if zip_key:
+        bucket, resume_keys = RESULTS_BUCKET, stage_zip(batch_id, bucket, zip_key)
+    resume_keys = list(resume_keys or [])
+    if not resume_keys:
+        raise ValueError("No resumes to screen")
+    if len(resume_keys) > MAX_BATCH_SIZE:
+        raise ValueError(f"A batch holds at most {MAX_BATCH_SIZE} resumes")
+
+    write_json(batch_key(batch_id, "manifest.json"), {
+        "batch_id": batch_id,
+        "job_description": job_description,
+        "jd_hash": result_index.job_description_hash(job_description),
+        "bucket": bucket,
+        "resume_keys": resume_keys,
+        "prefilter_threshold": prefilter_threshold,
+        "prefilter_top_k": prefilter_top_k,
+        "started_at": time.time()
+    })
+    write_batch_status(batch_id, "running", total=len(resume_keys), completed=0, stage="extraction")
+    dispatch_tasks({"batch_id": batch_id, "batch_stage": "prepare", "index": i} for i in range(len(resume_keys)))
+    print(f"Batch {batch_id}: queued {len(resume_keys)} resumes")
+    return len(resume_keys)
+
+
+def prepare_task(task):
+    batch_id, index = task["batch_id"], task["index"]
+    manifest = read_json(batch_key(batch_id, "manifest.json"))
+    item = prepare_resume(manifest["bucket"], manifest["resume_keys"][index], manifest["jd_hash"])
+    # The text stays in the result index instead of being copied per batch
+    item.pop("text", None)
+    write_json(item_key(batch_id, "prepared", index), item)
+
+    total = len(manifest["resume_keys"])
+    prepared = count_items(batch_id, "prepared")
+    if prepared >= total:
+        run_step(batch_id, "prefilter", lambda: prefilter_batch(manifest))
+    elif prepared % STATUS_EVERY == 0:
+        write_batch_status(batch_id, "running", total=total, completed=prepared, stage="extraction")
+
+
+def prefilter_batch(manifest):
+    """
+    Pre-filter every prepared resume together (the top K and the IDF weights
+    need the whole batch) and queue an analyze task for each that passed.
+    """
+    batch_id = manifest["batch_id"]
+    items = load_items(batch_id, "prepared", range(len(manifest["resume_keys"])))
+    pending = [(i, item) for i, item in enumerate(items) if item.get("responses") is None and not item.get("error")]
+    with ThreadPoolExecutor(max_workers=BATCH_IO_WORKERS) as executor:
+        texts = list(executor.map(lambda pair: result_index.load_text(pair[1]["pdf_hash"]), pending))
+    for (_, item), text in zip(pending, texts):
+        if text is None:
+            item["error"] = "Extracted text is missing from the result index"
+        else:
+            item["text"] = text
+    pending = [(i, item) for i, item in pending if "text" in item]
+
+    apply_prefilter(items, manifest["job_description"], manifest["prefilter_threshold"], manifest["prefilter_top_k"])
+    checks = {str(i): item["prefilter"] for i, item in pending}
+    selected = [i for i, item in pending if item["prefilter"]["passed"]]
+    write_json(batch_key(batch_id, "prefilter.json"), {"checks": checks, "selected": selected})
+
+    if not selected:
+        run_step(batch_id, "rank", lambda: finish_batch(manifest))
+        return
+    write_batch_status(batch_id, "running", total=len(selected), completed=0, stage="analysis")
+    dispatch_tasks({"batch_id": batch_id, "batch_stage": "analyze", "index": i, "expected": len(selected),
+                    "prefilter": checks[str(i)]} for i in selected)
+
+
+def analyze_task(task):
+    batch_id, index = task["batch_id"], task["index"]
+    manifest = read_json(batch_key(batch_id, "manifest.json"))
+    item = read_json(item_key(batch_id, "prepared", index))
+    item["prefilter"] = task["prefilter"]
+    item["text"] = result_index.load_text(item["pdf_hash"]) or ""
+    analyze_resume(item, manifest["job_description"], manifest["jd_hash"])
+    item.pop("text", None)
+    write_json(item_key(batch_id, "analyzed", index), item)
+
+    analyzed = count_items(batch_id, "analyzed")
+    if analyzed >= task["expected"]:
+        run_step(batch_id, "rank", lambda: finish_batch(manifest))
+    elif analyzed % STATUS_EVERY == 0:
+        write_batch_status(batch_id, "running", total=task["expected"], completed=analyzed, stage="analysis")
+
+
+def finish_batch(manifest):
+    """
+    Gather every resume of the batch and write the ranked table as
+    ranking.json and ranking.csv.
+    """
+    batch_id = manifest["batch_id"]
+    items = load_items(batch_id, "prepared", range(len(manifest["resume_keys"])))
+    prefiltered = read_json(batch_key(batch_id, "prefilter.json"))
+    analyzed = load_items(batch_id, "analyzed", prefiltered["selected"])
+    for index, check in prefiltered["checks"].items():
+        items[int(index)]["prefilter"] = check
+    for index, item in zip(prefiltered["selected"], analyzed):
+        items[index] = item
+
+    ranked = rank([to_row(item) for item in items])
+    elapsed = time.time() - manifest["started_at"]
+    write_json(batch_key(batch_id, "ranking.json"), {"batch_id": batch_id, "seconds": round(elapsed, 3), "results": ranked})
+    s3_client.put_object(
+        Bucket=RESULTS_BUCKET,
+        Key=batch_key(batch_id, "ranking.csv"),
+        Body=to_csv(ranked),
+        ContentType='text/csv'
+    )
+    counts = {status: sum(1 for row in ranked if row["status"] == status)
+              for status in ("analyzed", "cached", "filtered", "failed")}
+    print(f"Batch {batch_id}: screened {len(ranked)} resumes {counts} in {elapsed:.2f}s")
+    write_batch_status(batch_id, "done", total=len(ranked), completed=len(ranked),
+                       result_key=batch_key(batch_id, "ranking.json"), **counts)
+    return ranked
+
+
+def is_upload_key(key):
+    return (isinstance(key, str) and key.startswith(BATCH_UPLOAD_PREFIX)
+            and '..' not in key.split('/') and len(key) > len(BATCH_UPLOAD_PREFIX))
+
+
+def validate_request(body):
+    """
+    The batch event for an API request. Only these fields are taken from the
+    client: the bucket is always RESUME_BUCKET and every key must be under
+    BATCH_UPLOAD_PREFIX, so a caller cannot point the function (and Textract)
+    at other objects its role can read.
+    """
+    job_description = body.get("job_description")
+    if not isinstance(job_description, str) or not job_description.strip():
+        raise ValueError("Missing 'job_description' in the body")
+    resume_keys, zip_key = body.get("resume_keys"), body.get("zip_key")
+    if not resume_keys and not zip_key:
+        raise ValueError("Provide 'resume_keys' or 'zip_key'")
+    if zip_key and not is_upload_key(zip_key):
+        raise ValueError(f"'zip_key' must be under {BATCH_UPLOAD_PREFIX}")
+    if resume_keys:
+        if not isinstance(resume_keys, list) or not all(is_upload_key(key) for key in resume_keys):
+            raise ValueError(f"'resume_keys' must be a list of keys under {BATCH_UPLOAD_PREFIX}")
+        if len(resume_keys) > MAX_BATCH_SIZE:
+            raise ValueError(f"A batch holds at most {MAX_BATCH_SIZE} resumes")
+    request = {"job_description": job_description, "bucket": RESUME_BUCKET}
+    if zip_key:
+        request["zip_key"] = zip_key
+    else:
+        request["resume_keys"] = resume_keys
+    for field, convert in (("prefilter_threshold", float), ("prefilter_top_k", int)):
+        if field in body:
+            request[field] = convert(body[field])
+    return request
+
+
+TASKS = {"prepare": prepare_task, "analyze": analyze_task}
+
+
+def run_task(task):
+    try:
+        TASKS[task["batch_stage"]](task)
+    except Exception as e:
+        print(f"Batch {task.get('batch_id')} {task.get('batch_stage')} task {task.get('index')} failed: {str(e)}")
+        raise
+
+
+def lambda_handler(event, context):
+    # API requests only validate and queue the batch; the work runs in an
+    # asynchronous invocation of this same function
+    if "httpMethod" in event:
+        if event["httpMethod"] == "OPTIONS":
+            return {'statusCode': 200, 'headers': CORS_HEADERS, 'body': json.dumps({'message': 'CORS preflight request successful'})}
+        try:
+            request = validate_request(json.loads(event.get("body") or "{}"))
+            batch_id = uuid.uuid4().hex
+            request["batch_id"] = batch_id
+            write_batch_status(batch_id, "queued")
+            lambda_client.invoke(
+                FunctionName=context.invoked_function_arn,
+                InvocationType='Event',
+                Payload=json.dumps(request)
+            )
+            return {
+                'statusCode': 202,
+                'headers': CORS_HEADERS,
+                'body': json.dumps({'batch_id': batch_id, 'status_key': batch_key(batch_id, "status.json")})
+            }
+        except Exception as e:
+            print(f"Error: {str(e)}")
+            return {'statusCode': 400, 'headers': CORS_HEADERS, 'body': json.dumps({'message': str(e)})}
+
+    # Fed by the batch queue: report failed tasks so only they are retried
+    if "Records" in event:
+        failures = []
+        for record in event["Records"]:
+            try:
+                run_task(json.loads(record["body"]))
+            except Exception:
+                failures.append({"itemIdentifier": record["messageId"]})
+        return {"batchItemFailures": failures}
+
+    # One task invoked asynchronously; raising lets Lambda retry it
+    if "batch_stage" in event:
+        run_task(event)
+        return {'statusCode': 200, 'body': json.dumps({'batch_id': event["batch_id"]})}
+
+    batch_id = event.get("batch_id") or uuid.uuid4().hex
+    try:
+        queued = start_batch(
+            batch_id,
+            event["job_description"].strip(),
+            resume_keys=event.get("resume_keys"),
+            zip_key=event.get("zip_key"),
+            bucket=event.get("bucket", RESUME_BUCKET),
+            prefilter_threshold=float(event.get("prefilter_threshold", PREFILTER_THRESHOLD)),
+            prefilter_top_k=int(event.get("prefilter_top_k", PREFILTER_TOP_K))
+        )
+        return {'statusCode': 202, 'body': json.dumps({'batch_id': batch_id, 'queued': queued})}
+    except Exception as e:
+        print(f"Batch {batch_id} failed: {str(e)}")
+        write_batch_status(batch_id, "failed", error=str(e))
+        return {'statusCode': 500, 'body': json.dumps({'batch_id': batch_id, 'error': str(e)})}
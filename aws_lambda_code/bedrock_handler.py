@@ -1,8 +1,46 @@
 import boto3
 import json
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
-# Initialize the Bedrock client
-bedrock_client = boto3.client('bedrock-runtime')
+import document_status
+import relevance_filter
+import result_index
+
+# Fan-out settings: prompts run concurrently, each bounded by a timeout and
+# retried with exponential backoff when Bedrock throttles
+MAX_WORKERS = int(os.environ.get('BEDROCK_MAX_WORKERS', '4'))
+PROMPT_TIMEOUT = float(os.environ.get('BEDROCK_PROMPT_TIMEOUT', '60'))
+MAX_RETRIES = int(os.environ.get('BEDROCK_MAX_RETRIES', '4'))
+RETRY_BASE_DELAY = float(os.environ.get('BEDROCK_RETRY_BASE_DELAY', '0.5'))
+RETRYABLE_ERRORS = {'ThrottlingException', 'TooManyRequestsException', 'ServiceUnavailableException', 'ModelNotReadyException'}
+
+MODEL_ID = 'anthropic.claude-v2:1'
+
+# 'per_prompt' sends each prompt separately; 'consolidated' asks for every
+# section in one JSON response and falls back to per-prompt calls for any
+# section that comes back missing or malformed
+BEDROCK_MODE = os.environ.get('BEDROCK_MODE', 'per_prompt')
+MAX_TOKENS_PER_PROMPT = 400
+CONSOLIDATED_MAX_TOKENS = 1600
+
+# Resumes whose local similarity to the job description (relevance_filter.
+# similarity, recorded as relevance_filter.METHOD) is below this are not sent
+# to Bedrock. 0 analyzes everything; the score is stored with every result as
+# _prefilter so the threshold can be tuned. The batch path checks the same score.
+PREFILTER_THRESHOLD = float(os.environ.get('PREFILTER_THRESHOLD', '0'))
+
+# Initialize the Bedrock client (retries are handled in query_with_retry)
+bedrock_client = boto3.client(
+    'bedrock-runtime',
+    config=Config(read_timeout=PROMPT_TIMEOUT, max_pool_connections=MAX_WORKERS, retries={'max_attempts': 1})
+)
 
 # Initialize S3 client
 s3_client = boto3.client('s3')
@@ -37,6 +75,9 @@ PROMPTS = {
     )
 }
 
+# Every section is a non-empty string in the consolidated JSON response
+SECTION_SCHEMA = {key: str for key in PROMPTS}
+
 # Helper function to clean and format the response
 def clean_response(text):
     # Replace \\n with a newline
@@ -45,17 +86,289 @@ def clean_response(text):
     cleaned_text = text.strip()
     return cleaned_text
 
+class TokenUsage:
+    """
+    Thread-safe tally of Bedrock calls and the token counts Bedrock reports.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def record(self, response):
+        headers = response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+        with self._lock:
+            self.calls += 1
+            self.input_tokens += int(headers.get('x-amzn-bedrock-input-token-count', 0))
+            self.output_tokens += int(headers.get('x-amzn-bedrock-output-token-count', 0))
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'input_tokens': self.input_tokens,
+                'output_tokens': self.output_tokens,
+            }
+
+# Function to interact with AWS Bedrock for one prompt
+def query_bedrock(prompt, resume_text, job_description, client=None, usage=None,
+                  max_tokens=MAX_TOKENS_PER_PROMPT):
+    client = client or bedrock_client
+    # Construct the conversational format required by Anthropic Claude
+    input_prompt = f"\n\nHuman: {prompt}\nResume Text:\n{resume_text}\n\nJob Description:\n{job_description}\n\nAssistant:"
+
+    # Invoke the model
+    response = client.invoke_model(
+        modelId=MODEL_ID,
+        body=json.dumps({
+            "prompt": input_prompt,
+            "max_tokens_to_sample": max_tokens
+        }),
+        accept='application/json',
+        contentType='application/json'
+    )
+    if usage is not None:
+        usage.record(response)
+
+    # Read and decode the StreamingBody
+    response_body = json.loads(response['body'].read().decode('utf-8'))
+    return response_body.get("completion", "No response received.")
+
+def is_retryable(error):
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in RETRYABLE_ERRORS
+
+def query_with_retry(prompt, resume_text, job_description, client=None, usage=None,
+                     max_tokens=MAX_TOKENS_PER_PROMPT, max_retries=MAX_RETRIES,
+                     base_delay=RETRY_BASE_DELAY, sleep=time.sleep):
+    """
+    query_bedrock, retried with exponential backoff and full jitter when throttled.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return query_bedrock(prompt, resume_text, job_description, client, usage, max_tokens)
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            delay = random.uniform(0, base_delay * 2 ** attempt)
+            print(f"Bedrock throttled ({e}); retrying in {delay:.2f}s")
+            sleep(delay)
+
+def run_prompts(prompts, resume_text, job_description, client=None, usage=None,
+                max_workers=MAX_WORKERS, timeout=PROMPT_TIMEOUT):
+    """
+    Run every prompt concurrently on a bounded thread pool.
+
+    Returns (responses, errors): cleaned completions for the prompts that
+    finished, and an error message for each prompt that failed or did not
+    finish within `timeout` seconds. One failure does not discard the rest.
+    """
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(prompts))))
+    futures = {
+        executor.submit(query_with_retry, prompt, resume_text, job_description, client, usage): key
+        for key, prompt in prompts.items()
+    }
+    done, not_done = wait(futures, timeout=timeout)
+    # Don't wait for stragglers; their results are discarded
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    responses, errors = {}, {}
+    for future in done:
+        key = futures[future]
+        try:
+            responses[key] = clean_response(future.result())
+        except Exception as e:
+            print(f"Prompt {key} failed: {str(e)}")
+            errors[key] = str(e)
+    for future in not_done:
+        key = futures[future]
+        print(f"Prompt {key} timed out after {timeout}s")
+        errors[key] = f"Timed out after {timeout} seconds"
+    return responses, errors
+
+def build_consolidated_prompt(prompts):
+    lines = [
+        "Complete every task below for the resume text and job description that follow.",
+        "Respond with only a JSON object, with no text before or after it. It must have exactly "
+        "these keys, and each value must be a plain string answering that task:",
+        "",
+    ]
+    for key, prompt in prompts.items():
+        lines.append(f"{json.dumps(key)}: {prompt}")
+    return "\n".join(lines)
+
+def parse_sections(completion, schema):
+    """
+    Extract the JSON object from a consolidated completion and validate it.
+
+    Returns (sections, invalid): the values that match the schema, and the
+    keys that are missing, of the wrong type or empty.
+    """
+    start, end = completion.find("{"), completion.rfind("}")
+    try:
+        parsed = json.loads(completion[start:end + 1]) if start != -1 else None
+    except ValueError:
+        parsed = None
+    if not isinstance(parsed, dict):
+        return {}, list(schema)
+
+    sections, invalid = {}, []
+    for key, expected_type in schema.items():
+        value = parsed.get(key)
+        if isinstance(value, expected_type) and str(value).strip():
+            sections[key] = clean_response(value)
+        else:
+            invalid.append(key)
+    return sections, invalid
+
+def run_consolidated(prompts, resume_text, job_description, client=None, usage=None):
+    """
+    Ask for every section in a single invocation, so the resume and job
+    description are sent once instead of once per prompt. Sections missing
+    from (or malformed in) the JSON answer are fetched with per-prompt calls.
+    """
+    try:
+        completion = query_with_retry(
+            build_consolidated_prompt(prompts), resume_text, job_description,
+            client, usage, max_tokens=CONSOLIDATED_MAX_TOKENS
+        )
+        sections, invalid = parse_sections(completion, {key: SECTION_SCHEMA.get(key, str) for key in prompts})
+    except Exception as e:
+        print(f"Consolidated Bedrock call failed: {str(e)}")
+        sections, invalid = {}, list(prompts)
+
+    errors = {}
+    if invalid:
+        print(f"Falling back to per-prompt calls for: {invalid}")
+        fallback, errors = run_prompts({key: prompts[key] for key in invalid}, resume_text, job_description, client, usage)
+        sections.update(fallback)
+    return sections, errors
+
+# Scale phrases like "from 0 to 1" or "/1" would otherwise be read as the score
+_SCALE_PHRASES = re.compile(r'\b0\s*(?:to|-|–)\s*1(?:\.0+)?\b|(?:out of|/)\s*1(?:\.0+)?\b(?!\s*\d)', re.I)
+_SCORE = re.compile(r'score\D{0,60}?(\d+(?:\.\d+)?)\s*(%|/\s*10{1,2}\b)?', re.I)
+
+
+def parse_relevancy_score(text):
+    """
+    Numeric 0-1 relevancy score from the candidate_relevancy prose, or None.
+    Percentages and x/10 or x/100 ratings are rescaled.
+    """
+    for match in _SCORE.finditer(_SCALE_PHRASES.sub(' ', text or '')):
+        value = float(match.group(1))
+        suffix = match.group(2)
+        if suffix == '%':
+            value /= 100
+        elif suffix:
+            value /= float(suffix.strip('/ '))
+        if 0 <= value <= 1:
+            return value
+    return None
+
+
+def analyze_text(resume_text, job_description, mode=BEDROCK_MODE, prompts=PROMPTS):
+    """
+    Run every analysis prompt for one resume. Returns (responses, errors):
+    one entry per prompt, plus metadata keys starting with '_'.
+    """
+    usage = TokenUsage()
+    start = time.perf_counter()
+    if mode == 'consolidated':
+        results, errors = run_consolidated(prompts, resume_text, job_description, usage=usage)
+    else:
+        results, errors = run_prompts(prompts, resume_text, job_description, usage=usage)
+    elapsed = time.perf_counter() - start
+    print(f"Processed {len(prompts)} prompts in {elapsed:.2f}s ({mode}): {usage.as_dict()}")
+
+    # Keep the prompt order; failed sections say so instead of disappearing
+    responses = {
+        key: results.get(key, f"Analysis unavailable: {errors.get(key)}")
+        for key in prompts
+    }
+    # Keys starting with '_' are metadata, not result sections
+    if "candidate_relevancy" in results:
+        responses["_relevancy_score"] = parse_relevancy_score(results["candidate_relevancy"])
+    if errors:
+        responses["_errors"] = errors
+    responses["_usage"] = dict(usage.as_dict(), mode=mode, seconds=round(elapsed, 3))
+    return responses, errors
+
+
+def prefilter(resume_text, job_description, threshold=PREFILTER_THRESHOLD):
+    score = relevance_filter.similarity(job_description, resume_text)
+    return {"score": round(score, 4), "method": relevance_filter.METHOD, "threshold": threshold, "passed": score >= threshold}
+
+
+def prefiltered_responses(check, prompts=PROMPTS):
+    # Same shape as an analysis, so the page and the batch table need no special case
+    message = f"Not analyzed: similarity to the job description ({check['score']}) is below the pre-filter threshold ({check['threshold']})."
+    return dict({key: message for key in prompts}, _prefilter=check)
+
+
 # Lambda function handler
-def lambda_handler(event, context):
+def load_resume_text(event):
+    """
+    Resume text from the payload, inline or as an S3 reference for large documents.
+    """
+    location = event.get("text_location")
+    if location:
+        text_object = s3_client.get_object(Bucket=location["bucket"], Key=location["key"])
+        return text_object['Body'].read().decode('utf-8')
+    return event.get("text", "")
+
+
+def save_prefiltered(file_name, responses):
+    # Not indexed: a later, lower threshold should still get a real analysis
+    response_key = f"responses/{file_name.replace('.pdf', '.json')}"
+    s3_client.put_object(
+        Bucket=RESULTS_BUCKET,
+        Key=response_key,
+        Body=json.dumps(responses),
+        ContentType='application/json'
+    )
+    document_status.write_status(file_name, document_status.DONE, result_key=response_key, prefiltered=True)
+    return {
+        'statusCode': 200,
+        'body': json.dumps(responses, indent=2)
+    }
+
+
+def analyze_document(event, context=None):
+    """
+    Run the analysis for one handoff payload and save it to RESULTS_BUCKET.
+    Payloads carrying an idempotency key are processed once: the claim is a
+    lease that runs out with this invocation, so a redelivery after a
+    timeout or crash redoes the work instead of finding it taken forever.
+    """
+    file_name = event.get("file_name", "default_response.json")
+    idempotency_key = event.get("idempotency_key")
+    lease_seconds = document_status.lease_seconds(context)
+    outcome = document_status.claim(idempotency_key, lease_seconds) if idempotency_key else document_status.CLAIMED
+    if outcome == document_status.COMPLETED:
+        print(f"{file_name} ({idempotency_key}) was already analyzed. Skipping.")
+        return {
+            'statusCode': 200,
+            'body': json.dumps({"message": "Already processed"})
+        }
+    if outcome == document_status.IN_PROGRESS:
+        # Not a success, so the delivery is retried and takes over if the holder died
+        print(f"{file_name} ({idempotency_key}) is being analyzed by another invocation.")
+        return {
+            'statusCode': 409,
+            'body': json.dumps({"message": "Analysis in progress"})
+        }
+
     try:
+        document_status.write_status(file_name, document_status.ANALYZING,
+                                     lease_expires_at=time.time() + lease_seconds)
+
         # Extract the text from the event payload
-        resume_text = event.get("text", "")
+        resume_text = load_resume_text(event)
         if not resume_text:
             raise ValueError("No text provided in the payload.")
         
         print("Received resume text for processing.")
-
-        file_name = event.get("file_name", "default_response.json")
         print('Filename: ', file_name)
 
         # Extract job description from S3
@@ -70,32 +383,20 @@ def lambda_handler(event, context):
         job_description = job_description_object['Body'].read().decode('utf-8')
         print("Job Description Content:", job_description)
 
-        # Function to interact with AWS Bedrock for each prompt
-        def query_bedrock(prompt):
-            # Construct the conversational format required by Anthropic Claude
-            input_prompt = f"\n\nHuman: {prompt}\nResume Text:\n{resume_text}\n\nJob Description:\n{job_description}\n\nAssistant:"
-            
-            # Invoke the model
-            response = bedrock_client.invoke_model(
-                modelId='anthropic.claude-v2:1',
-                body=json.dumps({
-                    "prompt": input_prompt,
-                    "max_tokens_to_sample": 400
-                }),
-                accept='application/json',
-                contentType='application/json'
-            )
+        # Cheap local relevance check first; clear mismatches never reach Bedrock
+        check = prefilter(resume_text, job_description, float(event.get("prefilter_threshold", PREFILTER_THRESHOLD)))
+        print(f"Pre-filter: {check}")
+        if not check["passed"]:
+            response = save_prefiltered(file_name, prefiltered_responses(check))
+            if idempotency_key:
+                document_status.complete(idempotency_key)
+            return response
 
-            # Read and decode the StreamingBody
-            response_body = json.loads(response['body'].read().decode('utf-8'))
-            return response_body.get("completion", "No response received.")
-        
-        # Process prompts
-        responses = {}
-        for key, prompt in PROMPTS.items():
-            print(f"Processing prompt: {key}")
-            raw_response = query_bedrock(prompt)
-            responses[key] = clean_response(raw_response)
+        # Process prompts: one consolidated call, or all prompts concurrently
+        mode = event.get("mode", BEDROCK_MODE)
+        responses, errors = analyze_text(resume_text, job_description, mode)
+        responses["_prefilter"] = check
+        results = {key: value for key, value in responses.items() if key in PROMPTS and key not in errors}
 
         # Log and return responses
         print("Bedrock responses:", responses)
@@ -110,14 +411,48 @@ def lambda_handler(event, context):
         )
         
         print(f"Response saved to S3 as {response_key}")
-        
+
+        # Index complete analyses by content so a resubmission reuses them
+        content_hash = event.get("content_hash")
+        if content_hash and not errors:
+            result_index.store_result(
+                content_hash, result_index.job_description_hash(job_description), json.dumps(responses)
+            )
+
+        if not results:
+            raise RuntimeError(f"Every prompt failed: {errors}")
+        document_status.write_status(file_name, document_status.DONE, result_key=response_key)
+        if idempotency_key:
+            document_status.complete(idempotency_key)
+
         return {
             'statusCode': 200,
             'body': json.dumps(responses, indent=2)
         }
     except Exception as e:
         print(f"Error occurred: {str(e)}")
+        if idempotency_key:
+            document_status.release(idempotency_key)
+        document_status.write_status(file_name, document_status.FAILED, error=str(e))
         return {
             'statusCode': 500,
             'body': json.dumps({"error": str(e)})
         }
+
+
+def lambda_handler(event, context):
+    # Fed by the analysis queue: report failed messages so only they are retried
+    if "Records" in event:
+        failures = []
+        for record in event["Records"]:
+            response = analyze_document(json.loads(record["body"]), context)
+            if response['statusCode'] != 200:
+                failures.append({"itemIdentifier": record["messageId"]})
+        return {"batchItemFailures": failures}
+
+    # Invoked directly (synchronously or with InvocationType='Event')
+    response = analyze_document(event, context)
+    if response['statusCode'] == 409:
+        # Raise so Lambda retries the async invocation after the holder's lease
+        raise RuntimeError(f"{event.get('file_name')} is being analyzed by another invocation")
+    return response
@@ -0,0 +1,129 @@
+import boto3
+import json
+import time
+from botocore.exceptions import ClientError
+
+# Per-document pipeline status, shared by the Textract and Bedrock Lambdas.
+# Each resume gets status/<name>.json next to its responses/<name>.json so
+# the web page can poll it while the stages run asynchronously.
+
+s3_client = boto3.client('s3')
+
+RESULTS_BUCKET = "resume-analysis-results-bucket"
+STATUS_PREFIX = "status/"
+CLAIM_PREFIX = "analysis-claims/"
+
+# Claims are leases. Without an invocation context they last as long as the
+# longest possible Lambda invocation; the margin covers clock differences.
+DEFAULT_LEASE_SECONDS = 15 * 60
+LEASE_MARGIN_SECONDS = 30
+
+# Outcomes of claim()
+CLAIMED = 'claimed'
+IN_PROGRESS = 'in_progress'
+COMPLETED = 'completed'
+
+# Stages in pipeline order
+EXTRACTING = 'extracting'
+QUEUED = 'queued'
+ANALYZING = 'analyzing'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def status_key(file_name):
+    return f"{STATUS_PREFIX}{file_name.replace('.pdf', '.json')}"
+
+
+def write_status(file_name, status, **fields):
+    record = dict(fields, file_name=file_name, status=status, updated_at=time.time())
+    s3_client.put_object(
+        Bucket=RESULTS_BUCKET,
+        Key=status_key(file_name),
+        Body=json.dumps(record),
+        ContentType='application/json',
+        CacheControl='no-cache'  # The browser polls this object
+    )
+    print(f"Status of {file_name}: {status}")
+    return record
+
+
+def read_status(file_name):
+    try:
+        status_object = s3_client.get_object(Bucket=RESULTS_BUCKET, Key=status_key(file_name))
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            return None
+        raise
+    return json.loads(status_object['Body'].read())
+
+
+def lease_seconds(context=None):
+    """
+    How long a claim taken now may be held: until the current invocation
+    would be stopped by its timeout, or DEFAULT_LEASE_SECONDS without a context.
+    """
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        return context.get_remaining_time_in_millis() / 1000 + LEASE_MARGIN_SECONDS
+    return DEFAULT_LEASE_SECONDS
+
+
+def _is_precondition_failure(e):
+    return e.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict')
+
+
+def claim(idempotency_key, lease_seconds=DEFAULT_LEASE_SECONDS, bucket=RESULTS_BUCKET, prefix=CLAIM_PREFIX):
+    """
+    Take the lease on a unit of work. Returns CLAIMED when this invocation
+    should do the work, IN_PROGRESS while another delivery holds an unexpired
+    lease, or COMPLETED once the work was marked done.
+
+    A claim left behind by an invocation that timed out or ran out of memory
+    expires with its lease and is taken over by the next delivery, with a
+    write conditional on the stale claim's ETag so only one delivery wins.
+    """
+    key = f"{prefix}{idempotency_key}"
+    body = json.dumps({'state': 'running', 'expires_at': time.time() + lease_seconds})
+    try:
+        s3_client.put_object(Bucket=bucket, Key=key, Body=body, IfNoneMatch='*')
+        return CLAIMED
+    except ClientError as e:
+        if not _is_precondition_failure(e):
+            raise
+
+    try:
+        existing = s3_client.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            # Released between the two calls; the holder's retry takes it
+            return IN_PROGRESS
+        raise
+    # Claims written before leases existed are empty and are treated as expired
+    record = json.loads(existing['Body'].read() or b'{}')
+    if record.get('state') == 'done':
+        return COMPLETED
+    if record.get('expires_at', 0) > time.time():
+        return IN_PROGRESS
+
+    try:
+        s3_client.put_object(Bucket=bucket, Key=key, Body=body, IfMatch=existing['ETag'])
+    except ClientError as e:
+        if _is_precondition_failure(e):
+            return IN_PROGRESS
+        raise
+    print(f"Took over the expired claim {key}")
+    return CLAIMED
+
+
+def complete(idempotency_key, bucket=RESULTS_BUCKET, prefix=CLAIM_PREFIX):
+    # Later deliveries of the same work are acknowledged without redoing it
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=f"{prefix}{idempotency_key}",
+        Body=json.dumps({'state': 'done', 'completed_at': time.time()})
+    )
+
+
+def release(idempotency_key, bucket=RESULTS_BUCKET, prefix=CLAIM_PREFIX):
+    # Let a redelivery retry work that failed part way
+    s3_client.delete_object(Bucket=bucket, Key=f"{prefix}{idempotency_key}")
@@ -0,0 +1,67 @@
+import itertools
+import json
+from collections import deque
+
+# In-memory stand-in for the SQS queue between the Textract and Bedrock
+# stages, for running the whole pipeline locally:
+#
+#   queue = LocalQueue()
+#   textract_handler.sqs_client = queue
+#   textract_handler.ANALYSIS_QUEUE_URL = "local"
+#   ...
+#   queue.drain(bedrock_handler.lambda_handler)
+#
+# local_textract.LocalTextract stands in for Textract the same way.
+
+
+class LocalQueue:
+    """
+    Implements the part of the SQS client textract_handler uses
+    (send_message, with FIFO deduplication) and delivers messages to a
+    handler in SQS event format, honouring partial batch failures.
+    """
+
+    def __init__(self, max_receive_count=3):
+        self.max_receive_count = max_receive_count
+        self.messages = deque()
+        self.dead_letters = []
+        self._deduplication_ids = set()
+        self._ids = itertools.count(1)
+
+    def send_message(self, QueueUrl, MessageBody, MessageDeduplicationId=None, **kwargs):
+        message_id = str(next(self._ids))
+        if MessageDeduplicationId is not None:
+            if MessageDeduplicationId in self._deduplication_ids:
+                return {'MessageId': message_id}
+            self._deduplication_ids.add(MessageDeduplicationId)
+        self.messages.append({'messageId': message_id, 'body': MessageBody, 'receiveCount': 0})
+        return {'MessageId': message_id}
+
+    def drain(self, handler, batch_size=10):
+        """
+        Deliver messages until the queue is empty. Failed messages are
+        redelivered up to max_receive_count times, then moved to dead_letters.
+        """
+        delivered = 0
+        while self.messages:
+            batch = [self.messages.popleft() for _ in range(min(batch_size, len(self.messages)))]
+            for message in batch:
+                message['receiveCount'] += 1
+            event = {'Records': [
+                {'messageId': m['messageId'], 'body': m['body'], 'eventSource': 'aws:sqs'}
+                for m in batch
+            ]}
+            response = handler(event, None) or {}
+            failed = {item['itemIdentifier'] for item in response.get('batchItemFailures', [])}
+            for message in batch:
+                if message['messageId'] not in failed:
+                    continue
+                if message['receiveCount'] >= self.max_receive_count:
+                    self.dead_letters.append(message)
+                else:
+                    self.messages.append(message)
+            delivered += len(batch)
+        return delivered
+
+    def pending(self):
+        return [json.loads(m['body']) for m in self.messages]
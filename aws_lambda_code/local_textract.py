@@ -0,0 +1,83 @@
+import itertools
+import json
+import time
+
+# In-memory stand-in for Textract's asynchronous text detection, for running
+# the pipeline locally together with LocalQueue:
+#
+#   textract = LocalTextract({"resume.pdf": [["Jane Doe", "Python"], ["Page two"]]})
+#   textract_handler.textract_client = textract
+#   textract_handler.lambda_handler(s3_upload_event, None)
+#   textract_handler.lambda_handler(textract.completion_event(job_id), None)
+
+
+class LocalTextract:
+    """
+    Implements the part of the Textract client textract_handler uses.
+    Jobs finish as soon as they start; documents not in `documents` fail.
+    completion_event() builds the SNS notification Textract would publish.
+    """
+
+    def __init__(self, documents=None, page_size=1000):
+        # Object key -> list of pages, each a list of lines
+        self.documents = dict(documents or {})
+        self.page_size = page_size
+        self.jobs = {}
+        self._tokens = {}
+        self._ids = itertools.count(1)
+
+    def start_document_text_detection(self, DocumentLocation, ClientRequestToken=None,
+                                      JobTag=None, NotificationChannel=None, **kwargs):
+        # The same request token returns the job it started before
+        if ClientRequestToken is not None and ClientRequestToken in self._tokens:
+            return {'JobId': self._tokens[ClientRequestToken]}
+        job_id = f"local-job-{next(self._ids)}"
+        location = DocumentLocation['S3Object']
+        self.jobs[job_id] = {
+            'bucket': location['Bucket'],
+            'key': location['Name'],
+            'tag': JobTag,
+            'status': 'SUCCEEDED' if location['Name'] in self.documents else 'FAILED',
+        }
+        if ClientRequestToken is not None:
+            self._tokens[ClientRequestToken] = job_id
+        return {'JobId': job_id}
+
+    def _blocks(self, key):
+        blocks = []
+        for page, lines in enumerate(self.documents[key], 1):
+            blocks.append({'BlockType': 'PAGE', 'Page': page})
+            blocks.extend({'BlockType': 'LINE', 'Text': line, 'Page': page} for line in lines)
+        return blocks
+
+    def get_document_text_detection(self, JobId, MaxResults=1000, NextToken=None):
+        job = self.jobs[JobId]
+        if job['status'] != 'SUCCEEDED':
+            return {'JobStatus': job['status'], 'Blocks': []}
+        blocks = self._blocks(job['key'])
+        start = int(NextToken or 0)
+        end = start + min(MaxResults, self.page_size)
+        response = {
+            'JobStatus': 'SUCCEEDED',
+            'Blocks': blocks[start:end],
+            'DocumentMetadata': {'Pages': len(self.documents[job['key']])},
+        }
+        if end < len(blocks):
+            response['NextToken'] = str(end)
+        return response
+
+    def completion_event(self, job_id):
+        """
+        Lambda event for the SNS completion notification of one job.
+        """
+        job = self.jobs[job_id]
+        message = {
+            'JobId': job_id,
+            'Status': job['status'],
+            'API': 'StartDocumentTextDetection',
+            'Timestamp': int(time.time() * 1000),
+            'DocumentLocation': {'S3ObjectName': job['key'], 'S3Bucket': job['bucket']},
+        }
+        if job['tag']:
+            message['JobTag'] = job['tag']
+        return {'Records': [{'EventSource': 'aws:sns', 'Sns': {'Message': json.dumps(message)}}]}
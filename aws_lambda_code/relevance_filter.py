@@ -0,0 +1,109 @@
+import math
+import re
+import zlib
+
+import numpy as np
+
+# Cheap local relevance score between a resume and a job description, used
+# to keep obvious mismatches away from the Bedrock prompts. Words and word
+# bigrams are hashed into a fixed feature space (no vocabulary to fit or
+# ship), weighted 1 + log(tf), optionally by IDF across a batch, and compared
+# with cosine similarity. Nothing here touches the network.
+
+N_FEATURES = 2 ** 20
+
+# Stored scores carry the name of the method that produced them; thresholds
+# apply to METHOD, which both the single-resume and the batch paths use.
+# IDF_METHOD scores depend on the rest of the batch and only order candidates.
+METHOD = "tf-cosine"
+IDF_METHOD = "tf-idf-cosine"
+
+_TOKEN = re.compile(r"[a-z0-9][a-z0-9+#.]*[a-z0-9+#]|[a-z0-9]")
+
+STOP_WORDS = frozenset("""
+a about above after all also an and any are as at be been being but by can could did do does
+for from had has have having he her his how i if in into is it its me my no not of on or our
+she so such than that the their them then there these they this those to too us was we were
+what when where which while who will with would you your
+""".split())
+
+
+def tokenize(text):
+    return [t for t in _TOKEN.findall((text or "").casefold()) if t not in STOP_WORDS]
+
+
+def hashed_terms(text, n_features=N_FEATURES):
+    """
+    (feature indices, counts) of the words and word bigrams in `text`.
+    crc32 keeps the hashing stable across processes, unlike hash().
+    """
+    tokens = tokenize(text)
+    terms = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    if not terms:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    indices = np.fromiter((zlib.crc32(t.encode('utf-8')) % n_features for t in terms), dtype=np.int64, count=len(terms))
+    return np.unique(indices, return_counts=True)
+
+
+def _weights(counts, idf=None):
+    weights = 1.0 + np.log(counts)
+    if idf is not None:
+        weights = weights * idf
+    norm = math.sqrt(float(np.dot(weights, weights)))
+    return weights / norm if norm else weights
+
+
+def _cosine(a_indices, a_weights, b_indices, b_weights):
+    common, a_at, b_at = np.intersect1d(a_indices, b_indices, assume_unique=True, return_indices=True)
+    if not common.size:
+        return 0.0
+    return float(np.dot(a_weights[a_at], b_weights[b_at]))
+
+
+def similarity(job_description, resume_text):
+    """
+    Cosine similarity in [0, 1] between one resume and the job description.
+    """
+    jd_indices, jd_counts = hashed_terms(job_description)
+    cv_indices, cv_counts = hashed_terms(resume_text)
+    return _cosine(jd_indices, _weights(jd_counts), cv_indices, _weights(cv_counts))
+
+
+def similarities(job_description, resume_texts):
+    """
+    Scores for many resumes against one job description. Terms are weighted
+    by IDF over the batch, so boilerplate every resume shares counts less than
+    the skills that set candidates apart.
+    """
+    docs = [hashed_terms(text) for text in resume_texts]
+    jd_indices, jd_counts = hashed_terms(job_description)
+    if not docs:
+        return []
+
+    # Document frequency of the job description's terms across the resumes
+    df = np.zeros(len(jd_indices), dtype=np.float64)
+    for indices, _ in docs:
+        df += np.isin(jd_indices, indices, assume_unique=True)
+    idf = np.log((1 + len(docs)) / (1 + df)) + 1.0
+
+    jd_weights = _weights(jd_counts, idf)
+    scores = []
+    for indices, counts in docs:
+        # Resume terms the job description lacks only matter through the norm
+        doc_idf = np.ones(len(indices), dtype=np.float64)
+        common, jd_at, doc_at = np.intersect1d(jd_indices, indices, assume_unique=True, return_indices=True)
+        doc_idf[doc_at] = idf[jd_at]
+        scores.append(_cosine(jd_indices, jd_weights, indices, _weights(counts, doc_idf)))
+    return scores
+
+
+def select(scores, threshold=0.0, top_k=0, order_by=None):
+    """
+    Indices of the candidates that pass: score >= threshold and, when top_k
+    is set, among the top_k by `order_by` (default: the scores themselves).
+    Returned best first.
+    """
+    order_by = scores if order_by is None else order_by
+    order = sorted(range(len(scores)), key=lambda i: -order_by[i])
+    passed = [i for i in order if scores[i] >= threshold]
+    return passed[:top_k] if top_k else passed
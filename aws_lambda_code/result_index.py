@@ -0,0 +1,149 @@
+import base64
+import boto3
+import hashlib
+import json
+import unicodedata
+from botocore.exceptions import ClientError
+
+# Content-addressed index of finished work, shared by the resume Lambdas.
+#
+#   index/results/<pdf sha256>/<job description sha256>.json
+#       copy of the analysis for that resume + job description pair
+#   index/text/<pdf sha256>.txt
+#       extracted text of that resume, reused when only the job description changes
+#
+# A resubmitted pair is answered by copying the stored JSON to
+# responses/<file name>.json without running Textract or Bedrock again.
+
+s3_client = boto3.client('s3')
+
+RESULTS_BUCKET = "resume-analysis-results-bucket"
+RESULT_PREFIX = "index/results/"
+TEXT_PREFIX = "index/text/"
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def normalize_job_description(text):
+    # Requisitions that differ only in case, spacing or line breaks share results
+    return " ".join(unicodedata.normalize('NFKC', text).casefold().split())
+
+
+def job_description_hash(text):
+    return hashlib.sha256(normalize_job_description(text).encode('utf-8')).hexdigest()
+
+
+def content_hash(data):
+    """
+    sha256 of the PDF bytes; `data` is bytes or a readable stream (e.g. an S3 body).
+    """
+    digest = hashlib.sha256()
+    if isinstance(data, (bytes, bytearray)):
+        digest.update(data)
+    else:
+        for chunk in iter(lambda: data.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def object_hash(bucket, key):
+    """
+    sha256 of an S3 object: the checksum S3 verified when the object was
+    uploaded with one (presigned uploads are), otherwise hashed from its bytes.
+    """
+    head = s3_client.head_object(Bucket=bucket, Key=key, ChecksumMode='ENABLED')
+    checksum = head.get('ChecksumSHA256')
+    # Multipart checksums ("<base64>-<parts>") hash the parts, not the object
+    if checksum and '-' not in checksum:
+        return base64.b64decode(checksum).hex()
+    return content_hash(s3_client.get_object(Bucket=bucket, Key=key)['Body'])
+
+
+def result_key(pdf_hash, jd_hash):
+    return f"{RESULT_PREFIX}{pdf_hash}/{jd_hash}.json"
+
+
+def text_key(pdf_hash):
+    return f"{TEXT_PREFIX}{pdf_hash}.txt"
+
+
+def response_key(file_name):
+    return f"responses/{file_name.replace('.pdf', '.json')}"
+
+
+def _exists(key):
+    try:
+        s3_client.head_object(Bucket=RESULTS_BUCKET, Key=key)
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+
+def store_result(pdf_hash, jd_hash, body):
+    s3_client.put_object(
+        Bucket=RESULTS_BUCKET,
+        Key=result_key(pdf_hash, jd_hash),
+        Body=body,
+        ContentType='application/json'
+    )
+
+
+def load_result(pdf_hash, jd_hash):
+    try:
+        result_object = s3_client.get_object(Bucket=RESULTS_BUCKET, Key=result_key(pdf_hash, jd_hash))
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+            return None
+        raise
+    return json.loads(result_object['Body'].read())
+
+
+def publish_cached_result(pdf_hash, jd_hash, file_name):
+    """
+    Copy a stored analysis to responses/<file_name>.json.
+    Returns the response key, or None if the pair has not been analyzed yet.
+    """
+    key = result_key(pdf_hash, jd_hash)
+    if not _exists(key):
+        return None
+    target = response_key(file_name)
+    s3_client.copy_object(
+        Bucket=RESULTS_BUCKET,
+        Key=target,
+        CopySource={'Bucket': RESULTS_BUCKET, 'Key': key},
+        ContentType='application/json',
+        MetadataDirective='REPLACE'
+    )
+    print(f"Reused analysis {key} for {file_name}")
+    return target
+
+
+def find_text(pdf_hash):
+    """
+    Location of the cached extracted text for this PDF, or None.
+    """
+    key = text_key(pdf_hash)
+    if not _exists(key):
+        return None
+    return {"bucket": RESULTS_BUCKET, "key": key}
+
+
+def load_text(pdf_hash):
+    try:
+        text_object = s3_client.get_object(Bucket=RESULTS_BUCKET, Key=text_key(pdf_hash))
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+            return None
+        raise
+    return text_object['Body'].read().decode('utf-8')
+
+
+def store_text(pdf_hash, text):
+    s3_client.put_object(
+        Bucket=RESULTS_BUCKET,
+        Key=text_key(pdf_hash),
+        Body=text.encode('utf-8'),
+        ContentType='text/plain; charset=utf-8'
+    )
@@ -1,6 +1,10 @@
 import boto3
 import json
 import base64
+import os
+
+import document_status
+import result_index
 
 # Initialize S3 client
 s3_client = boto3.client('s3')
@@ -9,6 +13,79 @@ s3_client = boto3.client('s3')
 RESUME_BUCKET = "candidate-resume-processing-bucket"
 JOB_DESCRIPTION_BUCKET = "candidate-job-description-bucket"  # New bucket for job descriptions
 
+# Presigned uploads: the browser posts the files straight to S3, so this
+# function never sees the PDF and its cost doesn't grow with resume size
+PRESIGNED_URL_EXPIRY = int(os.environ.get('PRESIGNED_URL_EXPIRY', '300'))
+MAX_RESUME_BYTES = int(os.environ.get('MAX_RESUME_BYTES', str(10 * 1024 * 1024)))
+MAX_JOB_DESCRIPTION_BYTES = int(os.environ.get('MAX_JOB_DESCRIPTION_BYTES', str(256 * 1024)))
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',  # Adjust '*' to specific domains in production
+    'Access-Control-Allow-Methods': 'POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type'
+}
+
+
+def presigned_upload(bucket, key, content_type, max_bytes, content_sha256=None):
+    """
+    Presigned POST for one object, limited to the given type and size. With
+    content_sha256 (hex), S3 rejects an upload whose bytes hash differently
+    and stores the verified checksum with the object.
+    """
+    fields = {'Content-Type': content_type}
+    if content_sha256:
+        fields['x-amz-checksum-algorithm'] = 'SHA256'
+        fields['x-amz-checksum-sha256'] = base64.b64encode(bytes.fromhex(content_sha256)).decode('ascii')
+    return s3_client.generate_presigned_post(
+        Bucket=bucket,
+        Key=key,
+        Fields=fields,
+        Conditions=[{name: value} for name, value in fields.items()] + [
+            ['content-length-range', 1, max_bytes]
+        ],
+        ExpiresIn=PRESIGNED_URL_EXPIRY
+    )
+
+
+def presigned_uploads(file_name, content_sha256=None):
+    # The job description must be uploaded first: the PDF upload starts the pipeline
+    job_description_file_name = file_name.replace(".pdf", ".txt")
+    return {
+        'job_description': presigned_upload(
+            JOB_DESCRIPTION_BUCKET, job_description_file_name, 'text/plain', MAX_JOB_DESCRIPTION_BYTES
+        ),
+        'resume': presigned_upload(RESUME_BUCKET, file_name, 'application/pdf', MAX_RESUME_BYTES, content_sha256),
+        'expires_in': PRESIGNED_URL_EXPIRY
+    }
+
+
+def parse_sha256(value):
+    # A hex sha256, or None for anything else
+    if isinstance(value, str) and len(value) == 64:
+        try:
+            return bytes.fromhex(value).hex()
+        except ValueError:
+            pass
+    return None
+
+
+def cached_result(pdf_hash, job_description, file_name):
+    """
+    If this resume + job description pair was analyzed before, publish the
+    stored result under file_name and return the response body for the client.
+    """
+    jd_hash = result_index.job_description_hash(job_description)
+    response_key = result_index.publish_cached_result(pdf_hash, jd_hash, file_name)
+    if not response_key:
+        return None
+    document_status.write_status(file_name, document_status.DONE, result_key=response_key, cached=True)
+    return {
+        'message': 'This resume was already analyzed for this job description',
+        'cached': True,
+        'result_key': response_key
+    }
+
+
 def lambda_handler(event, context):
     try:
         # Handle preflight requests (CORS)
@@ -26,7 +103,6 @@ def lambda_handler(event, context):
             }
 
         print('resume lambda invoked...')
-        print('event: ', event)
 
         # Parse the body from the event
         body = event.get("body", "")
@@ -35,13 +111,27 @@ def lambda_handler(event, context):
         
         # Decode the JSON body
         parsed_body = json.loads(body)
-        get_file_content = parsed_body.get("content", None)
         file_name = parsed_body.get("file_name", "default_file_name.pdf")
-        job_description = parsed_body.get("job_description", "").strip()  # Extract job description
-        
-        print("get_file_content is: ", get_file_content)
         print('file_name: ', file_name)
-        print('job_description: ', job_description)
+
+        if parsed_body.get("mode") == "presigned":
+            if not file_name.lower().endswith(".pdf"):
+                raise ValueError("'file_name' must be a .pdf")
+            # The browser's sha256 is only a claim, so it never unlocks a
+            # stored analysis here. S3 checks the upload against it, and
+            # textract_handler reuses earlier work by the verified checksum.
+            content_sha256 = parse_sha256(parsed_body.get("content_sha256"))
+            print(f"Issuing presigned uploads for {file_name}")
+            return {
+                'statusCode': 200,
+                'headers': CORS_HEADERS,
+                'body': json.dumps(presigned_uploads(file_name, content_sha256))
+            }
+
+        # Legacy mode: the PDF arrives base64-encoded in the request body
+        get_file_content = parsed_body.get("content", None)
+        job_description = parsed_body.get("job_description", "").strip()  # Extract job description
+        print(f"Received {len(get_file_content or '')} base64 characters and a {len(job_description)} character job description")
 
         if not get_file_content:
             raise ValueError("Missing 'content' in the body")
@@ -52,6 +142,10 @@ def lambda_handler(event, context):
         # Decode the base64 content
         decode_content = base64.b64decode(get_file_content)
 
+        cached = cached_result(result_index.content_hash(decode_content), job_description, file_name)
+        if cached:
+            return {'statusCode': 200, 'headers': CORS_HEADERS, 'body': json.dumps(cached)}
+
         # Upload the PDF file to the resume bucket
         s3_client.put_object(
             Bucket=RESUME_BUCKET,
@@ -72,11 +166,7 @@ def lambda_handler(event, context):
 
         return {
             'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',  # Adjust '*' to specific domains in production
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
-            },
+            'headers': CORS_HEADERS,
             'body': json.dumps({
                 'message': 'File and job description uploaded successfully'
             })
@@ -85,11 +175,7 @@ def lambda_handler(event, context):
         print(f"Error: {str(e)}")
         return {
             'statusCode': 500,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
-            },
+            'headers': CORS_HEADERS,
             'body': json.dumps({
                 'message': 'Failed to upload file or job description',
                 'error': str(e)
@@ -1,74 +1,348 @@
 import boto3
+import hashlib
+import itertools
 import json
+import os
+import random
+import tempfile
+import time
+from botocore.exceptions import ClientError
+
+import document_status
+import result_index
 
 # Initialize clients for S3, Textract, and Lambda
 s3_client = boto3.client('s3')
 textract_client = boto3.client('textract')
 lambda_client = boto3.client('lambda')  # For invoking the bedrock Lambda function
+sqs_client = boto3.client('sqs')
 
 BEDROCK_LAMBDA = "arn:aws:lambda:us-east-1:619071344683:function:bedrock-handler"
+JOB_DESCRIPTION_BUCKET = "candidate-job-description-bucket"
+
+# With a queue URL the Bedrock stage is fed through SQS; otherwise it is
+# invoked asynchronously. Either way this function returns as soon as the
+# work is handed over instead of waiting for the analysis
+ANALYSIS_QUEUE_URL = os.environ.get('ANALYSIS_QUEUE_URL')
+
+# When both are set, Textract publishes job completion to this SNS topic and
+# this function is invoked again with the notification instead of polling
+TEXTRACT_SNS_TOPIC_ARN = os.environ.get('TEXTRACT_SNS_TOPIC_ARN')
+TEXTRACT_ROLE_ARN = os.environ.get('TEXTRACT_ROLE_ARN')
+
+# Fallback polling (no notification channel): exponential backoff with jitter
+POLL_INITIAL_DELAY = float(os.environ.get('TEXTRACT_POLL_INITIAL_DELAY', '1'))
+POLL_MAX_DELAY = float(os.environ.get('TEXTRACT_POLL_MAX_DELAY', '20'))
+POLL_TIMEOUT = float(os.environ.get('TEXTRACT_POLL_TIMEOUT', '600'))
+
+# One marker object per Textract job makes the Bedrock handoff happen once,
+# even if a completion notification is delivered more than once. The marker
+# is a lease: staging the text and queueing take seconds, so a marker still
+# "running" after HANDOFF_LEASE_SECONDS was left by a crashed invocation and
+# the next delivery takes it over (the Bedrock stage drops duplicates).
+HANDOFF_BUCKET = os.environ.get('HANDOFF_BUCKET', 'resume-analysis-results-bucket')
+HANDOFF_PREFIX = "textract-handoffs/"
+HANDOFF_LEASE_SECONDS = float(os.environ.get('HANDOFF_LEASE_SECONDS', '300'))
+
+# Extracted text larger than this is written to S3 and passed by reference;
+# async Lambda payloads are capped at 256 KB and JSON escaping adds overhead
+TEXT_INLINE_LIMIT = int(os.environ.get('TEXT_INLINE_LIMIT', str(128 * 1024)))
+TEXT_PREFIX = "textract-text/"
+
+# Blocks requested per GetDocumentTextDetection call (API maximum)
+RESULTS_PAGE_SIZE = 1000
+
+
+def upload_token(bucket_name, object_key, upload_id=None):
+    # Same value for redeliveries of one upload event, new value for a re-upload
+    token_source = f"{bucket_name}/{object_key}/{upload_id or ''}"
+    return hashlib.sha256(token_source.encode('utf-8')).hexdigest()[:64]
+
+
+def start_text_detection(bucket_name, object_key, upload_id=None, pdf_hash=None):
+    """
+    Start a Textract job for one PDF. The request token makes a redelivered
+    S3 event reuse the running job instead of starting a second one, while a
+    fresh upload of the same key (new upload_id) gets a new job. The PDF's
+    content hash rides along as the JobTag and comes back in the notification.
+    """
+    params = {
+        'DocumentLocation': {
+            'S3Object': {
+                'Bucket': bucket_name,
+                'Name': object_key
+            }
+        },
+        'ClientRequestToken': upload_token(bucket_name, object_key, upload_id),
+    }
+    if pdf_hash:
+        params['JobTag'] = pdf_hash
+    if TEXTRACT_SNS_TOPIC_ARN and TEXTRACT_ROLE_ARN:
+        params['NotificationChannel'] = {
+            'SNSTopicArn': TEXTRACT_SNS_TOPIC_ARN,
+            'RoleArn': TEXTRACT_ROLE_ARN
+        }
+    response = textract_client.start_document_text_detection(**params)
+    return response['JobId']
+
+
+def wait_for_job(job_id, timeout=POLL_TIMEOUT, initial_delay=POLL_INITIAL_DELAY,
+                 max_delay=POLL_MAX_DELAY, sleep=time.sleep):
+    """
+    Poll a Textract job until it leaves IN_PROGRESS or `timeout` seconds pass.
+    Waits grow exponentially up to max_delay, with jitter so concurrent
+    uploads don't poll in lockstep.
+    """
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+    while True:
+        status = textract_client.get_document_text_detection(JobId=job_id, MaxResults=1)['JobStatus']
+        if status != 'IN_PROGRESS' or time.monotonic() >= deadline:
+            return status
+        sleep(delay / 2 + random.uniform(0, delay / 2))
+        delay = min(delay * 2, max_delay)
+
+
+def iter_lines(job_id, page_size=RESULTS_PAGE_SIZE):
+    """
+    Yield (page number, LINE text) for a finished job, following NextToken
+    across result pages. Textract returns blocks in reading order, so lines
+    come out in document order without holding all blocks in memory.
+    """
+    params = {'JobId': job_id, 'MaxResults': page_size}
+    while True:
+        response = textract_client.get_document_text_detection(**params)
+        for block in response['Blocks']:
+            if block['BlockType'] == 'LINE':
+                yield block.get('Page', 1), block['Text']
+        next_token = response.get('NextToken')
+        if not next_token:
+            return
+        params['NextToken'] = next_token
+
+
+def iter_pages(job_id, page_size=RESULTS_PAGE_SIZE):
+    """
+    Yield (page number, list of lines) one document page at a time.
+    """
+    for page, lines in itertools.groupby(iter_lines(job_id, page_size), key=lambda line: line[0]):
+        yield page, [text for _, text in lines]
+
+
+def stage_text(job_id, inline_limit=TEXT_INLINE_LIMIT, pdf_hash=None):
+    """
+    Assemble the job's text and return the Bedrock payload fields for it:
+    {"text": ...} when it is small enough to inline, otherwise
+    {"text_location": {"bucket", "key"}} after uploading it to S3.
+
+    Text is spooled to a temporary file once it passes inline_limit, so
+    memory use stays bounded however long the document is. With a pdf_hash
+    the text is always saved to the result index for later uploads of the
+    same PDF.
+    """
+    size = 0
+    pages = 0
+    with tempfile.SpooledTemporaryFile(max_size=inline_limit) as buffer:
+        for page, lines in iter_pages(job_id):
+            chunk = "\n".join(lines).encode('utf-8')
+            if pages:
+                buffer.write(b"\n")
+                size += 1
+            buffer.write(chunk)
+            size += len(chunk)
+            pages += 1
+        buffer.seek(0)
+        print(f"Extracted {size} bytes of text from {pages} page(s) for job {job_id}")
+
+        if pdf_hash:
+            bucket, key = result_index.RESULTS_BUCKET, result_index.text_key(pdf_hash)
+        elif size > inline_limit:
+            bucket, key = HANDOFF_BUCKET, f"{TEXT_PREFIX}{job_id}.txt"
+        else:
+            return {"text": buffer.read().decode('utf-8')}
+
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=buffer,
+            ContentType='text/plain; charset=utf-8'
+        )
+        if size <= inline_limit:
+            buffer.seek(0)
+            return {"text": buffer.read().decode('utf-8')}
+        return {"text_location": {"bucket": bucket, "key": key}}
+
+
+def claim_handoff(job_id):
+    """
+    Take the lease on handing this job to Bedrock (see document_status.claim).
+    Returns False if another invocation holds it or already handed the job off.
+    """
+    outcome = document_status.claim(job_id, HANDOFF_LEASE_SECONDS, bucket=HANDOFF_BUCKET, prefix=HANDOFF_PREFIX)
+    return outcome == document_status.CLAIMED
+
+
+def complete_handoff(job_id):
+    document_status.complete(job_id, bucket=HANDOFF_BUCKET, prefix=HANDOFF_PREFIX)
+
+
+def release_handoff(job_id):
+    # Let a later retry hand the job off again after a failed invocation
+    document_status.release(job_id, bucket=HANDOFF_BUCKET, prefix=HANDOFF_PREFIX)
+
+
+def dispatch_analysis(payload, idempotency_key):
+    """
+    Queue the Bedrock analysis without waiting for it. The idempotency key
+    travels with the payload so the Bedrock stage can drop redeliveries.
+    """
+    payload = dict(payload, idempotency_key=idempotency_key)
+    if ANALYSIS_QUEUE_URL:
+        params = {'QueueUrl': ANALYSIS_QUEUE_URL, 'MessageBody': json.dumps(payload)}
+        if ANALYSIS_QUEUE_URL.endswith('.fifo'):
+            params['MessageGroupId'] = idempotency_key
+            params['MessageDeduplicationId'] = idempotency_key
+        sqs_client.send_message(**params)
+        return
+
+    response = lambda_client.invoke(
+        FunctionName=BEDROCK_LAMBDA,
+        InvocationType='Event',
+        Payload=json.dumps(payload)
+    )
+    if response.get('StatusCode') != 202:
+        raise RuntimeError(f"Async invoke returned status {response.get('StatusCode')}")
+
+
+def hand_off_to_bedrock(job_id, object_key, pdf_hash=None):
+    if not claim_handoff(job_id):
+        print(f"Textract job {job_id} was already handed off. Skipping.")
+        return
+
+    try:
+        # Small documents travel inline, large ones as an S3 reference
+        payload = stage_text(job_id, pdf_hash=pdf_hash)
+        payload["file_name"] = object_key
+        if pdf_hash:
+            payload["content_hash"] = pdf_hash
+
+        print("Queueing the Bedrock analysis...")
+        dispatch_analysis(payload, idempotency_key=job_id)
+        complete_handoff(job_id)
+        document_status.write_status(object_key, document_status.QUEUED, job_id=job_id)
+    except Exception as e:
+        print(f"Failed to hand off to the Bedrock stage: {str(e)}")
+        release_handoff(job_id)
+        document_status.write_status(object_key, document_status.FAILED, job_id=job_id, error=str(e))
+
+
+def handle_completion(message):
+    """
+    Handle a Textract completion notification (the SNS message body).
+    """
+    job_id = message['JobId']
+    object_key = message['DocumentLocation']['S3ObjectName']
+    print(f"Textract job {job_id} for {object_key} finished with status {message['Status']}")
+
+    if message['Status'] == 'SUCCEEDED':
+        hand_off_to_bedrock(job_id, object_key, message.get('JobTag'))
+    else:
+        print("Textract Job failed.")
+        document_status.write_status(object_key, document_status.FAILED, job_id=job_id,
+                                     error=f"Text extraction {message['Status'].lower()}")
+
+
+def read_job_description(object_key):
+    try:
+        job_description_object = s3_client.get_object(
+            Bucket=JOB_DESCRIPTION_BUCKET,
+            Key=object_key.replace(".pdf", ".txt")
+        )
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'NoSuchKey':
+            return None
+        raise
+    return job_description_object['Body'].read().decode('utf-8')
+
+
+def reuse_previous_work(bucket_name, object_key, upload_id, pdf_hash):
+    """
+    Short-circuit uploads whose content was seen before. Returns True when
+    the upload needs no Textract job: either the same resume + job
+    description pair was already analyzed, or the resume's text is cached
+    and only the analysis has to run.
+    """
+    job_description = read_job_description(object_key)
+    if job_description is not None:
+        jd_hash = result_index.job_description_hash(job_description)
+        response_key = result_index.publish_cached_result(pdf_hash, jd_hash, object_key)
+        if response_key:
+            document_status.write_status(object_key, document_status.DONE, result_key=response_key, cached=True)
+            return True
+
+    text_location = result_index.find_text(pdf_hash)
+    if text_location is None:
+        return False
+    print(f"Reusing extracted text {text_location['key']} for {object_key}")
+    token = upload_token(bucket_name, object_key, upload_id)
+    dispatch_analysis(
+        {"text_location": text_location, "file_name": object_key, "content_hash": pdf_hash},
+        idempotency_key=token
+    )
+    document_status.write_status(object_key, document_status.QUEUED, cached_text=True)
+    return True
+
+
+def process_upload(bucket_name, object_key, upload_id=None):
+    # Identify the resume by content, not name, to find earlier work on it
+    pdf_hash = result_index.object_hash(bucket_name, object_key)
+    if reuse_previous_work(bucket_name, object_key, upload_id, pdf_hash):
+        return
+
+    job_id = start_text_detection(bucket_name, object_key, upload_id, pdf_hash)
+    print(f"Textract Job started with ID: {job_id}")
+    document_status.write_status(object_key, document_status.EXTRACTING, job_id=job_id)
+
+    if TEXTRACT_SNS_TOPIC_ARN and TEXTRACT_ROLE_ARN:
+        # The completion notification triggers the handoff
+        return
+
+    # No notification channel configured: poll with backoff instead
+    status = wait_for_job(job_id)
+    if status == 'SUCCEEDED':
+        print("Textract Job succeeded.")
+        hand_off_to_bedrock(job_id, object_key, pdf_hash)
+    elif status == 'IN_PROGRESS':
+        print(f"Textract Job {job_id} still running after {POLL_TIMEOUT}s. Giving up.")
+        document_status.write_status(object_key, document_status.FAILED, job_id=job_id,
+                                     error="Text extraction timed out")
+    else:
+        print("Textract Job failed.")
+        document_status.write_status(object_key, document_status.FAILED, job_id=job_id,
+                                     error="Text extraction failed")
+
 
 def lambda_handler(event, context):
-    # Get the bucket name and file name from the event
+    # S3 upload events start OCR jobs; SNS events report finished jobs
     for record in event['Records']:
+        if 'Sns' in record:
+            handle_completion(json.loads(record['Sns']['Message']))
+            continue
+
         bucket_name = record['s3']['bucket']['name']
         object_key = record['s3']['object']['key']
-        
+
         print(f"File uploaded: {object_key} in bucket: {bucket_name}")
-        
+
         # Ensure the file is a PDF
         if object_key.lower().endswith('.pdf'):
-            # Call Textract to process the PDF file
-            response = textract_client.start_document_text_detection(
-                DocumentLocation={
-                    'S3Object': {
-                        'Bucket': bucket_name,
-                        'Name': object_key
-                    }
-                }
-            )
-            job_id = response['JobId']
-            print(f"Textract Job started with ID: {job_id}")
-            
-            # Poll the job status until completion
-            while True:
-                status = textract_client.get_document_text_detection(JobId=job_id)
-                if status['JobStatus'] in ['SUCCEEDED', 'FAILED']:
-                    break
-            
-            if status['JobStatus'] == 'SUCCEEDED':
-                print("Textract Job succeeded.")
-                
-                # Collect the extracted text
-                extracted_text = []
-                for block in status['Blocks']:
-                    if block['BlockType'] == 'LINE':
-                        extracted_text.append(block['Text'])
-                
-                # Combine all lines into a single string
-                text_data = "\n".join(extracted_text)
-                print("Extracted Text:", text_data)
-                
-                # Invoke the second Lambda function
-                try:
-                    print("Invoking the second Lambda function...")
-                    lambda_response = lambda_client.invoke(
-                        FunctionName=BEDROCK_LAMBDA,
-                        InvocationType='RequestResponse',
-                        Payload=json.dumps({"text": text_data, "file_name": object_key})  # Passing the extracted text
-                    )
-                    
-                    # Parse the response from the second Lambda function
-                    response_payload = json.loads(lambda_response['Payload'].read())
-                    print("Response from second Lambda:", response_payload)
-                except Exception as e:
-                    print(f"Failed to invoke the second Lambda function: {str(e)}")
-            else:
-                print("Textract Job failed.")
+            # The sequencer is unique per upload and repeated on redelivery
+            s3_object = record['s3']['object']
+            process_upload(bucket_name, object_key, s3_object.get('sequencer') or s3_object.get('eTag'))
         else:
             print("Uploaded file is not a PDF. Skipping.")
 
     return {
         'statusCode': 200,
-        'body': json.dumps('PDF processed successfully and second Lambda invoked.')
+        'body': json.dumps('PDF processed successfully and analysis queued.')
     }
@@ -0,0 +1,86 @@
+"""
+Parity check and microbenchmark: sklearn RandomForestClassifier vs PackedForest.
+
+Also reports the batch size from which sklearn is faster; RoutedModel sends
+inputs of fused_model.DEFAULT_SKLEARN_MIN_ROWS rows or more (override with
+BATCH_SKLEARN_MIN_ROWS) to sklearn, so set it near the measured crossover.
+
+Run from the repository root (where rf_model.joblib lives):
+    python benchmarks/bench_packed_forest.py [rf_model.joblib]
+"""
+import os
+import sys
+import time
+
+import joblib
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fused_model import DEFAULT_SKLEARN_MIN_ROWS  # noqa: E402
+from packed_forest import PackedForest  # noqa: E402
+
+
+def make_rows(packed, n_rows, rng):
+    """
+    Random scaled rows, with some features placed exactly on split thresholds
+    (and one float32 step above) and some missing values.
+    """
+    X = rng.standard_normal((n_rows, packed.n_features_in_))
+    splits = np.flatnonzero(~packed.is_leaf)
+    for i in range(n_rows):
+        node = rng.choice(splits)
+        value = np.float32(packed.threshold[node])
+        if i % 2:
+            value = np.nextafter(value, np.float32(np.inf))
+        X[i, packed.feature[node]] = value
+    X[::11, rng.integers(packed.n_features_in_)] = np.nan
+    return X
+
+
+def check_parity(rf_model, packed, X):
+    expected = rf_model.predict_proba(X)
+    actual = packed.predict_proba(X)
+    if not np.array_equal(expected, actual):
+        mismatches = int((expected != actual).any(axis=1).sum())
+        raise SystemExit(f"Parity check FAILED: {mismatches} of {len(X)} rows differ")
+    if not np.array_equal(rf_model.predict(X), packed.predict(X)):
+        raise SystemExit("Parity check FAILED: predicted classes differ")
+    print(f"Parity check passed on {len(X)} rows (bit-identical probabilities)")
+
+
+def timeit(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    timings = np.array(timings) * 1000
+    return np.median(timings), np.percentile(timings, 99)
+
+
+def main(argv):
+    model_path = argv[0] if argv else 'rf_model.joblib'
+    rf_model = joblib.load(model_path)
+    packed = PackedForest.from_sklearn(rf_model)
+    print(f"{packed.n_trees} trees, {packed.node_count} nodes, max depth {packed.max_depth}")
+
+    rng = np.random.default_rng(0)
+    check_parity(rf_model, packed, make_rows(packed, 5000, rng))
+
+    print(f"\n{'rows':>6} {'sklearn p50/p99 ms':>22} {'packed p50/p99 ms':>22} {'speedup':>8}")
+    crossover = None
+    for n_rows, repeat in [(1, 300), (10, 200), (100, 100), (200, 50), (300, 40), (500, 30), (1000, 20), (10000, 5)]:
+        X = rng.standard_normal((n_rows, packed.n_features_in_))
+        sk_p50, sk_p99 = timeit(lambda: rf_model.predict_proba(X), repeat)
+        pk_p50, pk_p99 = timeit(lambda: packed.predict_proba(X), repeat)
+        print(f"{n_rows:>6} {sk_p50:>11.3f} / {sk_p99:<8.3f} {pk_p50:>11.3f} / {pk_p99:<8.3f} {sk_p50 / pk_p50:>7.1f}x")
+        if crossover is None and sk_p50 < pk_p50:
+            crossover = n_rows
+
+    print(f"\nsklearn is faster from {crossover} rows" if crossover else "\nPackedForest is faster at every size measured")
+    print(f"Batches are routed to sklearn from {DEFAULT_SKLEARN_MIN_ROWS} rows (BATCH_SKLEARN_MIN_ROWS)")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,147 @@
+"""
+Startup time and per-worker memory of the web app under gunicorn, for each
+startup configuration (see startup.py and gunicorn.conf.py).
+
+For every configuration the app is started with --workers workers, and the
+script records the time until /ready answers 200, the time until the first
+/predict succeeds, and each worker's RSS and PSS from /proc (Linux only). PSS
+divides shared pages between the processes sharing them, so it shows what
+preload_app's copy-on-write sharing saves, which RSS does not.
+
+Run from the directory holding the model files, with the app's environment
+(GOOGLE_APPLICATION_CREDENTIALS_JSON etc.) set:
+    python benchmarks/bench_startup.py --workers 4
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (label, GUNICORN_PRELOAD, STARTUP_MODE)
+CONFIGURATIONS = [
+    ('per-worker eager', '0', 'eager'),
+    ('per-worker background', '0', 'background'),
+    ('per-worker lazy', '0', 'lazy'),
+    ('preload eager', '1', 'eager'),
+]
+
+SAMPLE_EMPLOYEE = {
+    'satisfaction_level': 0.38, 'last_evaluation': 0.53, 'number_project': 2,
+    'average_montly_hours': 157, 'time_spend_company': 3, 'Work_accident': 0,
+    'promotion_last_5years': 0, 'department': 'sales', 'salary': 'low',
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def request(url, payload=None, timeout=30):
+    data = json.dumps(payload).encode() if payload is not None else None
+    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return None
+
+
+def wait_for(url, deadline, payload=None):
+    while time.monotonic() < deadline:
+        if request(url, payload) == 200:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def worker_pids(master_pid):
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name is in parentheses and may contain spaces
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == master_pid:
+            pids.append(int(entry))
+    return pids
+
+
+def memory_kb(pid):
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0] in ('Rss:', 'Pss:'):
+                fields[parts[0][:-1]] = int(parts[1])
+    return fields.get('Rss', 0), fields.get('Pss', 0)
+
+
+def measure(label, preload, mode, args):
+    port = free_port()
+    env = dict(os.environ, GUNICORN_PRELOAD=preload, STARTUP_MODE=mode, PYTHONPATH=REPO_ROOT)
+    base = f'http://127.0.0.1:{port}'
+    start = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(REPO_ROOT, 'gunicorn.conf.py'),
+         '--workers', str(args.workers), '--bind', f'127.0.0.1:{port}', 'app:app'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL if not args.verbose else None,
+    )
+    try:
+        deadline = start + args.timeout
+        ready = wait_for(f'{base}/ready', deadline)
+        ready_seconds = time.monotonic() - start
+        predicted = ready and wait_for(f'{base}/predict', deadline, SAMPLE_EMPLOYEE)
+        predict_seconds = time.monotonic() - start
+        if not predicted:
+            return f"{label:<24} did not become ready within {args.timeout}s"
+
+        # Let every worker answer a prediction so each has touched the forest
+        for _ in range(args.workers * 4):
+            request(f'{base}/predict', SAMPLE_EMPLOYEE)
+        time.sleep(0.5)
+        workers = [memory_kb(pid) for pid in worker_pids(process.pid)]
+        master = memory_kb(process.pid)
+        rss = sum(r for r, _ in workers) / len(workers) / 1024
+        pss = sum(p for _, p in workers) / len(workers) / 1024
+        total_pss = (sum(p for _, p in workers) + master[1]) / 1024
+        return (f"{label:<24} {ready_seconds:>8.2f} {predict_seconds:>10.2f} "
+                f"{rss:>13.1f} {pss:>13.1f} {total_pss:>11.1f}")
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for each configuration')
+    parser.add_argument('--verbose', action='store_true', help="show gunicorn's log")
+    args = parser.parse_args(argv)
+
+    print(f"{args.workers} workers, times in seconds from launch, memory in MiB")
+    print(f"{'configuration':<24} {'/ready':>8} {'/predict':>10} {'worker RSS':>13} {'worker PSS':>13} {'total PSS':>11}")
+    for label, preload, mode in CONFIGURATIONS:
+        print(measure(label, preload, mode, args))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
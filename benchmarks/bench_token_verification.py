@@ -0,0 +1,120 @@
+"""
+ID-token verification latency: firebase_admin-style (parse the certificates
+and check the RSA signature every time) vs. IdTokenVerifier's cache.
+
+Runs offline: tokens are signed with a throwaway key whose certificate is
+served by a fake fetch, so no Google endpoint or Firebase project is needed.
+    python benchmarks/bench_token_verification.py --tokens 50 --repeats 20
+"""
+import argparse
+import datetime
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography import x509  # noqa: E402
+from cryptography.hazmat.primitives import hashes, serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import rsa  # noqa: E402
+from cryptography.x509.oid import NameOID  # noqa: E402
+from firebase_admin import auth  # noqa: E402
+from google.auth import crypt, jwt  # noqa: E402
+
+from token_verification import ID_TOKEN_ISSUER_PREFIX, CertificateCache, IdTokenVerifier  # noqa: E402
+
+PROJECT_ID = 'bench-project'
+KEY_ID = 'bench-key'
+
+
+def signing_key():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'bench')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name).issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    key_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    signer = crypt.RSASigner.from_string(key_pem, key_id=KEY_ID)
+    return signer, cert.public_bytes(serialization.Encoding.PEM).decode()
+
+
+def make_token(signer, uid, lifetime=3600, **overrides):
+    now = int(time.time())
+    claims = {
+        'aud': PROJECT_ID,
+        'iss': ID_TOKEN_ISSUER_PREFIX + PROJECT_ID,
+        'sub': uid,
+        'iat': now - 10,
+        'exp': now + lifetime,
+        'auth_time': now - 10,
+        'email': f'{uid}@example.com',
+    }
+    claims.update(overrides)
+    return jwt.encode(signer, claims).decode()
+
+
+def check_rejections(verifier, signer):
+    cases = [
+        ('expired', make_token(signer, 'late', iat=int(time.time()) - 7200, exp=int(time.time()) - 3600), auth.ExpiredIdTokenError),
+        ('wrong audience', make_token(signer, 'other', aud='someone-else'), auth.InvalidIdTokenError),
+        ('wrong issuer', make_token(signer, 'other', iss='https://example.com'), auth.InvalidIdTokenError),
+        ('garbage', 'not.a.token', auth.InvalidIdTokenError),
+    ]
+    for label, token, expected in cases:
+        try:
+            verifier.verify(token)
+        except expected:
+            print(f"  rejected {label:<15} ok ({expected.__name__})")
+        else:
+            raise SystemExit(f"{label} token was accepted")
+
+
+def time_verifications(verify, tokens, repeats):
+    timings = []
+    for _ in range(repeats):
+        for token in tokens:
+            start = time.perf_counter()
+            verify(token)
+            timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tokens', type=int, default=50, help='distinct users/tokens')
+    parser.add_argument('--repeats', type=int, default=20, help='times each token is verified')
+    args = parser.parse_args(argv)
+
+    signer, cert_pem = signing_key()
+    tokens = [make_token(signer, f'user{i}') for i in range(args.tokens)]
+    certificates = CertificateCache(fetch=lambda: ({KEY_ID: cert_pem}, 3600))
+    verifier = IdTokenVerifier(PROJECT_ID, certificates=certificates)
+
+    print("Rejections:")
+    check_rejections(verifier, signer)
+
+    # Baseline: what verify_id_token does per call once its HTTP cache is warm
+    def uncached(token):
+        claims = jwt.decode(token, certs={KEY_ID: cert_pem}, audience=PROJECT_ID)
+        assert claims['iss'] == ID_TOKEN_ISSUER_PREFIX + PROJECT_ID
+
+    baseline = time_verifications(uncached, tokens, args.repeats)
+    cached = time_verifications(verifier.verify, tokens, args.repeats)
+
+    print(f"{'':<28} {'p50 ms':>9} {'p99 ms':>9}")
+    print(f"{'signature check every call':<28} {baseline[0]:>9.3f} {baseline[1]:>9.3f}")
+    print(f"{'IdTokenVerifier':<28} {cached[0]:>9.3f} {cached[1]:>9.3f}")
+    print(f"Verifier stats: {verifier.stats()}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
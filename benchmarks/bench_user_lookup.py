@@ -0,0 +1,98 @@
+"""
+Login lookup latency vs. number of users, with and without the email index.
+
+Against a real server the unindexed lookup is a collection scan whose cost
+grows with the user count, while the indexed one stays flat:
+    python benchmarks/bench_user_lookup.py --mongo-uri mongodb://localhost:27017
+
+Without --mongo-uri the benchmark runs on mongomock. mongomock never uses
+indexes, so both columns show scan behaviour there; it is useful for
+checking the harness and the effect of the projection, not the index.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from user_store import EMAIL_INDEX_NAME, UserStore, mongo_client_options  # noqa: E402
+
+# A realistic stored werkzeug hash, so documents have their production size
+PASSWORD_HASH = 'scrypt:32768:8:1$' + 'a' * 16 + '$' + 'b' * 128
+
+
+def connect(mongo_uri):
+    if mongo_uri:
+        from pymongo import MongoClient
+        return MongoClient(mongo_uri, **mongo_client_options())
+    import mongomock
+    return mongomock.MongoClient()
+
+
+def populate(collection, n_users, batch=5000):
+    collection.drop()
+    for start in range(0, n_users, batch):
+        collection.insert_many([
+            {'name': f'User {i}', 'email': f'user{i}@example.com', 'password': PASSWORD_HASH}
+            for i in range(start, min(start + batch, n_users))
+        ])
+
+
+def time_lookups(lookup, n_users, n_lookups):
+    timings = []
+    step = max(1, n_users // n_lookups)
+    for i in range(0, n_users, step)[:n_lookups]:
+        email = f'user{i}@example.com'
+        start = time.perf_counter()
+        lookup(email)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+
+
+def plan_stage(collection):
+    # Winning plan of the login query: IXSCAN with the index, COLLSCAN without
+    try:
+        plan = collection.find({'email': 'user0@example.com'}, {'_id': 0, 'password': 1}).explain()
+        stage = plan['queryPlanner']['winningPlan']
+        while 'inputStage' in stage:
+            stage = stage['inputStage']
+        return stage.get('stage', '?')
+    except Exception:
+        return 'n/a'
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mongo-uri', help='benchmark against this server instead of mongomock')
+    parser.add_argument('--database', default='bench_user_lookup')
+    parser.add_argument('--sizes', default='1000,10000,50000', help='comma-separated user counts')
+    parser.add_argument('--lookups', type=int, default=200, help='logins timed per configuration')
+    args = parser.parse_args(argv)
+
+    client = connect(args.mongo_uri)
+    collection = client[args.database]['users']
+    store = UserStore(collection)
+    print(f"Backend: {'mongod at ' + args.mongo_uri if args.mongo_uri else 'mongomock (no index support)'}")
+    print(f"{'users':>8} {'legacy find_one p50/p99 ms':>28} {'indexed+projection p50/p99 ms':>31} {'plan':>8}")
+
+    try:
+        for n_users in (int(size) for size in args.sizes.split(',')):
+            populate(collection, n_users)
+
+            # Before: no index, whole document fetched (the old login query)
+            legacy = time_lookups(lambda email: collection.find_one({'email': email}), n_users, args.lookups)
+
+            # After: startup index plus projection
+            store.ensure_indexes()
+            indexed = time_lookups(store.password_hash, n_users, args.lookups)
+            print(f"{n_users:>8} {legacy[0]:>14.3f} / {legacy[1]:<11.3f} {indexed[0]:>16.3f} / {indexed[1]:<12.3f} {plan_stage(collection):>8}")
+            collection.drop_index(EMAIL_INDEX_NAME)
+    finally:
+        collection.drop()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
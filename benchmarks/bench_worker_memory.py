@@ -0,0 +1,108 @@
+"""
+Per-worker memory of the model: joblib (unpickled per process) vs. the
+memory-mapped format, optionally with reduced precision.
+
+Starts --workers fresh interpreters per format, the way gunicorn workers
+without preload_app each load the model, lets each run predictions, and reads
+their memory from /proc (Linux only). RSS counts mapped file pages in every
+process; PSS splits shared pages between the processes using them and USS
+(private pages) is what each extra worker really costs.
+
+Run from the directory holding fused_model.joblib:
+    python benchmarks/bench_worker_memory.py --workers 4
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# (label, threshold dtype, value dtype); None means the joblib artifact itself
+FORMATS = [
+    ('joblib', None, None),
+    ('mapped float64', 'float64', 'float64'),
+    ('mapped float32', 'float32', 'float32'),
+    ('mapped float32/16', 'float32', 'float16'),
+]
+
+
+def memory_kb(pid='self'):
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(':'):
+                fields[parts[0][:-1]] = int(parts[1]) if parts[1].isdigit() else 0
+    return {
+        'rss': fields.get('Rss', 0),
+        'pss': fields.get('Pss', 0),
+        'uss': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0),
+    }
+
+
+def child(path, predictions):
+    import joblib
+    import numpy as np
+    from mapped_forest import MappedForest
+
+    before = memory_kb()
+    model = MappedForest.load(path) if path.endswith('.forest') else joblib.load(path)
+    X = np.random.default_rng(os.getpid()).normal(size=(predictions, model.n_features_in_))
+    for row in X:
+        model.predict_with_proba(row[np.newaxis, :])
+    after = memory_kb()
+    print(json.dumps({'model_rss_kb': after['rss'] - before['rss']}), flush=True)
+    # Stay alive until the parent has measured every worker
+    sys.stdin.read()
+
+
+def measure(path, workers, predictions):
+    processes = [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', path, '--predictions', str(predictions)],
+                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        for _ in range(workers)
+    ]
+    try:
+        deltas = [json.loads(p.stdout.readline())['model_rss_kb'] for p in processes]
+        usage = [memory_kb(p.pid) for p in processes]
+    finally:
+        for p in processes:
+            p.stdin.close()
+            p.wait()
+    mean = {key: sum(u[key] for u in usage) / len(usage) / 1024 for key in ('rss', 'pss', 'uss')}
+    return sum(deltas) / len(deltas) / 1024, mean
+
+
+def main(argv):
+    if argv and argv[0] == '--child':
+        return child(argv[1], int(argv[3]))
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--model', default='fused_model.joblib')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--predictions', type=int, default=200, help='single-row predictions per worker')
+    args = parser.parse_args(argv)
+
+    import joblib
+    from mapped_forest import export
+
+    forest = joblib.load(args.model)
+    print(f"{args.workers} workers per format, MiB per worker")
+    print(f"{'format':<20} {'file MiB':>9} {'model RSS':>10} {'RSS':>8} {'PSS':>8} {'USS':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, threshold_dtype, value_dtype in FORMATS:
+            if threshold_dtype is None:
+                path = os.path.abspath(args.model)
+            else:
+                path = os.path.join(tmp, f'{threshold_dtype}-{value_dtype}.forest')
+                export(forest, path, threshold_dtype=threshold_dtype, value_dtype=value_dtype)
+            model_rss, mean = measure(path, args.workers, args.predictions)
+            print(f"{label:<20} {os.path.getsize(path) / 1024 / 1024:>9.2f} {model_rss:>10.1f} "
+                  f"{mean['rss']:>8.1f} {mean['pss']:>8.1f} {mean['uss']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
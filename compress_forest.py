@@ -0,0 +1,369 @@
+"""
+Forest compression: smaller models for cheaper inference, with the
+accuracy/latency/size trade-off measured on the holdout split.
+
+train_model grows 100 unbounded trees, far more than 9 features and ~15k rows
+need, and their node count drives /predict latency and per-worker memory.
+Every variant here is built from the serving model (fused_model, raw feature
+rows in) and is itself a drop-in serving model:
+
+    full                          the model as it is
+    trees=25                      the 25 trees whose average best reproduces the
+                                  full forest's probabilities on the training
+                                  rows, picked greedily
+    depth=8                       every tree cut at depth 8; the cut nodes become
+                                  leaves holding their own class fractions
+    depth=12,merge=0.05           then splits whose two leaves differ by at most
+                                  0.05 in every class probability collapse into
+                                  one leaf, repeatedly (merge=0 is lossless)
+    depth=8,merge=class           same, for leaves predicting the same class
+    trees=25,depth=10,merge=class the three applied in that order
+    tree:depth=6                  one shallow tree distilled from the forest
+    gbm:n=100,depth=3             small gradient-boosted model distilled from
+                                  the forest
+
+Fully grown trees end in pure leaves, so merging only finds work after a
+depth cap (or in forests grown with min_samples_leaf > 1).
+
+Students are fitted on the training split plus synthetic rows (features of
+random training rows recombined), all labelled by the forest, so they learn
+its decision surface rather than the raw labels. Tree selection and
+distillation only see the training split; the holdout split is for the table.
+
+`--save` writes one variant as the serving model (fused_model.joblib and, when
+the format allows, fused_model.forest) and/or publishes it to a registry. The
+next retraining cycle publishes a full forest again.
+
+Usage:
+    python compress_forest.py [--model fused_model.joblib] [--dataset HR_comma_sep.csv] [--variants 'full trees=25 tree:depth=6 ...']
+    python compress_forest.py --save 'trees=25,depth=12,merge=0.02' [--output-dir .] [--registry models/]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import joblib
+import numpy as np
+from sklearn.ensemble import GradientBoostingClassifier
+from sklearn.tree import DecisionTreeClassifier
+
+from fused_model import FUSED_MODEL_PATH, load_model
+from mapped_forest import MAPPED_MODEL_PATH, export
+from packed_forest import BoostedTrees, PackedForest, pack_trees
+from retention_model import DEPARTMENT_PREFIX
+from retraining import CANARY_SIZE, COLUMNS_PATH, DATASET_PATH, RANDOM_STATE, holdout_split, read_dataset
+from train import feature_matrix, serving_cost
+
+DEFAULT_VARIANTS = (
+    'full',
+    'trees=50', 'trees=25', 'trees=10',
+    'depth=12', 'depth=8',
+    'depth=12,merge=0.05', 'depth=8,merge=class',
+    'trees=25,depth=10,merge=class',
+    'tree:depth=6', 'tree:depth=10',
+    'gbm:n=100,depth=3',
+)
+# Synthetic rows added to the training split for distillation, per training row
+DEFAULT_AUGMENT = 3
+# Chance that a feature (or the department block) of a synthetic row comes from another row
+SWAP_PROBABILITY = 0.5
+
+
+def _rebuild(forest, keep, children_left, children_right, value, roots):
+    """
+    PackedForest of the nodes in `keep`, renumbered in their original order so
+    every tree stays contiguous. `keep` must contain every node reachable from
+    `roots`; children of kept nodes are translated, leaves point to themselves.
+    """
+    new_id = np.cumsum(keep) - 1
+    nodes = np.flatnonzero(keep)
+    left = new_id[children_left[nodes]]
+    right = new_id[children_right[nodes]]
+    leaf = left == np.arange(len(nodes))
+    feature = np.where(leaf, 0, forest.feature[nodes])
+    threshold = np.where(leaf, 0.0, forest.threshold[nodes])
+    roots = new_id[roots]
+    return PackedForest(
+        feature, threshold, left, right, forest.missing_go_to_left[nodes], value[nodes], roots,
+        max_depth=_depths(left, right, roots).max(), classes=forest.classes_,
+        n_features_in=forest.n_features_in_, X_columns=forest.X_columns, input_dtype=forest.input_dtype.name,
+    )
+
+
+def _depths(children_left, children_right, roots):
+    """
+    Depth of every node below `roots`, -1 for nodes no root reaches.
+    """
+    depth = np.full(len(children_left), -1, dtype=np.intp)
+    frontier = np.asarray(roots, dtype=np.intp)
+    level = 0
+    while frontier.size:
+        depth[frontier] = level
+        frontier = frontier[children_left[frontier] != frontier]
+        frontier = np.concatenate([children_left[frontier], children_right[frontier]])
+        level += 1
+    return depth
+
+
+def _children(forest):
+    return np.array(forest.children_left, dtype=np.intp), np.array(forest.children_right, dtype=np.intp)
+
+
+def tree_order(forest, X):
+    """
+    Tree indices in greedy order: each step adds the tree that brings the
+    average of the trees picked so far closest (squared error) to the full
+    forest's probabilities on X.
+    """
+    per_tree = np.asarray(forest.value, dtype=np.float64)[forest.apply(X).T]
+    target = per_tree.mean(axis=0)
+    total = np.zeros_like(target)
+    remaining = np.arange(forest.n_trees)
+    order = []
+    for k in range(1, forest.n_trees + 1):
+        errors = np.square((total + per_tree[remaining]) / k - target).sum(axis=(1, 2))
+        best = int(np.argmin(errors))
+        order.append(int(remaining[best]))
+        total += per_tree[remaining[best]]
+        remaining = np.delete(remaining, best)
+    return order
+
+
+def select_trees(forest, trees):
+    """
+    Forest of the given tree indices (kept in their original order).
+    """
+    trees = np.sort(np.asarray(trees, dtype=np.intp))
+    bounds = np.append(np.asarray(forest.roots, dtype=np.intp), forest.node_count)
+    keep = np.zeros(forest.node_count, dtype=bool)
+    for t in trees:
+        keep[bounds[t]:bounds[t + 1]] = True
+    left, right = _children(forest)
+    return _rebuild(forest, keep, left, right, forest.value, forest.roots[trees])
+
+
+def cap_depth(forest, max_depth):
+    """
+    Cut every tree at max_depth. Split nodes at that depth become leaves; in
+    sklearn trees they already hold the class fractions of their samples.
+    """
+    left, right = _children(forest)
+    depth = _depths(left, right, forest.roots)
+    cut = np.flatnonzero(depth == max_depth)
+    left[cut] = right[cut] = cut
+    return _rebuild(forest, _depths(left, right, forest.roots) >= 0, left, right, forest.value, forest.roots)
+
+
+def merge_leaves(forest, tolerance=0.0, same_class=False):
+    """
+    Collapse splits whose two children are leaves predicting class
+    probabilities within `tolerance` of each other (or, with same_class, the
+    same class), until none is left. The new leaf keeps the split node's own
+    class fractions, or the children's when they are identical, so tolerance 0
+    never changes a prediction.
+    """
+    left, right = _children(forest)
+    value = np.array(forest.value, dtype=np.float64)
+    node_ids = np.arange(forest.node_count)
+    while True:
+        leaf = left == node_ids
+        candidates = np.flatnonzero(~leaf & leaf[left] & leaf[right])
+        left_value, right_value = value[left[candidates]], value[right[candidates]]
+        difference = np.abs(left_value - right_value).max(axis=1)
+        mergeable = difference <= tolerance
+        if same_class:
+            mergeable |= np.argmax(left_value, axis=1) == np.argmax(right_value, axis=1)
+        merged = candidates[mergeable]
+        if not merged.size:
+            break
+        identical = (difference[mergeable] == 0)[:, np.newaxis]
+        value[merged] = np.where(identical, value[left[merged]], value[merged])
+        left[merged] = right[merged] = merged
+    return _rebuild(forest, _depths(left, right, forest.roots) >= 0, left, right, value, forest.roots)
+
+
+def augment(X, X_columns, n_rows, rng):
+    """
+    Synthetic rows: copies of random rows of X where each feature, and the
+    one-hot department block as a whole, is taken from another random row
+    with probability SWAP_PROBABILITY.
+    """
+    department = [i for i, c in enumerate(X_columns) if c.startswith(DEPARTMENT_PREFIX)]
+    groups = [[i] for i in range(len(X_columns)) if i not in department] + ([department] if department else [])
+    rows = X[rng.integers(len(X), size=n_rows)]
+    for group in groups:
+        swap = rng.random(n_rows) < SWAP_PROBABILITY
+        donors = X[rng.integers(len(X), size=int(swap.sum()))]
+        rows[np.ix_(swap, group)] = donors[:, group]
+    return rows
+
+
+def distillation_set(teacher, X, X_columns, augment_factor=DEFAULT_AUGMENT, random_state=RANDOM_STATE):
+    """
+    (rows, teacher labels) for fitting a student.
+    """
+    rng = np.random.default_rng(random_state)
+    rows = np.vstack([X, augment(X, X_columns, augment_factor * len(X), rng)])
+    return rows, teacher.predict(rows)
+
+
+def distill_tree(X, labels, max_depth, X_columns=None):
+    tree = DecisionTreeClassifier(max_depth=max_depth, random_state=RANDOM_STATE).fit(X, labels)
+    return PackedForest(classes=tree.classes_, n_features_in=tree.n_features_in_, X_columns=X_columns,
+                        **pack_trees([tree]))
+
+
+def distill_boosting(X, labels, n_estimators, max_depth, learning_rate=0.1, X_columns=None):
+    gbm = GradientBoostingClassifier(n_estimators=n_estimators, max_depth=max_depth,
+                                     learning_rate=learning_rate, random_state=RANDOM_STATE).fit(X, labels)
+    return BoostedTrees.from_sklearn(gbm, X_columns)
+
+
+def parse_variant(spec):
+    """
+    (kind, parameters) for a variant name: 'full', 'trees=25,depth=8,merge=0.05',
+    'tree:depth=6' or 'gbm:n=100,depth=3[,lr=0.1]'.
+    """
+    kind, _, body = spec.rpartition(':')
+    kind = kind or 'compress'
+    params = {}
+    if body != 'full':
+        for item in filter(None, body.split(',')):
+            key, _, value = item.partition('=')
+            if key == 'merge' and value == 'class':
+                params[key] = value
+            else:
+                params[key] = float(value) if key in ('merge', 'lr') else int(value)
+    allowed = {'compress': {'trees', 'depth', 'merge'}, 'tree': {'depth'}, 'gbm': {'n', 'depth', 'lr'}}
+    if kind not in allowed or not set(params) <= allowed[kind] or (kind != 'compress' and 'depth' not in params):
+        raise ValueError(f"Invalid variant {spec!r}")
+    return kind, params
+
+
+class Compressor:
+    """
+    Builds variants of one teacher forest, reusing the greedy tree order and
+    the distillation set across variants.
+    """
+
+    def __init__(self, teacher, X_train, X_columns):
+        self.teacher = teacher
+        self.X_train = X_train
+        self.X_columns = X_columns
+        self._order = None
+        self._distillation = None
+
+    def build(self, spec):
+        kind, params = parse_variant(spec)
+        if kind == 'compress':
+            model = self.teacher
+            if 'trees' in params:
+                if self._order is None:
+                    self._order = tree_order(self.teacher, self.X_train)
+                model = select_trees(model, self._order[:params['trees']])
+            if 'depth' in params:
+                model = cap_depth(model, params['depth'])
+            if 'merge' in params:
+                if params['merge'] == 'class':
+                    model = merge_leaves(model, same_class=True)
+                else:
+                    model = merge_leaves(model, params['merge'])
+            return model
+
+        if self._distillation is None:
+            self._distillation = distillation_set(self.teacher, self.X_train, self.X_columns)
+        X, labels = self._distillation
+        if kind == 'tree':
+            return distill_tree(X, labels, params['depth'], self.X_columns)
+        return distill_boosting(X, labels, params.get('n', 100), params['depth'], params.get('lr', 0.1), self.X_columns)
+
+
+def evaluate(model, X, y, teacher_predictions):
+    predictions = model.predict(X)
+    latency_ms, size_bytes = serving_cost(model, X)
+    return {
+        'holdout_accuracy': float(np.mean(predictions == y)),
+        'teacher_agreement': float(np.mean(predictions == teacher_predictions)),
+        'trees': model.n_trees,
+        'nodes': model.node_count,
+        'max_depth': model.max_depth,
+        'latency_ms': latency_ms,
+        'size_bytes': size_bytes,
+    }
+
+
+def save(model, model_dir='.'):
+    """
+    Make `model` the serving model in model_dir. The mapped copy is rewritten,
+    or removed when the model cannot be mapped, since load_model prefers it.
+    """
+    path = os.path.join(model_dir, FUSED_MODEL_PATH)
+    joblib.dump(model, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    mapped_path = os.path.join(model_dir, MAPPED_MODEL_PATH)
+    if isinstance(model, BoostedTrees):
+        if os.path.exists(mapped_path):
+            os.unlink(mapped_path)
+    else:
+        export(model, mapped_path)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--model', default=FUSED_MODEL_PATH, help='fused model to compress')
+    parser.add_argument('--dataset', default=DATASET_PATH)
+    parser.add_argument('--variants', default=' '.join(DEFAULT_VARIANTS),
+                        help="space-separated variant names (see the module docstring)")
+    parser.add_argument('--save', metavar='VARIANT', help='write this variant as the serving model')
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--registry', default=None, help='also publish the saved variant to this model registry')
+    parser.add_argument('--report', default='compression_report.json')
+    args = parser.parse_args(argv)
+
+    teacher = load_model(args.model, mapped_path=None)
+    df = read_dataset(args.dataset)
+    X, X_columns = feature_matrix(df)
+    if teacher.X_columns is not None and list(teacher.X_columns) != X_columns:
+        raise SystemExit(f"{args.model} was trained on columns {teacher.X_columns}, the dataset gives {X_columns}")
+    y = df['left'].to_numpy(dtype=np.int64)
+    train, holdout = holdout_split(len(y))
+    teacher_predictions = teacher.predict(X[holdout])
+    compressor = Compressor(teacher, X[train], X_columns)
+
+    variants = [args.save] if args.save else args.variants.split()
+    results = []
+    print(f"{'variant':<30} {'trees':>5} {'nodes':>8} {'depth':>5} {'accuracy':>8} {'agreement':>9} "
+          f"{'latency ms':>10} {'size MB':>8} {'build s':>7}")
+    for spec in variants:
+        start = time.perf_counter()
+        model = compressor.build(spec)
+        build_seconds = time.perf_counter() - start
+        result = dict(variant=spec, build_seconds=round(build_seconds, 3),
+                      **evaluate(model, X[holdout], y[holdout], teacher_predictions))
+        results.append(result)
+        print(f"{spec:<30} {result['trees']:>5} {result['nodes']:>8} {result['max_depth']:>5} "
+              f"{result['holdout_accuracy']:>8.4f} {result['teacher_agreement']:>9.4f} "
+              f"{result['latency_ms']:>10.3f} {result['size_bytes'] / 1024 / 1024:>8.2f} {build_seconds:>7.2f}")
+
+    report = {'model': args.model, 'dataset': args.dataset, 'holdout_rows': int(len(holdout)), 'variants': results}
+    if args.save:
+        save(model, args.output_dir)
+        print(f"Saved {args.save} as the serving model in {os.path.abspath(args.output_dir)}")
+        if args.registry:
+            from model_registry import ModelRegistry, open_store
+            records = df.drop(columns='left').iloc[holdout[:CANARY_SIZE]].astype({'department': str, 'salary': str}).to_dict('records')
+            report['model_version'] = ModelRegistry(open_store(args.registry)).publish(
+                {FUSED_MODEL_PATH: model, COLUMNS_PATH: X_columns},
+                metadata={'compression': args.save, 'holdout_accuracy': results[0]['holdout_accuracy']},
+                canary=[{'record': r, 'left': int(left)} for r, left in zip(records, y[holdout[:CANARY_SIZE]])],
+            )
+            print(f"Published {report['model_version']} to {args.registry}")
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,233 @@
+"""
+Fused inference artifact: a random forest with the StandardScaler folded in.
+
+The service used to run scaler.transform and then walk the forest twice, once
+for rf_model.predict and once for rf_model.predict_proba. A FusedForest is a
+PackedForest that works on raw (unscaled) features and returns the class and
+the probabilities from a single traversal.
+
+Folding works because scaling is monotonic per feature: sklearn sends a row
+left when float32((x - mean) / scale) <= threshold, so for every split there is
+a largest raw float64 value T with the same outcome, and the test becomes
+x <= T. T is found by exact bisection over the float64 values rather than by
+computing threshold * scale + mean, so predictions match the original
+scaler + forest pipeline bit for bit.
+
+Writes fused_model.joblib and its memory-mapped copy fused_model.forest.
+
+Usage:
+    python fused_model.py [rf_model.joblib] [scaler.joblib] [X_columns.joblib] [fused_model.joblib]
+"""
+import os
+import sys
+import threading
+
+import joblib
+import numpy as np
+
+from packed_forest import PackedForest, pack_trees
+from retention_model import FeatureEncoder
+
+FUSED_MODEL_PATH = 'fused_model.joblib'
+# Rows per call from which sklearn's compiled per-tree traversal beats the
+# level-by-level PackedForest (see benchmarks/bench_packed_forest.py)
+DEFAULT_SKLEARN_MIN_ROWS = 300
+# Rows compared before routing large inputs to the sklearn pair
+ROUTING_CHECK_ROWS = 200
+
+_SIGN_BIT = np.int64(-2 ** 63)
+
+
+def _to_ordered(x):
+    # Map float64 onto int64 so that integer order matches float order
+    i = np.asarray(x, dtype=np.float64).view(np.int64)
+    return np.where(i >= 0, i, _SIGN_BIT - i)
+
+
+def _from_ordered(o):
+    i = np.where(o >= 0, o, _SIGN_BIT - o)
+    return i.astype(np.int64).view(np.float64)
+
+
+def fold_thresholds(threshold, mean, scale):
+    """
+    For each split, return the largest raw float64 x for which
+    float32((x - mean) / scale) <= threshold, i.e. the raw-space threshold.
+    """
+    threshold = np.asarray(threshold, dtype=np.float64)
+    mean = np.asarray(mean, dtype=np.float64)
+    scale = np.asarray(scale, dtype=np.float64)
+
+    def goes_left(o):
+        x = _from_ordered(o)
+        return ((x - mean) / scale).astype(np.float32) <= threshold
+
+    # Invariant: goes_left(lo) is True (-inf), goes_left(hi) is False (+inf)
+    lo = np.full(threshold.shape, _to_ordered(-np.inf), dtype=np.int64)
+    hi = np.full(threshold.shape, _to_ordered(np.inf), dtype=np.int64)
+    with np.errstate(over='ignore', invalid='ignore'):
+        while True:
+            open_ = hi > lo + 1
+            if not open_.any():
+                break
+            # Overflow-free midpoint; the full range spans more than int64
+            mid = (lo >> 1) + (hi >> 1) + (lo & hi & 1)
+            left = goes_left(mid)
+            lo = np.where(open_ & left, mid, lo)
+            hi = np.where(open_ & ~left, mid, hi)
+    return _from_ordered(lo)
+
+
+class FusedForest(PackedForest):
+    """
+    Drop-in replacement for the scaler + RandomForestClassifier pair.
+
+    Takes unscaled feature rows laid out like X_columns (FeatureEncoder built
+    without a scaler) and compares them in float64 against the folded thresholds.
+    """
+
+    def __init__(self, rf_model, scaler, X_columns=None):
+        if getattr(rf_model, 'n_outputs_', 1) != 1:
+            raise ValueError("Only single-output forests can be fused")
+
+        n_features = rf_model.n_features_in_
+        mean = np.zeros(n_features, dtype=np.float64)
+        scale = np.ones(n_features, dtype=np.float64)
+        if getattr(scaler, 'with_mean', True):
+            mean = np.asarray(scaler.mean_, dtype=np.float64)
+        if getattr(scaler, 'with_std', True):
+            scale = np.asarray(scaler.scale_, dtype=np.float64)
+
+        def fold(threshold, feature):
+            return fold_thresholds(threshold, mean[feature], scale[feature])
+
+        super().__init__(
+            classes=rf_model.classes_,
+            n_features_in=n_features,
+            X_columns=X_columns,
+            input_dtype='float64',
+            **pack_trees(rf_model.estimators_, fold),
+        )
+
+
+def _scale(scaler, X):
+    # scaler.transform on a copy, without the feature-name check (see retraining.scale)
+    return FeatureEncoder([], scaler).scale(np.array(X, dtype=np.float64))
+
+
+class RoutedModel:
+    """
+    Serving model that picks the evaluator by input size: the fused forest
+    for small inputs (single /predict rows) and rf_model.predict_proba on
+    scaled rows for chunks of sklearn_min_rows or more (/predict/batch).
+
+    `load_sklearn` returns the (rf_model, scaler) pair. It is called on the
+    first large input, so workers that never score batches do not hold a
+    second copy of the forest. If the pair does not reproduce the fused
+    model's output (e.g. a compressed model is being served), large inputs
+    stay on the fused forest.
+    """
+
+    def __init__(self, fused, load_sklearn, sklearn_min_rows=DEFAULT_SKLEARN_MIN_ROWS):
+        self.fused = fused
+        self.load_sklearn = load_sklearn
+        self.sklearn_min_rows = sklearn_min_rows
+        self._sklearn = None
+        self._sklearn_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # classes_, n_features_in_, X_columns, ... come from the fused forest
+        if name == 'fused':
+            raise AttributeError(name)
+        return getattr(self.fused, name)
+
+    def _sklearn_pair(self):
+        with self._sklearn_lock:
+            if self._sklearn is None:
+                self._sklearn = False
+                try:
+                    rf_model, scaler = self.load_sklearn()
+                    rng = np.random.default_rng(0)
+                    X = scaler.mean_ + rng.standard_normal((ROUTING_CHECK_ROWS, len(scaler.mean_))) * scaler.scale_
+                    if np.array_equal(rf_model.predict_proba(_scale(scaler, X)), self.fused.predict_proba(X)):
+                        self._sklearn = (rf_model, scaler)
+                    else:
+                        print("rf_model + scaler do not match the served model; batches stay on it")
+                except Exception as e:
+                    print(f"Could not load rf_model + scaler for batch scoring: {e}")
+            return self._sklearn
+
+    def predict_with_proba(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        if not self.sklearn_min_rows or len(X) < self.sklearn_min_rows or not self._sklearn_pair():
+            return self.fused.predict_with_proba(X)
+        rf_model, scaler = self._sklearn
+        proba = rf_model.predict_proba(_scale(scaler, X))
+        return rf_model.classes_.take(np.argmax(proba, axis=1)), proba
+
+    def predict_proba(self, X):
+        return self.predict_with_proba(X)[1]
+
+    def predict(self, X):
+        return self.predict_with_proba(X)[0]
+
+
+def load_model(fused_path=FUSED_MODEL_PATH, model_path='rf_model.joblib',
+               scaler_path='scaler.joblib', columns_path='X_columns.joblib',
+               mapped_path='fused_model.forest'):
+    """
+    Load the memory-mapped artifact (see mapped_forest.py) or the fused one,
+    or fuse rf_model + scaler on the fly if neither has been built.
+
+    A mapped file exported with --scaler expects scaled rows (its `scaler` is
+    set); feed it rows from its feature_encoder().
+    """
+    if mapped_path and os.path.exists(mapped_path):
+        # Every writer exports the mapped copy after the joblib file, so an
+        # older one was left behind by a rebuild that did not replace it
+        if os.path.exists(fused_path) and os.path.getmtime(mapped_path) < os.path.getmtime(fused_path):
+            print(f"{mapped_path} is older than {fused_path}, ignoring it")
+        else:
+            from mapped_forest import MappedForest
+            return MappedForest.load(mapped_path)
+    if os.path.exists(fused_path):
+        return joblib.load(fused_path)
+    print(f"{fused_path} not found, fusing {model_path} with {scaler_path}")
+    return FusedForest(joblib.load(model_path), joblib.load(scaler_path), joblib.load(columns_path))
+
+
+def main(argv):
+    model_path, scaler_path, columns_path, fused_path = (
+        argv + ['rf_model.joblib', 'scaler.joblib', 'X_columns.joblib', FUSED_MODEL_PATH][len(argv):]
+    )
+    # Run as a script this module is __main__; build the forest from the
+    # importable module so the pickle refers to fused_model.FusedForest
+    from fused_model import FusedForest
+
+    rf_model = joblib.load(model_path)
+    scaler = joblib.load(scaler_path)
+    X_columns = joblib.load(columns_path)
+    fused = FusedForest(rf_model, scaler, X_columns)
+
+    # Check parity against the two-step pipeline on rows drawn around the scaler's statistics
+    rng = np.random.default_rng(0)
+    X_raw = scaler.mean_ + rng.standard_normal((2000, len(scaler.mean_))) * scaler.scale_
+    expected = rf_model.predict_proba(scaler.transform(X_raw))
+    if not np.array_equal(fused.predict_proba(X_raw), expected):
+        raise SystemExit("Fused model does not match rf_model + scaler; not saving")
+
+    joblib.dump(fused, fused_path)
+    # The app loads this file; make sure it unpickles and still matches
+    if not np.array_equal(joblib.load(fused_path).predict_proba(X_raw), expected):
+        raise SystemExit(f"{fused_path} does not load back as the fused model")
+    print(f"Fused model saved as {fused_path}")
+
+    # load_model prefers the memory-mapped copy, so it is rewritten alongside
+    from mapped_forest import MAPPED_MODEL_PATH, export
+    mapped_path = os.path.join(os.path.dirname(fused_path), MAPPED_MODEL_PATH)
+    export(fused, mapped_path)
+    print(f"Memory-mapped copy saved as {mapped_path}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
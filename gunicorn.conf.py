@@ -0,0 +1,35 @@
+# gunicorn reads this file from the working directory (Procfile: gunicorn app:app).
+# Workers, bind address and the rest keep gunicorn's defaults, which already
+# follow Heroku's WEB_CONCURRENCY and PORT.
+import gc
+import os
+
+# Import app.py once in the master and fork the workers from it: the forest
+# and the other startup resources are loaded a single time, and the workers
+# share those pages copy-on-write instead of each holding a private copy.
+# Set GUNICORN_PRELOAD=0 to have every worker import the app itself.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+if preload_app:
+    # Only eager loading finishes in the master; lazy or background loading
+    # would happen again in every worker
+    os.environ.setdefault('STARTUP_MODE', 'eager')
+
+
+def pre_fork(server, worker):
+    # Move everything the master has allocated into the permanent GC
+    # generation, so collections in the workers don't write to (and thereby
+    # copy) the shared pages
+    gc.freeze()
+
+
+def on_starting(server):
+    # In-memory recommendation jobs are only visible to the worker that
+    # created them; polling from another worker gets a 404
+    from recommendations import default_job_store
+    job_store = os.environ.get('RECOMMENDATION_JOB_STORE') or default_job_store(
+        os.environ.get('RECOMMENDATION_CACHE_BACKEND', 'memory'))
+    if server.cfg.workers > 1 and job_store == 'memory':
+        server.log.warning(
+            "%d workers with the in-memory recommendation job store: /recommendations/<id> "
+            "will 404 on other workers. Set RECOMMENDATION_JOB_STORE=mongo.", server.cfg.workers)
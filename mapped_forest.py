@@ -0,0 +1,226 @@
+"""
+Memory-mapped forest artifact, shared by every worker through the page cache.
+
+Unpickling a joblib forest gives each gunicorn worker a private copy of every
+node array. This format stores the arrays of a PackedForest (or FusedForest)
+back to back in one flat binary file, after a small JSON header with their
+dtypes, shapes and offsets, the classes, X_columns and, for forests that
+expect scaled input, the scaler's mean and scale. MappedForest.load maps the
+file read-only and builds the forest from views into the mapping, so the
+node data is read from the page cache and counted once across all workers.
+
+Layout: 8-byte magic, little-endian uint64 header length, UTF-8 JSON header,
+then each array at an offset aligned to 64 bytes.
+
+Thresholds and leaf values can be stored in reduced precision (float32 or,
+for leaf values, float16). Probabilities are still accumulated in float64,
+but predictions may then differ slightly from the original forest; the export
+reports how much. Node indices always use the narrowest lossless integer type.
+
+Usage:
+    python mapped_forest.py [fused_model.joblib] [fused_model.forest] [--threshold-dtype float32] [--value-dtype float16]
+"""
+import argparse
+import json
+import os
+import sys
+from types import SimpleNamespace
+
+import joblib
+import numpy as np
+
+from packed_forest import PackedForest
+from retention_model import FeatureEncoder
+
+MAPPED_MODEL_PATH = 'fused_model.forest'
+FORMAT_MAGIC = b'PKFOREST'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+THRESHOLD_DTYPES = ('float64', 'float32')
+VALUE_DTYPES = ('float64', 'float32', 'float16')
+
+
+def _index_dtype(max_value):
+    for dtype in (np.int16, np.int32):
+        if max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def export(forest, path, scaler=None, threshold_dtype='float64', value_dtype='float64'):
+    """
+    Write a PackedForest (or FusedForest) to `path`. Pass the scaler only for
+    a forest that expects scaled rows; a FusedForest already has it folded in.
+    Returns the file size in bytes.
+    """
+    if threshold_dtype not in THRESHOLD_DTYPES or value_dtype not in VALUE_DTYPES:
+        raise ValueError(f"threshold_dtype must be one of {THRESHOLD_DTYPES}, value_dtype one of {VALUE_DTYPES}")
+    if forest.value.shape[1] != len(forest.classes_):
+        raise ValueError("Only forests whose leaves hold class probabilities can be mapped")
+
+    n_nodes = forest.node_count
+    # apply() indexes _children with 2 * node + 1
+    node_dtype = _index_dtype(2 * n_nodes + 1)
+    arrays = {
+        'feature': forest.feature.astype(_index_dtype(forest.n_features_in_)),
+        'threshold': forest.threshold.astype(threshold_dtype),
+        'children': forest._children.astype(node_dtype),
+        'missing_go_to_left': forest.missing_go_to_left,
+        'is_leaf': forest.is_leaf,
+        'value': forest.value.astype(value_dtype),
+        'roots': forest.roots.astype(node_dtype),
+    }
+
+    header = {
+        'format_version': FORMAT_VERSION,
+        'classes': forest.classes_.tolist(),
+        'n_features_in': forest.n_features_in_,
+        'max_depth': forest.max_depth,
+        'input_dtype': forest.input_dtype.name,
+        'X_columns': forest.X_columns,
+        'scaler': None,
+        'arrays': {},
+    }
+    if scaler is not None:
+        header['scaler'] = {
+            'mean': np.asarray(scaler.mean_, dtype=np.float64).tolist() if getattr(scaler, 'with_mean', True) else None,
+            'scale': np.asarray(scaler.scale_, dtype=np.float64).tolist() if getattr(scaler, 'with_std', True) else None,
+        }
+
+    # Offsets are relative to the start of the data section, so the header
+    # length does not depend on them
+    offset = 0
+    for name, array in arrays.items():
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _align(offset + array.nbytes)
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _align(len(FORMAT_MAGIC) + 8 + len(header_bytes))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(FORMAT_MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + header['arrays'][name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def read_header(path):
+    """
+    (header dict, byte offset of the data section).
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(FORMAT_MAGIC)) != FORMAT_MAGIC:
+            raise ValueError(f"{path} is not a mapped forest file")
+        length = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        header = json.loads(f.read(length))
+    if header['format_version'] != FORMAT_VERSION:
+        raise ValueError(f"{path} has format version {header['format_version']}, expected {FORMAT_VERSION}")
+    return header, _align(len(FORMAT_MAGIC) + 8 + length)
+
+
+class MappedForest(PackedForest):
+    """
+    PackedForest whose node arrays are read-only views into a memory-mapped file.
+    """
+
+    @classmethod
+    def load(cls, path):
+        header, data_start = read_header(path)
+        mapping = np.memmap(path, mode='r')
+        arrays = {}
+        for name, spec in header['arrays'].items():
+            # Plain ndarrays over the mapping; memmap slices would carry the subclass into every result
+            arrays[name] = np.ndarray(spec['shape'], dtype=spec['dtype'], buffer=mapping, offset=data_start + spec['offset'])
+
+        # Set the attributes directly: PackedForest.__init__ would copy the
+        # arrays into private memory converting them to intp/float64
+        forest = cls.__new__(cls)
+        forest.path = path
+        forest.feature = arrays['feature']
+        forest.threshold = arrays['threshold']
+        forest._children = arrays['children']
+        forest.children_left = forest._children[0::2]
+        forest.children_right = forest._children[1::2]
+        forest.missing_go_to_left = arrays['missing_go_to_left']
+        forest.is_leaf = arrays['is_leaf']
+        forest.value = arrays['value']
+        forest.roots = arrays['roots']
+        forest.max_depth = header['max_depth']
+        forest.classes_ = np.asarray(header['classes'])
+        forest.X_columns = header['X_columns']
+        forest.input_dtype = np.dtype(header['input_dtype'])
+        forest.n_features_in_ = header['n_features_in']
+        forest.scaler = None
+        if header['scaler'] is not None:
+            mean, scale = header['scaler']['mean'], header['scaler']['scale']
+            forest.scaler = SimpleNamespace(
+                mean_=mean, scale_=scale, with_mean=mean is not None, with_std=scale is not None,
+            )
+        return forest
+
+    def feature_encoder(self):
+        """
+        FeatureEncoder producing the rows this forest expects (scaled if the
+        file carries scaler parameters).
+        """
+        return FeatureEncoder(self.X_columns, self.scaler)
+
+    def __reduce__(self):
+        # Pickle as a plain PackedForest holding copies of the arrays; the
+        # scaler goes along, or a copy would silently expect unscaled rows
+        return (PackedForest, (
+            np.array(self.feature), np.array(self.threshold), np.array(self.children_left),
+            np.array(self.children_right), np.array(self.missing_go_to_left), np.array(self.value),
+            np.array(self.roots), self.max_depth, self.classes_, self.n_features_in_, self.X_columns,
+            self.input_dtype.name,
+        ), {'scaler': self.scaler})
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('model', nargs='?', default='fused_model.joblib', help='joblib PackedForest/FusedForest')
+    parser.add_argument('output', nargs='?', default=MAPPED_MODEL_PATH)
+    parser.add_argument('--scaler', help="scaler.joblib, only for a forest that expects scaled rows")
+    parser.add_argument('--threshold-dtype', choices=THRESHOLD_DTYPES, default='float64')
+    parser.add_argument('--value-dtype', choices=VALUE_DTYPES, default='float64')
+    parser.add_argument('--check-rows', type=int, default=5000, help='random rows used to compare with the original')
+    args = parser.parse_args(argv)
+
+    forest = joblib.load(args.model)
+    if not isinstance(forest, PackedForest):
+        forest = PackedForest.from_sklearn(forest)
+    scaler = joblib.load(args.scaler) if args.scaler else None
+    size = export(forest, args.output, scaler, args.threshold_dtype, args.value_dtype)
+    in_memory = sum(a.nbytes for a in (forest.feature, forest.threshold, forest.children_left, forest.children_right,
+                                       forest._children, forest.missing_go_to_left, forest.is_leaf, forest.value, forest.roots))
+    print(f"Wrote {args.output}: {size / 1024 / 1024:.2f} MiB (the unpickled forest holds {in_memory / 1024 / 1024:.2f} MiB per process)")
+
+    # Compare on rows drawn around the split thresholds the forest actually uses
+    mapped = MappedForest.load(args.output)
+    rng = np.random.default_rng(0)
+    splits = np.flatnonzero(~forest.is_leaf)
+    X = np.empty((args.check_rows, forest.n_features_in_))
+    for j in range(forest.n_features_in_):
+        thresholds = forest.threshold[splits[forest.feature[splits] == j]]
+        X[:, j] = rng.choice(thresholds, args.check_rows) if len(thresholds) else 0.0
+    X += rng.normal(scale=1e-3, size=X.shape) * np.abs(X)
+    expected_classes, expected = forest.predict_with_proba(X)
+    classes, proba = mapped.predict_with_proba(X)
+    print(f"Parity on {args.check_rows} rows: {np.mean(classes == expected_classes):.4%} same class, "
+          f"max probability difference {np.max(np.abs(proba - expected)):.2e}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
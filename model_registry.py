@@ -0,0 +1,377 @@
+"""
+Versioned model registry with hot reloading.
+
+A registry is a directory, or an S3 (or S3-compatible) prefix, holding one
+folder per model version plus a manifest:
+
+    manifest.json        {"current": "v0003", "versions": [{"version", "created_at",
+                          "files": {name: sha256}, "metadata"}, ...]}
+    canary.json          labelled records every new version is checked against
+    v0003/fused_model.joblib
+    v0003/X_columns.joblib
+    ...
+
+Publishing uploads the bundle first and rewrites the manifest last, so a
+reader only ever sees complete versions. In the app, an ActiveModel polls the
+manifest; when `current` changes it loads the bundle in the background,
+checks the hashes, validates it on the canary sample and swaps it in with a
+single reference assignment. Requests already running keep the model they
+started with.
+
+Usage:
+    python model_registry.py publish <registry> [model_dir]
+    python model_registry.py list <registry>
+    python model_registry.py activate <registry> <version>
+"""
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import joblib
+import numpy as np
+
+from fused_model import DEFAULT_SKLEARN_MIN_ROWS, FUSED_MODEL_PATH, RoutedModel
+from retention_model import FeatureEncoder
+
+MANIFEST_KEY = 'manifest.json'
+CANARY_KEY = 'canary.json'
+COLUMNS_PATH = 'X_columns.joblib'
+# Optional files that let large batches be scored by sklearn (see fused_model.RoutedModel)
+SKLEARN_FILES = ('rf_model.joblib', 'scaler.joblib')
+# Files a bundle must contain to be served
+SERVING_FILES = (FUSED_MODEL_PATH, COLUMNS_PATH)
+
+DEFAULT_POLL_INTERVAL = 60
+# A new version may be this much less accurate on the canary sample than the active one
+DEFAULT_CANARY_TOLERANCE = 0.02
+
+LoadedModel = namedtuple('LoadedModel', ['version', 'model', 'encoder'])
+
+
+class InvalidModel(Exception):
+    """
+    Raised when a bundle is incomplete, corrupted or fails canary validation.
+    """
+
+
+class DirectoryStore:
+    """
+    Registry on a local or shared filesystem. Writes go through a temporary
+    file and a rename.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def read(self, key):
+        try:
+            with open(os.path.join(self.root, key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, key, data):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path) + '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+
+class S3Store:
+    """
+    Registry under an S3 prefix. MODEL_REGISTRY_S3_ENDPOINT points it at an
+    S3-compatible service (MinIO, R2, ...). A single PUT replaces an object
+    atomically, which is all the manifest needs.
+    """
+
+    def __init__(self, bucket, prefix='', client=None):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        if client is None:
+            import boto3
+            client = boto3.client('s3', endpoint_url=os.environ.get('MODEL_REGISTRY_S3_ENDPOINT') or None)
+        self.client = client
+
+    def _key(self, key):
+        return f'{self.prefix}/{key}' if self.prefix else key
+
+    def read(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._key(key))['Body'].read()
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return None
+            raise
+
+    def write(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data)
+
+
+def open_store(location):
+    """
+    DirectoryStore for a path, S3Store for s3://bucket/prefix.
+    """
+    if location.startswith('s3://'):
+        bucket, _, prefix = location[len('s3://'):].partition('/')
+        return S3Store(bucket, prefix)
+    return DirectoryStore(location)
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class ModelRegistry:
+
+    def __init__(self, store, sklearn_min_rows=DEFAULT_SKLEARN_MIN_ROWS):
+        self.store = store
+        self.sklearn_min_rows = sklearn_min_rows
+
+    def manifest(self):
+        data = self.store.read(MANIFEST_KEY)
+        if data is None:
+            return {'current': None, 'versions': []}
+        return json.loads(data)
+
+    def _entry(self, manifest, version):
+        for entry in manifest['versions']:
+            if entry['version'] == version:
+                return entry
+        raise KeyError(f"Unknown model version {version}")
+
+    def publish(self, artifacts, metadata=None, canary=None, activate=True):
+        """
+        Upload a new version from {file name: object} and return its name.
+        `canary`, if given, replaces the shared canary sample.
+        """
+        missing = [name for name in SERVING_FILES if name not in artifacts]
+        if missing:
+            raise InvalidModel(f"Bundle is missing {', '.join(missing)}")
+
+        manifest = self.manifest()
+        version = f"v{len(manifest['versions']) + 1:04d}"
+        files = {}
+        for name, obj in artifacts.items():
+            buffer = io.BytesIO()
+            joblib.dump(obj, buffer)
+            data = buffer.getvalue()
+            self.store.write(f'{version}/{name}', data)
+            files[name] = _sha256(data)
+        if canary is not None:
+            self.store.write(CANARY_KEY, json.dumps(canary).encode('utf-8'))
+
+        manifest['versions'].append({
+            'version': version,
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'files': files,
+            'metadata': metadata or {},
+        })
+        if activate:
+            manifest['current'] = version
+        self.store.write(MANIFEST_KEY, json.dumps(manifest, indent=2).encode('utf-8'))
+        return version
+
+    def activate(self, version):
+        # Rolling back is activating an older version
+        manifest = self.manifest()
+        self._entry(manifest, version)
+        manifest['current'] = version
+        self.store.write(MANIFEST_KEY, json.dumps(manifest, indent=2).encode('utf-8'))
+
+    def load(self, version, manifest=None):
+        """
+        LoadedModel for a version, after checking every file against its hash.
+        """
+        entry = self._entry(manifest or self.manifest(), version)
+        model = self._read(version, entry, FUSED_MODEL_PATH)
+        encoder = FeatureEncoder(self._read(version, entry, COLUMNS_PATH))
+        if self.sklearn_min_rows and all(name in entry['files'] for name in SKLEARN_FILES):
+            # Read on the first large batch only
+            model = RoutedModel(
+                model, lambda: tuple(self._read(version, entry, name) for name in SKLEARN_FILES), self.sklearn_min_rows,
+            )
+        return LoadedModel(version, model, encoder)
+
+    def _read(self, version, entry, name):
+        data = self.store.read(f'{version}/{name}')
+        if data is None:
+            raise InvalidModel(f"{version}/{name} is missing")
+        if _sha256(data) != entry['files'].get(name):
+            raise InvalidModel(f"{version}/{name} does not match its hash in the manifest")
+        return joblib.load(io.BytesIO(data))
+
+    def canary(self):
+        data = self.store.read(CANARY_KEY)
+        return json.loads(data) if data is not None else []
+
+
+def canary_accuracy(loaded, canary):
+    """
+    Score a model on the canary sample, raising InvalidModel if it cannot
+    predict or returns malformed probabilities. Returns the accuracy on the
+    labelled entries (None when there are none).
+    """
+    records = [entry['record'] for entry in canary] or [{}]
+    try:
+        predictions, probabilities = loaded.model.predict_with_proba(loaded.encoder.encode(records))
+    except Exception as e:
+        raise InvalidModel(f"{loaded.version} failed on the canary sample: {e}")
+    probabilities = np.asarray(probabilities)
+    if (probabilities.shape != (len(records), len(loaded.model.classes_))
+            or not np.all(np.isfinite(probabilities))
+            or not np.allclose(probabilities.sum(axis=1), 1.0)):
+        raise InvalidModel(f"{loaded.version} returned malformed probabilities on the canary sample")
+
+    labels = [entry.get('left') for entry in canary]
+    if not canary or None in labels:
+        return None
+    return float(np.mean(np.asarray(predictions) == np.asarray(labels)))
+
+
+class ActiveModel:
+    """
+    The model the app serves, swapped in place when the registry's current
+    version changes.
+
+    Without a registry it holds a fixed model. With one, a poller thread is
+    started on first use in each process (after gunicorn's fork), and
+    versions that fail validation are remembered and not retried.
+    """
+
+    def __init__(self, loaded, registry=None, poll_interval=DEFAULT_POLL_INTERVAL,
+                 canary_tolerance=DEFAULT_CANARY_TOLERANCE):
+        self._loaded = loaded
+        self.registry = registry
+        self.poll_interval = poll_interval
+        self.canary_tolerance = canary_tolerance
+        self.loaded_at = time.time()
+        self.rejected = {}
+        self.last_check = None
+        self.last_error = None
+        self._check_lock = threading.Lock()
+        self._poller_pid = None
+
+    @classmethod
+    def from_registry(cls, registry, **kwargs):
+        """
+        Load the registry's current version (validated, but not compared with anything).
+        """
+        manifest = registry.manifest()
+        if not manifest['current']:
+            raise InvalidModel("The model registry has no current version")
+        loaded = registry.load(manifest['current'], manifest)
+        canary_accuracy(loaded, registry.canary())
+        return cls(loaded, registry, **kwargs)
+
+    def current(self):
+        if self.registry is not None and self._poller_pid != os.getpid():
+            self._poller_pid = os.getpid()
+            threading.Thread(target=self._poll, name='model-registry', daemon=True).start()
+        return self._loaded
+
+    @property
+    def version(self):
+        return self._loaded.version
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.check()
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Model registry check failed: {e}")
+
+    def check(self):
+        """
+        Swap in the registry's current version if it differs from the active
+        one and passes validation. Returns True if the model changed.
+        """
+        with self._check_lock:
+            self.last_check = time.time()
+            manifest = self.registry.manifest()
+            version = manifest['current']
+            if not version or version == self._loaded.version or version in self.rejected:
+                return False
+
+            try:
+                candidate = self.registry.load(version, manifest)
+                canary = self.registry.canary()
+                accuracy = canary_accuracy(candidate, canary)
+                baseline = canary_accuracy(self._loaded, canary)
+                if accuracy is not None and baseline is not None and accuracy < baseline - self.canary_tolerance:
+                    raise InvalidModel(
+                        f"{version} scores {accuracy:.4f} on the canary sample, "
+                        f"{self._loaded.version} scores {baseline:.4f}"
+                    )
+            except InvalidModel as e:
+                self.rejected[version] = str(e)
+                print(f"Not activating model {version}: {e}")
+                return False
+
+            # One reference assignment; requests in flight keep the model they already hold
+            previous = self._loaded.version
+            self._loaded = candidate
+            self.loaded_at = time.time()
+            print(f"Model {version} activated (was {previous})")
+            return True
+
+    def status(self):
+        return {
+            'version': self._loaded.version,
+            'loaded_at': self.loaded_at,
+            'registry': self.registry is not None,
+            'last_check': self.last_check,
+            'last_error': self.last_error,
+            'rejected': self.rejected,
+        }
+
+
+def publish_local(registry, model_dir='.', metadata=None):
+    """
+    Publish the model files in model_dir (fused model, columns and, when
+    present, the forest and scaler it was built from) as a new version.
+    """
+    artifacts = {}
+    for name in (FUSED_MODEL_PATH, COLUMNS_PATH, 'rf_model.joblib', 'scaler.joblib'):
+        path = os.path.join(model_dir, name)
+        if os.path.exists(path):
+            artifacts[name] = joblib.load(path)
+    return registry.publish(artifacts, metadata)
+
+
+def main(argv):
+    if len(argv) < 2 or argv[0] not in ('publish', 'list', 'activate'):
+        raise SystemExit(__doc__)
+    command, registry = argv[0], ModelRegistry(open_store(argv[1]))
+    if command == 'publish':
+        print(f"Published {publish_local(registry, argv[2] if len(argv) > 2 else '.')}")
+    elif command == 'activate':
+        registry.activate(argv[2])
+        print(f"{argv[2]} is now current")
+    else:
+        manifest = registry.manifest()
+        for entry in manifest['versions']:
+            marker = '*' if entry['version'] == manifest['current'] else ' '
+            print(f"{marker} {entry['version']}  {entry['created_at']}  {json.dumps(entry['metadata'])}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
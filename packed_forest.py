@@ -0,0 +1,266 @@
+"""
+Array-backed random forest evaluator.
+
+RandomForestClassifier.predict_proba pays a large fixed cost on every call:
+input validation, joblib dispatch over all estimators and a Python call per
+tree. For the one-row requests /predict sees, that overhead dominates. A
+PackedForest stores every node of every tree in a handful of contiguous NumPy
+arrays (feature, threshold, left, right, leaf value) and walks all trees for a
+batch of rows at once, one tree level per step.
+
+Every (row, tree) pair advances one level per step, and pairs drop out of the
+working set as soon as they reach a leaf. Results match sklearn bit for bit.
+
+Usage:
+    python packed_forest.py [rf_model.joblib] [rf_model_packed.npz]
+"""
+import json
+import sys
+
+import joblib
+import numpy as np
+
+TREE_LEAF = -1
+
+
+def pack_trees(estimators, fold=None):
+    """
+    Concatenate the node arrays of fitted sklearn trees into one flat forest.
+
+    `fold(threshold, feature)`, if given, rewrites the thresholds of the split
+    nodes of each tree (see fused_model.fold_thresholds).
+    """
+    features, thresholds, lefts, rights, missing, values, roots = [], [], [], [], [], [], []
+    max_depth = 0
+    offset = 0
+    for est in estimators:
+        tree = est.tree_
+        left = tree.children_left.astype(np.int64)
+        right = tree.children_right.astype(np.int64)
+        feature = tree.feature.astype(np.int64)
+        threshold = np.array(tree.threshold, dtype=np.float64)
+
+        leaf = left == TREE_LEAF
+        split = ~leaf
+        if fold is not None:
+            threshold[split] = fold(threshold[split], feature[split])
+
+        # Leaves point to themselves; their feature/threshold are never used
+        node_ids = np.arange(tree.node_count, dtype=np.int64)
+        left = np.where(leaf, node_ids, left) + offset
+        right = np.where(leaf, node_ids, right) + offset
+        feature[leaf] = 0
+        threshold[leaf] = 0.0
+
+        features.append(feature)
+        thresholds.append(threshold)
+        lefts.append(left)
+        rights.append(right)
+        missing.append(tree.missing_go_to_left.astype(bool))
+        # Per-node class fractions, exactly what DecisionTreeClassifier.predict_proba returns
+        values.append(np.asarray(tree.value[:, 0, :], dtype=np.float64))
+        roots.append(offset)
+        max_depth = max(max_depth, tree.max_depth)
+        offset += tree.node_count
+
+    return {
+        'feature': np.concatenate(features),
+        'threshold': np.concatenate(thresholds),
+        'children_left': np.concatenate(lefts),
+        'children_right': np.concatenate(rights),
+        'missing_go_to_left': np.concatenate(missing),
+        'value': np.concatenate(values),
+        'roots': np.array(roots, dtype=np.int64),
+        'max_depth': max_depth,
+    }
+
+
+class PackedForest:
+    """
+    Flattened, read-only random forest classifier.
+
+    input_dtype is the precision rows are rounded to before comparing with the
+    thresholds: float32 for a plain sklearn export (sklearn casts X to float32),
+    float64 when the thresholds were folded into raw feature space.
+    """
+
+    def __init__(self, feature, threshold, children_left, children_right,
+                 missing_go_to_left, value, roots, max_depth, classes,
+                 n_features_in, X_columns=None, input_dtype='float32'):
+        self.feature = np.ascontiguousarray(feature, dtype=np.intp)
+        self.threshold = np.ascontiguousarray(threshold, dtype=np.float64)
+        self.children_left = np.ascontiguousarray(children_left, dtype=np.intp)
+        self.children_right = np.ascontiguousarray(children_right, dtype=np.intp)
+        self.missing_go_to_left = np.ascontiguousarray(missing_go_to_left, dtype=bool)
+        self.value = np.ascontiguousarray(value, dtype=np.float64)
+        self.roots = np.ascontiguousarray(roots, dtype=np.intp)
+        self.max_depth = int(max_depth)
+        self.classes_ = np.asarray(classes)
+        self.X_columns = list(X_columns) if X_columns is not None else None
+        self.input_dtype = np.dtype(input_dtype)
+        self.is_leaf = self.children_left == np.arange(len(self.children_left))
+        # Interleaved [left, right] pairs so one gather picks the next node
+        self._children = np.ascontiguousarray(
+            np.stack([self.children_left, self.children_right], axis=1).ravel()
+        )
+        self.n_features_in_ = int(n_features_in)
+
+    @classmethod
+    def from_sklearn(cls, rf_model, X_columns=None):
+        if getattr(rf_model, 'n_outputs_', 1) != 1:
+            raise ValueError("Only single-output forests can be packed")
+        return cls(
+            classes=rf_model.classes_,
+            n_features_in=rf_model.n_features_in_,
+            X_columns=X_columns,
+            **pack_trees(rf_model.estimators_),
+        )
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    @property
+    def node_count(self):
+        return len(self.feature)
+
+    def _check_input(self, X):
+        X = np.asarray(X, dtype=self.input_dtype)
+        if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+            raise ValueError(
+                f"X has shape {X.shape}, expected (n_samples, {self.n_features_in_})"
+            )
+        return X
+
+    def apply(self, X):
+        """
+        Global leaf index reached in every tree, shape (n_samples, n_trees).
+        """
+        X = self._check_input(X)
+        n_samples = X.shape[0]
+        # One (row, tree) pair per entry, row-major; offsets index into X.ravel()
+        node = np.tile(self.roots, n_samples)
+        row_offset = np.repeat(np.arange(n_samples) * X.shape[1], self.n_trees)
+        X_flat = X.ravel()
+
+        # Only pairs still on a split node are advanced; the set shrinks every level
+        active = np.flatnonzero(~self.is_leaf[node])
+        while active.size:
+            current = node[active]
+            x = X_flat[row_offset[active] + self.feature[current]]
+            # float32 rows are promoted to float64 for the comparison, as in sklearn
+            go_right = ~(x <= self.threshold[current])
+            missing = np.isnan(x)
+            if missing.any():
+                go_right[missing] = ~self.missing_go_to_left[current[missing]]
+            current = self._children[2 * current + go_right]
+            node[active] = current
+            active = active[~self.is_leaf[current]]
+        return node.reshape(n_samples, self.n_trees)
+
+    def predict_with_proba(self, X):
+        """
+        Return (predicted classes, class probabilities) from one pass over all trees.
+        """
+        leaves = self.apply(X)
+        # Sum over the outer (tree) axis adds trees one at a time in estimator
+        # order, the same accumulation RandomForestClassifier does (in float64
+        # even when the leaf values are stored in lower precision)
+        proba = np.add.reduce(self.value[leaves.T], axis=0, dtype=np.float64)
+        proba /= self.n_trees
+        return self.classes_.take(np.argmax(proba, axis=1)), proba
+
+    def predict_proba(self, X):
+        return self.predict_with_proba(X)[1]
+
+    def predict(self, X):
+        return self.predict_with_proba(X)[0]
+
+    def save(self, path):
+        meta = {
+            'max_depth': self.max_depth,
+            'n_features_in': self.n_features_in_,
+            'X_columns': self.X_columns,
+            'input_dtype': self.input_dtype.name,
+        }
+        np.savez(
+            path,
+            feature=self.feature,
+            threshold=self.threshold,
+            children_left=self.children_left,
+            children_right=self.children_right,
+            missing_go_to_left=self.missing_go_to_left,
+            value=self.value,
+            roots=self.roots,
+            classes=self.classes_,
+            meta=np.array(json.dumps(meta)),
+        )
+
+    @staticmethod
+    def load(path):
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+            return PackedForest(
+                feature=data['feature'],
+                threshold=data['threshold'],
+                children_left=data['children_left'],
+                children_right=data['children_right'],
+                missing_go_to_left=data['missing_go_to_left'],
+                value=data['value'],
+                roots=data['roots'],
+                max_depth=meta['max_depth'],
+                classes=data['classes'],
+                n_features_in=meta['n_features_in'],
+                X_columns=meta['X_columns'],
+                input_dtype=meta['input_dtype'],
+            )
+
+
+class BoostedTrees(PackedForest):
+    """
+    Binary gradient-boosted trees on the PackedForest evaluator.
+
+    Leaf values are the trees' raw scores with the learning rate folded in;
+    the class-1 probability is the logistic function of their sum plus the
+    initial score. Built by compress_forest.py; mapped_forest.py only holds
+    forests that average class probabilities.
+    """
+
+    def __init__(self, bias, **kwargs):
+        super().__init__(**kwargs)
+        self.bias = float(bias)
+
+    @classmethod
+    def from_sklearn(cls, gbm, X_columns=None):
+        if len(gbm.classes_) != 2:
+            raise ValueError("Only binary gradient boosting models can be packed")
+        packed = pack_trees(gbm.estimators_[:, 0])
+        packed['value'] = packed['value'] * gbm.learning_rate
+        boosted = cls(0.0, classes=gbm.classes_, n_features_in=gbm.n_features_in_, X_columns=X_columns, **packed)
+        # The initial score is whatever decision_function adds on top of the trees
+        probe = np.zeros((1, gbm.n_features_in_))
+        boosted.bias = float(gbm.decision_function(probe)[0] - boosted.decision_function(probe)[0])
+        return boosted
+
+    def decision_function(self, X):
+        leaves = self.apply(X)
+        return np.add.reduce(self.value[leaves.T, 0], axis=0, dtype=np.float64) + self.bias
+
+    def predict_with_proba(self, X):
+        raw = self.decision_function(X)
+        # Logistic function without overflow for large negative scores
+        positive = np.exp(-np.logaddexp(0.0, -raw))
+        proba = np.column_stack([1.0 - positive, positive])
+        return self.classes_.take(np.argmax(proba, axis=1)), proba
+
+
+def main(argv):
+    model_path, packed_path = (argv + ['rf_model.joblib', 'rf_model_packed.npz'][len(argv):])[:2]
+    rf_model = joblib.load(model_path)
+    packed = PackedForest.from_sklearn(rf_model)
+    packed.save(packed_path)
+    print(f"Packed {packed.n_trees} trees ({packed.node_count} nodes, max depth {packed.max_depth}) into {packed_path}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,222 @@
+"""
+Password hashing off the request thread.
+
+Werkzeug's password hashes are deliberately slow (hundreds of milliseconds of
+CPU for pbkdf2 with 600k iterations), and login/signup used to compute them
+inline. A PasswordHasher runs them on a small process pool instead, so a burst
+of logins keeps at most `max_workers` cores busy and never holds the GIL that
+the other endpoints of the same worker need.
+
+The method and salt length are configurable. Stored hashes made with older
+parameters still verify, and are upgraded transparently on the next
+successful login (rehash-on-login).
+"""
+import io
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import context, forkserver, popen_forkserver, spawn, util
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+DEFAULT_METHOD = 'pbkdf2'
+DEFAULT_SALT_LENGTH = 16
+DEFAULT_WORKERS = 2
+
+# Hashes waiting for a free worker, per pool slot, before callers are turned away
+QUEUE_DEPTH_PER_WORKER = 8
+DEFAULT_QUEUE_TIMEOUT = 5.0
+
+
+class HasherBusy(Exception):
+    """
+    Raised when every pool slot stays taken for longer than the queue timeout.
+    """
+
+
+def hash_parameters(password_hash):
+    """
+    (method, salt length) of a stored werkzeug hash, e.g. ('pbkdf2:sha256:600000', 16).
+    """
+    method, _, rest = password_hash.partition('$')
+    salt, _, _ = rest.partition('$')
+    return method, len(salt)
+
+
+def full_method(method):
+    """
+    The method string werkzeug stores in a hash made with `method`, defaults
+    filled in ('pbkdf2' -> 'pbkdf2:sha256:600000'), without hashing anything.
+    """
+    name, *args = method.split(':')
+    if name == 'pbkdf2':
+        hash_name = args[0] if args else 'sha256'
+        iterations = int(args[1]) if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return f"pbkdf2:{hash_name}:{iterations}"
+    if name == 'scrypt':
+        n, r, p = map(int, args) if args else (2 ** 15, 8, 1)
+        return f"scrypt:{n}:{r}:{p}"
+    return method
+
+
+class _WorkerPopen(popen_forkserver.Popen):
+    """
+    Starts a pool worker from the forkserver without the parent's __main__.
+    multiprocessing would otherwise make every worker run the main script
+    again before its first task (all of app.py under `python app.py`, with
+    Firebase, Mongo and model loading); the workers only need werkzeug.
+    """
+
+    def _launch(self, process_obj):
+        # popen_forkserver.Popen._launch, minus the main module in prep_data
+        prep_data = spawn.get_preparation_data(process_obj._name)
+        prep_data.pop('init_main_from_path', None)
+        prep_data.pop('init_main_from_name', None)
+        buf = io.BytesIO()
+        context.set_spawning_popen(self)
+        try:
+            context.reduction.dump(prep_data, buf)
+            context.reduction.dump(process_obj, buf)
+        finally:
+            context.set_spawning_popen(None)
+
+        self.sentinel, w = forkserver.connect_to_new_process(self._fds)
+        _parent_w = os.dup(w)
+        self.finalizer = util.Finalize(self, util.close_fds, (_parent_w, self.sentinel))
+        with open(w, 'wb', closefd=True) as f:
+            f.write(buf.getbuffer())
+        self.pid = forkserver.read_signed(self.sentinel)
+
+
+class _WorkerProcess(context.ForkServerProcess):
+    @staticmethod
+    def _Popen(process_obj):
+        return _WorkerPopen(process_obj)
+
+
+class _WorkerContext(context.ForkServerContext):
+    Process = _WorkerProcess
+
+
+class PasswordHasher:
+    """
+    Generates and checks werkzeug password hashes on a bounded process pool.
+
+    max_workers=0 computes hashes inline (useful for tests and for single-
+    threaded tools). Timings of every hash are kept for stats().
+    """
+
+    def __init__(self, method=DEFAULT_METHOD, salt_length=DEFAULT_SALT_LENGTH,
+                 max_workers=DEFAULT_WORKERS, queue_timeout=DEFAULT_QUEUE_TIMEOUT):
+        self.method = method
+        self.salt_length = salt_length
+        self.max_workers = max_workers
+        self.queue_timeout = queue_timeout
+        # Werkzeug expands 'pbkdf2' to 'pbkdf2:sha256:600000' etc.; compare against the full form
+        self.method_id = full_method(method)
+
+        self._slots = threading.BoundedSemaphore(max(1, max_workers) * QUEUE_DEPTH_PER_WORKER)
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.rehashed = 0
+        self.rejected = 0
+
+    def _executor(self):
+        # Created on first use in each process: a pool inherited through
+        # gunicorn's fork would point at the parent's workers
+        with self._pool_lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                # Not fork: this process already runs request threads, and a
+                # forked child would inherit any lock they hold at that moment.
+                # Workers are forked by a forkserver, a fresh single-threaded
+                # interpreter that imports werkzeug once for all of them. Not
+                # __main__ (see _WorkerPopen): under `python app.py` that would
+                # run the whole app again inside the forkserver.
+                mp_context = _WorkerContext()
+                mp_context.set_forkserver_preload(['werkzeug.security'])
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=mp_context)
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _run(self, operation, fn, *args):
+        start = time.perf_counter()
+        if self.max_workers <= 0:
+            result = fn(*args)
+        else:
+            if not self._slots.acquire(timeout=self.queue_timeout):
+                with self._lock:
+                    self.rejected += 1
+                raise HasherBusy("Too many password hashes in progress, try again shortly")
+            try:
+                result = self._executor().submit(fn, *args).result()
+            finally:
+                self._slots.release()
+        elapsed = time.perf_counter() - start
+        self._record(operation, elapsed)
+        return result, elapsed
+
+    def _record(self, operation, elapsed):
+        with self._lock:
+            entry = self._stats.setdefault(operation, {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+            entry['count'] += 1
+            entry['total_seconds'] += elapsed
+            entry['max_seconds'] = max(entry['max_seconds'], elapsed)
+
+    def hash(self, password):
+        """
+        Returns (password hash, seconds spent hashing).
+        """
+        return self._run('hash', generate_password_hash, password, self.method, self.salt_length)
+
+    def needs_rehash(self, password_hash):
+        return hash_parameters(password_hash) != (self.method_id, self.salt_length)
+
+    def verify(self, password_hash, password):
+        """
+        Check a password against its stored hash.
+
+        Returns (ok, new_hash, seconds): new_hash is a replacement made with the
+        current parameters when the password is right but the stored hash is
+        outdated, otherwise None.
+        """
+        ok, elapsed = self._run('verify', check_password_hash, password_hash, password)
+        if not ok or not self.needs_rehash(password_hash):
+            return ok, None, elapsed
+        new_hash, rehash_elapsed = self.hash(password)
+        with self._lock:
+            self.rehashed += 1
+        return ok, new_hash, elapsed + rehash_elapsed
+
+    def warm(self):
+        """
+        Start the pool's worker processes now rather than on the first login.
+        """
+        if self.max_workers > 0:
+            executor = self._executor()
+            for future in [executor.submit(len, '') for _ in range(self.max_workers)]:
+                future.result()
+
+    def stats(self):
+        with self._lock:
+            operations = {
+                operation: dict(
+                    entry,
+                    total_seconds=round(entry['total_seconds'], 4),
+                    max_seconds=round(entry['max_seconds'], 4),
+                    mean_seconds=round(entry['total_seconds'] / entry['count'], 4),
+                )
+                for operation, entry in self._stats.items()
+            }
+            return {
+                'method': self.method_id,
+                'salt_length': self.salt_length,
+                'workers': self.max_workers,
+                'operations': operations,
+                'rehashed': self.rehashed,
+                'rejected': self.rejected,
+            }
@@ -0,0 +1,469 @@
+"""
+Caching and background generation for the LLM retention recommendations.
+
+generate_recommendations in app.py makes a multi-second gpt-4 call, often for
+employees whose profiles are practically the same. Requests are keyed on a
+canonicalized, bucketed copy of the employee data plus the prediction and a
+probability band, so near-identical profiles share one completion until it
+expires.
+
+/predict does not wait for that call: it submits a job to a small thread pool
+and returns a job id that /recommendations/<id> resolves once the completion
+is ready.
+"""
+import hashlib
+import json
+import math
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import pymongo
+from openai.openai_object import OpenAIObject
+
+# Bucket width for continuous fields; values in the same bucket share a cache entry
+NUMERIC_BUCKETS = {
+    'satisfaction_level': 0.05,
+    'last_evaluation': 0.05,
+    'average_monthly_hours': 10,
+    'average_montly_hours': 10,
+}
+
+# Width of the leaving-probability band that is part of the key
+PROBABILITY_BAND = 0.1
+
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_MAX_SIZE = 10000
+
+# Finished jobs are kept this long for clients to collect
+DEFAULT_JOB_TTL = 60 * 60
+DEFAULT_MAX_JOBS = 10000
+DEFAULT_WORKERS = 4
+
+# MongoDB collections of the 'mongo' cache and job store
+CACHE_COLLECTION = 'recommendation_cache'
+JOB_COLLECTION = 'recommendation_jobs'
+
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+FINISHED_STATES = (JOB_DONE, JOB_FAILED)
+
+
+def _canonical_value(field, value):
+    if isinstance(value, str):
+        value = value.strip()
+        try:
+            value = float(value)
+        except ValueError:
+            return value.lower()
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (int, float)):
+        if math.isnan(value):
+            return None
+        bucket = NUMERIC_BUCKETS.get(field)
+        if bucket:
+            return round(math.floor(value / bucket + 1e-9) * bucket, 6)
+        return float(value)
+    return value
+
+
+def recommendation_key(prediction, probability, employee_data):
+    """
+    Cache key for a recommendation request.
+
+    Field names are lower-cased, numeric strings are parsed, continuous fields
+    are bucketed and the probability is reduced to its band.
+    """
+    canonical = {
+        str(field).strip().lower(): _canonical_value(str(field).strip().lower(), value)
+        for field, value in (employee_data or {}).items()
+    }
+    band = min(math.floor(probability / PROBABILITY_BAND + 1e-9), round(1 / PROBABILITY_BAND) - 1)
+    payload = json.dumps(
+        {'prediction': int(prediction), 'band': band, 'employee': canonical},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class InMemoryCacheBackend:
+    """
+    Per-process LRU cache with a TTL and a size bound.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, entry = item
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class MongoCacheBackend:
+    """
+    Cache shared by every worker, stored in a MongoDB collection.
+
+    Expiry uses a TTL index on `expires_at` (checked on read as well, since the
+    TTL monitor only runs about once a minute). The size bound evicts the least
+    recently used documents.
+    """
+
+    def __init__(self, collection, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        self.collection = collection
+        self.max_size = max_size
+        self.ttl = ttl
+
+    def ensure_indexes(self):
+        """
+        Create the TTL and LRU indexes at startup (a no-op when they exist).
+        Returns False if they could not be created; expiry is still checked on
+        read, and eviction falls back to a collection scan.
+        """
+        try:
+            self.collection.create_index('expires_at', expireAfterSeconds=0)
+            self.collection.create_index('last_access')
+            return True
+        except pymongo.errors.PyMongoError as e:
+            print(f"Could not create recommendation cache indexes: {e}")
+            return False
+
+    def get(self, key):
+        now = datetime.now(timezone.utc)
+        doc = self.collection.find_one_and_update(
+            {'_id': key, 'expires_at': {'$gt': now}},
+            {'$set': {'last_access': now}},
+            projection={'entry': True},
+        )
+        return doc['entry'] if doc else None
+
+    def set(self, key, entry):
+        now = datetime.now(timezone.utc)
+        self.collection.replace_one(
+            {'_id': key},
+            {'entry': entry, 'last_access': now, 'expires_at': now + timedelta(seconds=self.ttl)},
+            upsert=True,
+        )
+        excess = self.collection.estimated_document_count() - self.max_size
+        if excess > 0:
+            oldest = self.collection.find({}, {'_id': True}).sort('last_access', pymongo.ASCENDING).limit(excess)
+            self.collection.delete_many({'_id': {'$in': [doc['_id'] for doc in oldest]}})
+
+    def clear(self):
+        self.collection.delete_many({})
+
+    def __len__(self):
+        return self.collection.estimated_document_count()
+
+
+class RecommendationCache:
+    """
+    Wraps a backend and keeps hit/miss counters plus the LLM latency and
+    tokens that cache hits avoided.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.saved_seconds = 0.0
+        self.saved_tokens = 0
+
+    def lookup(self, key):
+        try:
+            entry = self.backend.get(key)
+        except Exception as e:
+            # A broken cache must never break /predict
+            print(f"Recommendation cache lookup failed: {e}")
+            entry = None
+            with self._lock:
+                self.errors += 1
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.saved_seconds += entry.get('latency', 0.0)
+            self.saved_tokens += entry.get('tokens', 0)
+        return entry['text']
+
+    def store(self, key, text, latency=0.0, tokens=0):
+        try:
+            self.backend.set(key, {'text': text, 'latency': latency, 'tokens': tokens})
+        except Exception as e:
+            print(f"Recommendation cache store failed: {e}")
+            with self._lock:
+                self.errors += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': type(self.backend).__name__,
+                'size': len(self.backend),
+                'hits': self.hits,
+                'misses': self.misses,
+                'errors': self.errors,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'saved_seconds': round(self.saved_seconds, 3),
+                'saved_tokens': self.saved_tokens,
+            }
+
+
+def build_recommendation_cache(backend_name, db=None, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+    """
+    Build the cache selected by RECOMMENDATION_CACHE_BACKEND ('memory', 'mongo' or 'none').
+    """
+    if backend_name == 'none':
+        return None
+    if backend_name == 'mongo':
+        return RecommendationCache(MongoCacheBackend(db[CACHE_COLLECTION], max_size, ttl))
+    if backend_name == 'memory':
+        return RecommendationCache(InMemoryCacheBackend(max_size, ttl))
+    raise ValueError(f"Unknown recommendation cache backend: {backend_name}")
+
+
+class InMemoryJobStore:
+    """
+    Job records for a single process. Only suitable when every request for a
+    job reaches the worker that created it (one gunicorn worker).
+    """
+
+    def __init__(self, max_jobs=DEFAULT_MAX_JOBS, ttl=DEFAULT_JOB_TTL):
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, job_id):
+        with self._lock:
+            now = time.monotonic()
+            # Drop expired jobs and keep the store bounded
+            while self._jobs:
+                oldest_id, (created, _) = next(iter(self._jobs.items()))
+                if created + self.ttl > now and len(self._jobs) < self.max_jobs:
+                    break
+                del self._jobs[oldest_id]
+            self._jobs[job_id] = (now, {'id': job_id, 'status': JOB_PENDING})
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            item = self._jobs.get(job_id)
+            if item is not None:
+                item[1].update(fields)
+
+    def get(self, job_id):
+        with self._lock:
+            item = self._jobs.get(job_id)
+            if item is None or item[0] + self.ttl <= time.monotonic():
+                return None
+            return dict(item[1])
+
+
+class MongoJobStore:
+    """
+    Job records shared by every worker, stored in a MongoDB collection with a TTL index.
+    """
+
+    def __init__(self, collection, ttl=DEFAULT_JOB_TTL):
+        self.collection = collection
+        self.ttl = ttl
+
+    def ensure_indexes(self):
+        """
+        Create the TTL index at startup (a no-op when it exists). Returns False
+        if it could not be created, in which case old jobs are not expired.
+        """
+        try:
+            self.collection.create_index('created_at', expireAfterSeconds=self.ttl)
+            return True
+        except pymongo.errors.PyMongoError as e:
+            print(f"Could not create recommendation job indexes: {e}")
+            return False
+
+    def create(self, job_id):
+        self.collection.insert_one({
+            '_id': job_id,
+            'status': JOB_PENDING,
+            'created_at': datetime.now(timezone.utc),
+        })
+
+    def update(self, job_id, **fields):
+        self.collection.update_one({'_id': job_id}, {'$set': fields})
+
+    def get(self, job_id):
+        doc = self.collection.find_one({'_id': job_id}, {'created_at': False})
+        if doc is None:
+            return None
+        doc['id'] = doc.pop('_id')
+        return doc
+
+
+class RecommendationJobs:
+    """
+    Runs recommendation generation on a bounded thread pool and records the
+    outcome in a job store.
+    """
+
+    def __init__(self, store, max_workers=DEFAULT_WORKERS):
+        self.store = store
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='recommendations')
+
+    def submit(self, fn, *args):
+        job_id = uuid.uuid4().hex
+        self.store.create(job_id)
+        self.executor.submit(self._run, job_id, fn, args)
+        return job_id
+
+    def _run(self, job_id, fn, args):
+        self.store.update(job_id, status=JOB_RUNNING)
+        try:
+            self.store.update(job_id, status=JOB_DONE, recommendations=fn(*args))
+        except Exception as e:
+            print(f"Recommendation job {job_id} failed: {e}")
+            self.store.update(job_id, status=JOB_FAILED, error=str(e))
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def wait(self, job_id, timeout, poll_interval=0.25):
+        """
+        Yield the job record every time its status changes, until it finishes,
+        disappears or `timeout` seconds pass.
+        """
+        deadline = time.monotonic() + timeout
+        last_status = None
+        while True:
+            job = self.get(job_id)
+            if job is None:
+                return
+            if job['status'] != last_status:
+                last_status = job['status']
+                yield job
+            if last_status in FINISHED_STATES or time.monotonic() >= deadline:
+                return
+            time.sleep(poll_interval)
+
+
+def default_job_store(cache_backend):
+    """
+    Job store used when RECOMMENDATION_JOB_STORE is not set: 'mongo' when the
+    cache is in MongoDB, since a deployment sharing its cache between workers
+    needs its jobs shared too, otherwise 'memory'.
+    """
+    return 'mongo' if cache_backend == 'mongo' else 'memory'
+
+
+def build_job_store(backend_name, db=None, ttl=DEFAULT_JOB_TTL):
+    """
+    Build the job store selected by RECOMMENDATION_JOB_STORE ('memory' or 'mongo').
+    """
+    if backend_name == 'mongo':
+        return MongoJobStore(db[JOB_COLLECTION], ttl)
+    if backend_name == 'memory':
+        return InMemoryJobStore(ttl=ttl)
+    raise ValueError(f"Unknown recommendation job store: {backend_name}")
+
+
+def ensure_recommendation_indexes(db, cache_backend, job_store, job_ttl=DEFAULT_JOB_TTL):
+    """
+    Create the indexes of the MongoDB cache and job store, for whichever of
+    them is in use. The backends do no I/O when constructed, so this runs as a
+    startup step with a client of its own (see create_indexes in app.py).
+    """
+    created = True
+    if cache_backend == 'mongo':
+        created = MongoCacheBackend(db[CACHE_COLLECTION]).ensure_indexes() and created
+    if job_store == 'mongo':
+        created = MongoJobStore(db[JOB_COLLECTION], job_ttl).ensure_indexes() and created
+    return created
+
+
+def format_sse(event, data):
+    """
+    One server-sent event; data is JSON-encoded so it may safely contain newlines.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stub_chat_completion(delay=0.0, **kwargs):
+    """
+    Offline stand-in for openai.ChatCompletion.create, for tests and local runs.
+    Returns a response shaped like the real one, or a chunk iterator when
+    stream=True (the delay is then spread over the chunks).
+    """
+    prompt = kwargs['messages'][-1]['content']
+    leaving = 'Likely to leave' in prompt
+    text = (
+        "1. Schedule a stay interview to understand current concerns. "
+        "2. Review workload and compensation against peers. "
+        "3. Agree on a concrete development or promotion plan. "
+        "4. Follow up monthly on progress."
+        if leaving else
+        "1. Recognize recent contributions publicly. "
+        "2. Keep offering stretch projects and learning time. "
+        "3. Check in quarterly on career goals."
+    )
+
+    if kwargs.get('stream'):
+        return _stub_chunks(text, delay, kwargs.get('model', 'stub'))
+
+    if delay:
+        time.sleep(delay)
+    return OpenAIObject.construct_from({
+        'object': 'chat.completion',
+        'model': kwargs.get('model', 'stub'),
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': len(prompt.split()), 'completion_tokens': len(text.split()),
+                  'total_tokens': len(prompt.split()) + len(text.split())},
+    })
+
+
+def _stub_chunks(text, delay, model):
+    words = text.split(' ')
+    for i, word in enumerate(words):
+        if delay:
+            time.sleep(delay / len(words))
+        yield OpenAIObject.construct_from({
+            'object': 'chat.completion.chunk',
+            'model': model,
+            'choices': [{'index': 0, 'delta': {'content': word if i == 0 else ' ' + word}, 'finish_reason': None}],
+        })
+    yield OpenAIObject.construct_from({
+        'object': 'chat.completion.chunk',
+        'model': model,
+        'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}],
+    })
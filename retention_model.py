@@ -0,0 +1,204 @@
+import json
+import math
+
+import joblib
+import numpy as np
+
+# Mapping used when the model was trained (see preprocess_data in 272_project.py)
+SALARY_MAPPING = {'low': 0, 'medium': 1, 'high': 2}
+
+# Prefix pd.get_dummies gives the one-hot department columns
+DEPARTMENT_PREFIX = 'department_'
+
+# Number of employees scored per model call in batch mode
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def _to_float(value):
+    # Same conversion pandas/sklearn apply to an object column: None -> NaN
+    if value is None:
+        return math.nan
+    return float(value)
+
+
+class FeatureEncoder:
+    """
+    Encodes raw employee records into the feature layout the model was trained on.
+
+    Replaces the per-request pandas pipeline (DataFrame, astype, salary map,
+    get_dummies, column padding and reindex). Column positions are resolved once
+    here, and each record is written directly into a preallocated float64 row.
+    The output is bit-identical to running that pipeline and, when a scaler is
+    given, to calling scaler.transform on its result.
+    """
+
+    def __init__(self, X_columns, scaler=None, salary_mapping=SALARY_MAPPING):
+        self.columns = list(X_columns)
+        self.n_features = len(self.columns)
+        self.salary_mapping = dict(salary_mapping)
+
+        positions = {col: i for i, col in enumerate(self.columns)}
+        self._salary_position = positions.pop('salary', None)
+        # Every other training column is read verbatim when the record has it
+        self._value_positions = list(positions.items())
+        self._department_positions = {
+            col[len(DEPARTMENT_PREFIX):]: i
+            for col, i in positions.items()
+            if col.startswith(DEPARTMENT_PREFIX)
+        }
+
+        self._mean = None
+        self._scale = None
+        if scaler is not None:
+            if getattr(scaler, 'with_mean', True):
+                self._mean = np.asarray(scaler.mean_, dtype=np.float64)
+            if getattr(scaler, 'with_std', True):
+                self._scale = np.asarray(scaler.scale_, dtype=np.float64)
+
+    @classmethod
+    def load(cls, columns_path='X_columns.joblib', scaler=None):
+        return cls(joblib.load(columns_path), scaler)
+
+    def encode_into(self, record, row):
+        """
+        Write the unscaled features of one record into `row` (length n_features).
+        """
+        if not isinstance(record, dict):
+            raise ValueError("Each employee record must be a JSON object")
+
+        row[:] = 0.0
+        for col, i in self._value_positions:
+            if col in record:
+                row[i] = _to_float(record[col])
+
+        if self._salary_position is not None and 'salary' in record:
+            try:
+                row[self._salary_position] = self.salary_mapping.get(record['salary'], math.nan)
+            except TypeError:
+                # Unhashable values never match the mapping
+                row[self._salary_position] = math.nan
+
+        # One-hot department; unknown or missing departments leave every column at 0
+        department = record.get('department')
+        if department is not None and not (isinstance(department, float) and math.isnan(department)):
+            i = self._department_positions.get(str(department))
+            if i is not None:
+                row[i] = 1.0
+        return row
+
+    def encode(self, records):
+        """
+        Encode a sequence of records into an (n_records, n_features) matrix,
+        scaled if the encoder was built with a scaler.
+        """
+        X = np.empty((len(records), self.n_features), dtype=np.float64)
+        for record, row in zip(records, X):
+            self.encode_into(record, row)
+        return self.scale(X)
+
+    def encode_one(self, record):
+        return self.encode([record])
+
+    def scale(self, X):
+        # Same in-place operations StandardScaler.transform performs
+        if self._mean is not None:
+            X -= self._mean
+        if self._scale is not None:
+            X /= self._scale
+        return X
+
+
+def leaving_probability(probabilities):
+    """
+    Probability of the positive ("left") class for one row of predict_proba output.
+    """
+    probability = float(probabilities[1]) if len(probabilities) > 1 else 0.0
+    # Ensure probability is not NaN
+    if math.isnan(probability):
+        probability = 0.0
+    return probability
+
+
+def iter_chunks(records, chunk_size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class InvalidRecord:
+    """
+    Stands in for an input line that could not be parsed, so it is reported
+    at its position instead of ending the stream.
+    """
+
+    def __init__(self, error):
+        self.error = error
+
+
+def iter_ndjson(lines):
+    """
+    Parse an NDJSON stream (one JSON object per line), skipping blank lines.
+    Lines that are not valid JSON come out as InvalidRecord.
+    """
+    for line in lines:
+        try:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+        except ValueError as e:
+            yield InvalidRecord(f"Invalid NDJSON input: {e}")
+
+
+def score_records(records, model, encoder, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Score an iterable of employee records in chunks.
+
+    The valid records of each chunk are encoded into a single feature matrix
+    and go through one forest traversal; a malformed record (or InvalidRecord)
+    only produces an error result for itself. Yields one result dict per
+    record, in input order, so callers can stream results as they are produced.
+    """
+    index = 0
+    for chunk in iter_chunks(records, chunk_size):
+        X = np.empty((len(chunk), encoder.n_features), dtype=np.float64)
+        errors = {}
+        for i, (record, row) in enumerate(zip(chunk, X)):
+            if isinstance(record, InvalidRecord):
+                errors[i] = record.error
+                continue
+            try:
+                encoder.encode_into(record, row)
+            except (TypeError, ValueError) as e:
+                errors[i] = str(e)
+
+        valid = [i for i in range(len(chunk)) if i not in errors]
+        scored = {}
+        if valid:
+            try:
+                predictions, probabilities = model.predict_with_proba(encoder.scale(X[valid]))
+                scored = dict(zip(valid, zip(predictions, probabilities)))
+            except Exception as e:
+                # The model rejected the chunk as a whole; report it for every record in it
+                errors.update((i, str(e)) for i in valid)
+
+        for i, record in enumerate(chunk):
+            if i in errors:
+                yield {'index': index, 'error': errors[i]}
+            else:
+                prediction, row = scored[i]
+                result = {
+                    'index': index,
+                    'prediction': int(prediction),
+                    'probability': leaving_probability(row),
+                }
+                if 'employee_id' in record:
+                    result['employee_id'] = record['employee_id']
+                yield result
+            index += 1
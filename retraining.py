@@ -0,0 +1,519 @@
+"""
+Feedback ingestion and micro-batch retraining of the retention model.
+
+update_model in 272_project.py used to refit the forest on the single row it
+was given, throwing away everything it had learned. Labelled outcomes now go
+to a durable feedback store, and a Retrainer folds them into the model in
+batches, with one of two strategies:
+
+    warm_start  keep the published forest and grow it by a few trees fitted on
+                all feedback so far plus a replay sample of the original
+                training data; the scaler stays as it is. Once the forest
+                reaches max_estimators the next cycle is a full retrain.
+    full        refit the scaler and a fresh forest on the original training
+                data plus all feedback, with n_jobs=-1.
+
+Every cycle measures accuracy on a fixed holdout split of the original
+dataset before and after training, and only publishes a model that is not
+worse than the current one by more than the tolerance. Publishing writes
+rf_model.joblib, scaler.joblib, fused_model.joblib and its memory-mapped copy
+fused_model.forest (the files the app serves) to temporary files and renames
+them into place, so a reader never sees a half-written artifact.
+
+Usage:
+    python retraining.py [--strategy warm_start|full] [--watch] [--batch-size N]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from fused_model import FUSED_MODEL_PATH, FusedForest
+from mapped_forest import MAPPED_MODEL_PATH, export
+from retention_model import FeatureEncoder
+
+FEEDBACK_PATH = 'feedback.ndjson'
+DATASET_PATH = 'HR_comma_sep.csv'
+MODEL_PATH = 'rf_model.joblib'
+SCALER_PATH = 'scaler.joblib'
+COLUMNS_PATH = 'X_columns.joblib'
+
+# HR_comma_sep.csv headers vary between copies ('sales' vs 'Department',
+# 'Work_accident'); columns are renamed by position to the record fields the
+# encoder reads
+DATASET_COLUMNS = [
+    'satisfaction_level', 'last_evaluation', 'number_project', 'average_montly_hours',
+    'time_spend_company', 'work_accident', 'left', 'promotion_last_5years', 'department', 'salary',
+]
+DATASET_DTYPES = {
+    'satisfaction_level': 'float64', 'last_evaluation': 'float64', 'number_project': 'int64',
+    'average_montly_hours': 'int64', 'time_spend_company': 'int64', 'work_accident': 'int64',
+    'left': 'int64', 'promotion_last_5years': 'int64', 'department': 'category', 'salary': 'category',
+}
+
+WARM_START = 'warm_start'
+FULL = 'full'
+STRATEGIES = (WARM_START, FULL)
+
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_TREES_PER_BATCH = 10
+DEFAULT_MAX_ESTIMATORS = 300
+DEFAULT_N_ESTIMATORS = 100
+# Rows of the original training data mixed into each warm-start batch
+DEFAULT_REPLAY_SIZE = 2000
+# A new model may be this much less accurate on the holdout and still be published
+DEFAULT_TOLERANCE = 0.005
+DEFAULT_INTERVAL = 300
+DEFAULT_POLL_INTERVAL = 10
+HOLDOUT_FRACTION = 0.2
+# Holdout records published to the model registry for the app's canary check
+CANARY_SIZE = 200
+RANDOM_STATE = 42
+
+
+class FileFeedbackStore:
+    """
+    Append-only NDJSON file, one labelled record per line.
+
+    Each entry is written with a single O_APPEND write and fsynced, so several
+    gunicorn workers can append to the same file and an acknowledged entry
+    survives a crash.
+    """
+
+    def __init__(self, path=FEEDBACK_PATH):
+        self.path = path
+
+    def append(self, record, left):
+        line = json.dumps({
+            'record': record,
+            'left': int(left),
+            'received_at': datetime.now(timezone.utc).isoformat(),
+        }) + '\n'
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('utf-8'))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def read(self):
+        """
+        Every entry, oldest first. An entry's position is its line number.
+        """
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        with open(self.path, encoding='utf-8') as f:
+            for i, line in enumerate(f):
+                # A line without its newline is an append still in progress
+                if line.endswith('\n'):
+                    entries.append(dict(json.loads(line), position=i))
+        return entries
+
+    def count(self):
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, 'rb') as f:
+            return sum(1 for line in f if line.endswith(b'\n'))
+
+    def count_after(self, watermark):
+        """
+        Entries after the one at position `watermark` (all of them for None).
+        """
+        return self.count() - (0 if watermark is None else watermark + 1)
+
+
+class MongoFeedbackStore:
+    """
+    Feedback shared by every dyno, in a MongoDB collection. An entry's
+    position is its _id as a hex string, so positions sort like the _ids.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def append(self, record, left):
+        self.collection.insert_one({
+            'record': record,
+            'left': int(left),
+            'received_at': datetime.now(timezone.utc),
+        })
+
+    def read(self):
+        entries = []
+        for doc in self.collection.find({}).sort('_id', 1):
+            doc['position'] = str(doc.pop('_id'))
+            entries.append(doc)
+        return entries
+
+    def count(self):
+        return self.collection.count_documents({})
+
+    def count_after(self, watermark):
+        from bson import ObjectId
+        return self.collection.count_documents({} if watermark is None else {'_id': {'$gt': ObjectId(watermark)}})
+
+
+def build_feedback_store(backend_name, db=None, path=FEEDBACK_PATH):
+    """
+    Build the store selected by FEEDBACK_STORE ('file' or 'mongo').
+    """
+    if backend_name == 'mongo':
+        return MongoFeedbackStore(db['model_feedback'])
+    if backend_name == 'file':
+        return FileFeedbackStore(path)
+    raise ValueError(f"Unknown feedback store: {backend_name}")
+
+
+def validate_feedback(record, left):
+    if not isinstance(record, dict):
+        raise ValueError("employee_data must be a JSON object")
+    if left not in (0, 1, True, False):
+        raise ValueError("left must be 0 or 1")
+
+
+def read_dataset(path=DATASET_PATH):
+    """
+    The dataset as a DataFrame with DATASET_COLUMNS names and DATASET_DTYPES
+    types, parsed once without pandas guessing the column types.
+    """
+    return pd.read_csv(path, header=0, names=DATASET_COLUMNS, dtype=DATASET_DTYPES)
+
+
+def load_dataset(path=DATASET_PATH):
+    """
+    Employee records and labels of the original training data.
+    """
+    df = read_dataset(path)
+    y = df.pop('left').to_numpy(dtype=np.int64)
+    return df.astype({'department': str, 'salary': str}).to_dict('records'), y
+
+
+def holdout_split(n_rows, fraction=HOLDOUT_FRACTION, random_state=RANDOM_STATE):
+    """
+    (train indices, holdout indices): the same split train_model in
+    272_project.py makes, so the original model never saw the holdout rows.
+    """
+    from sklearn.model_selection import train_test_split
+    return train_test_split(np.arange(n_rows), test_size=fraction, random_state=random_state)
+
+
+def scale(scaler, X):
+    """
+    scaler.transform on a copy of X, without the feature-name check that
+    warns for scalers fitted on the notebook's DataFrame.
+    """
+    return FeatureEncoder([], scaler).scale(np.array(X, dtype=np.float64))
+
+
+def _dump_atomic(obj, path):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            joblib.dump(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        return tmp_path
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def publish(rf_model, scaler, X_columns, model_dir='.', check_rows=None):
+    """
+    Write the forest, the scaler and the fused serving artifact, each replacing
+    the previous file in a single rename. The fused model is renamed last; it
+    is self-contained, so the app switches from one model to the next at once.
+    """
+    fused = FusedForest(rf_model, scaler, X_columns)
+    if check_rows is not None:
+        expected = rf_model.predict_proba(scale(scaler, check_rows))
+        if not np.array_equal(fused.predict_proba(check_rows), expected):
+            raise RuntimeError("Fused model does not match rf_model + scaler; not publishing")
+
+    staged = [
+        (_dump_atomic(rf_model, os.path.join(model_dir, MODEL_PATH)), MODEL_PATH),
+        (_dump_atomic(scaler, os.path.join(model_dir, SCALER_PATH)), SCALER_PATH),
+        (_dump_atomic(fused, os.path.join(model_dir, FUSED_MODEL_PATH)), FUSED_MODEL_PATH),
+    ]
+    for tmp_path, name in staged:
+        os.replace(tmp_path, os.path.join(model_dir, name))
+    # The app prefers the memory-mapped copy when there is one; it is replaced last
+    export(fused, os.path.join(model_dir, MAPPED_MODEL_PATH))
+    return fused
+
+
+class Retrainer:
+    """
+    Runs retraining cycles over the feedback that has arrived since the last
+    published model. Progress is kept in retrain_state.json next to the model
+    as a watermark, the position of the newest entry the model has seen;
+    unlike a count, it stays right when entries are deleted or expire. With
+    a model registry (see model_registry.py) every published model also
+    becomes a new version there.
+    """
+
+    def __init__(self, store, strategy=WARM_START, model_dir='.', dataset_path=DATASET_PATH,
+                 batch_size=DEFAULT_BATCH_SIZE, trees_per_batch=DEFAULT_TREES_PER_BATCH,
+                 max_estimators=DEFAULT_MAX_ESTIMATORS, replay_size=DEFAULT_REPLAY_SIZE,
+                 tolerance=DEFAULT_TOLERANCE, n_jobs=-1, registry=None):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown retraining strategy {strategy!r}, expected one of {', '.join(STRATEGIES)}")
+        self.store = store
+        self.strategy = strategy
+        self.model_dir = model_dir
+        self.batch_size = batch_size
+        self.trees_per_batch = trees_per_batch
+        self.max_estimators = max_estimators
+        self.replay_size = replay_size
+        self.tolerance = tolerance
+        self.n_jobs = n_jobs
+        self.registry = registry
+        self.state_path = os.path.join(model_dir, 'retrain_state.json')
+        self._lock = threading.Lock()
+
+        self.X_columns = joblib.load(os.path.join(model_dir, COLUMNS_PATH))
+        self.encoder = FeatureEncoder(self.X_columns)
+        records, y = load_dataset(dataset_path)
+        X = self.encoder.encode(records)
+        train, holdout = holdout_split(len(y))
+        self.X_train, self.y_train = X[train], y[train]
+        self.X_holdout, self.y_holdout = X[holdout], y[holdout]
+        self.canary = [{'record': records[i], 'left': int(y[i])} for i in holdout[:CANARY_SIZE]]
+
+    def _path(self, name):
+        return os.path.join(self.model_dir, name)
+
+    def _load_state(self):
+        if not os.path.exists(self.state_path):
+            return {'feedback_watermark': None, 'trained_feedback': 0, 'cycles': 0}
+        with open(self.state_path) as f:
+            return json.load(f)
+
+    def _save_state(self, state):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def pending(self):
+        state = self._load_state()
+        if 'feedback_watermark' not in state:
+            # State written before watermarks only counted the entries trained on
+            return self.store.count() - state['trained_feedback']
+        return self.store.count_after(state['feedback_watermark'])
+
+    def _new_rows(self, state, entries):
+        """
+        Mask of the entries the current model has not been trained on.
+        """
+        if 'feedback_watermark' not in state:
+            return np.arange(len(entries)) >= state['trained_feedback']
+        watermark = state['feedback_watermark']
+        return np.array([watermark is None or entry['position'] > watermark for entry in entries], dtype=bool)
+
+    def _current_model(self):
+        if not os.path.exists(self._path(MODEL_PATH)):
+            return None, None
+        return joblib.load(self._path(MODEL_PATH)), joblib.load(self._path(SCALER_PATH))
+
+    def _accuracy(self, rf_model, scaler, X, y):
+        if rf_model is None or not len(y):
+            return None
+        return float(np.mean(rf_model.predict(scale(scaler, X)) == y))
+
+    def _fit_full(self, X, y):
+        from sklearn.ensemble import RandomForestClassifier
+        from sklearn.preprocessing import StandardScaler
+        scaler = StandardScaler().fit(X)
+        rf_model = RandomForestClassifier(n_estimators=DEFAULT_N_ESTIMATORS, random_state=RANDOM_STATE, n_jobs=self.n_jobs)
+        rf_model.fit(scale(scaler, X), y)
+        return rf_model, scaler
+
+    def _fit_warm_start(self, rf_model, scaler, X_feedback, y_feedback, cycle):
+        # New trees see every feedback row plus a replay sample, so they learn
+        # the new outcomes without forgetting the original distribution
+        rng = np.random.default_rng(RANDOM_STATE + cycle)
+        replay = rng.choice(len(self.y_train), size=min(self.replay_size, len(self.y_train)), replace=False)
+        X = np.vstack([self.X_train[replay], X_feedback])
+        y = np.concatenate([self.y_train[replay], y_feedback])
+        rf_model.set_params(warm_start=True, n_jobs=self.n_jobs,
+                            n_estimators=len(rf_model.estimators_) + self.trees_per_batch)
+        rf_model.fit(scale(scaler, X), y)
+        rf_model.set_params(warm_start=False)
+        return rf_model, scaler
+
+    def run_cycle(self, force=False):
+        """
+        Retrain if at least batch_size new feedback entries are waiting (or
+        any at all with force=True). Returns the cycle report, or None when
+        there was nothing to do.
+        """
+        with self._lock:
+            state = self._load_state()
+            entries = self.store.read()
+            new_rows = self._new_rows(state, entries)
+            new = int(new_rows.sum())
+            if new <= 0 or (new < self.batch_size and not force):
+                return None
+
+            cycle_start = time.perf_counter()
+            records = [entry['record'] for entry in entries]
+            X_feedback = self.encoder.encode(records) if records else np.empty((0, self.encoder.n_features))
+            y_feedback = np.array([entry['left'] for entry in entries], dtype=np.int64)
+
+            rf_model, scaler = self._current_model()
+            # Accuracy of the current model on feedback it has not been trained on yet
+            feedback_accuracy = self._accuracy(rf_model, scaler, X_feedback[new_rows], y_feedback[new_rows])
+            holdout_before = self._accuracy(rf_model, scaler, self.X_holdout, self.y_holdout)
+
+            strategy = self.strategy
+            if strategy == WARM_START and (rf_model is None or len(rf_model.estimators_) + self.trees_per_batch > self.max_estimators):
+                strategy = FULL
+
+            train_start = time.perf_counter()
+            if strategy == WARM_START:
+                new_model, new_scaler = self._fit_warm_start(rf_model, scaler, X_feedback, y_feedback, state['cycles'])
+            else:
+                new_model, new_scaler = self._fit_full(np.vstack([self.X_train, X_feedback]),
+                                                       np.concatenate([self.y_train, y_feedback]))
+            train_seconds = time.perf_counter() - train_start
+            holdout_after = self._accuracy(new_model, new_scaler, self.X_holdout, self.y_holdout)
+
+            published = holdout_before is None or holdout_after >= holdout_before - self.tolerance
+            fused = None
+            if published:
+                fused = publish(new_model, new_scaler, self.X_columns, self.model_dir, check_rows=self.X_holdout[:500])
+                state['feedback_watermark'] = entries[-1]['position']
+                state['trained_feedback'] = len(entries)
+            state['cycles'] += 1
+
+            report = {
+                'cycle': state['cycles'],
+                'strategy': strategy,
+                'new_feedback': new,
+                'training_rows': int(len(self.y_train) + len(y_feedback)) if strategy == FULL else None,
+                'n_estimators': len(new_model.estimators_),
+                'train_seconds': round(train_seconds, 3),
+                'cycle_seconds': round(time.perf_counter() - cycle_start, 3),
+                'feedback_accuracy_before': feedback_accuracy,
+                'holdout_accuracy_before': holdout_before,
+                'holdout_accuracy_after': holdout_after,
+                'published': published,
+                'finished_at': datetime.now(timezone.utc).isoformat(),
+            }
+            if fused is not None and self.registry is not None:
+                report['model_version'] = self.registry.publish(
+                    {FUSED_MODEL_PATH: fused, COLUMNS_PATH: self.X_columns, MODEL_PATH: new_model, SCALER_PATH: new_scaler},
+                    metadata={key: report[key] for key in ('cycle', 'strategy', 'n_estimators', 'holdout_accuracy_after')},
+                    canary=self.canary,
+                )
+            state['last_cycle'] = report
+            self._save_state(state)
+            print(f"Retraining cycle {report['cycle']} ({strategy}): {new} new rows, "
+                  f"trained in {report['train_seconds']}s, holdout accuracy "
+                  f"{holdout_before if holdout_before is None else round(holdout_before, 4)} -> {holdout_after:.4f}, "
+                  f"{'published' if published else 'not published (worse than the current model)'}")
+            return report
+
+
+class RetrainWorker:
+    """
+    Runs a cycle whenever a full batch is waiting, checking the store every
+    `poll_interval` seconds or as soon as notify() is called. Feedback that
+    has waited `interval` seconds is trained on even if the batch is partial.
+    """
+
+    def __init__(self, retrainer, interval=DEFAULT_INTERVAL, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.retrainer = retrainer
+        self.interval = interval
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='retrain', daemon=True)
+        self._thread.start()
+
+    def notify(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def run(self):
+        waiting_since = None
+        while not self._stopped.is_set():
+            try:
+                pending = self.retrainer.pending()
+                if pending <= 0:
+                    waiting_since = None
+                else:
+                    waiting_since = waiting_since or time.monotonic()
+                    overdue = time.monotonic() - waiting_since >= self.interval
+                    if self.retrainer.run_cycle(force=overdue) is not None:
+                        waiting_since = None
+            except Exception as e:
+                print(f"Retraining cycle failed: {e}")
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--strategy', choices=STRATEGIES, default=WARM_START)
+    parser.add_argument('--feedback-store', choices=('file', 'mongo'), default=os.environ.get('FEEDBACK_STORE', 'file'))
+    parser.add_argument('--feedback-path', default=os.environ.get('FEEDBACK_PATH', FEEDBACK_PATH))
+    parser.add_argument('--dataset', default=DATASET_PATH)
+    parser.add_argument('--model-dir', default='.')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--trees-per-batch', type=int, default=DEFAULT_TREES_PER_BATCH)
+    parser.add_argument('--max-estimators', type=int, default=DEFAULT_MAX_ESTIMATORS)
+    parser.add_argument('--registry', default=os.environ.get('MODEL_REGISTRY'),
+                        help='also publish to this model registry (directory or s3://bucket/prefix)')
+    parser.add_argument('--force', action='store_true', help='retrain even on a partial batch')
+    parser.add_argument('--watch', action='store_true', help='keep running, one cycle per batch')
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL, help='seconds before a partial batch is trained on with --watch')
+    args = parser.parse_args(argv)
+
+    db = None
+    if args.feedback_store == 'mongo':
+        from pymongo import MongoClient
+        from user_store import mongo_client_options
+        db = MongoClient(os.environ['MONGO_URI'], **mongo_client_options())['my_database']
+    store = build_feedback_store(args.feedback_store, db, args.feedback_path)
+    registry = None
+    if args.registry:
+        from model_registry import ModelRegistry, open_store
+        registry = ModelRegistry(open_store(args.registry))
+    retrainer = Retrainer(store, args.strategy, args.model_dir, args.dataset, args.batch_size,
+                          args.trees_per_batch, args.max_estimators, registry=registry)
+
+    if not args.watch:
+        report = retrainer.run_cycle(force=args.force)
+        if report is None:
+            print(f"{retrainer.pending()} new feedback entries, waiting for {args.batch_size}")
+        return
+
+    # Feedback arrives from the web processes, so the store is polled
+    try:
+        RetrainWorker(retrainer, args.interval).run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,166 @@
+"""
+Loading of the app's heavy resources (the forest, Firebase, Mongo indexes).
+
+app.py used to do all of this one step after another at import time, so every
+gunicorn worker and every dyno restart waited for the sum of them. A
+StartupManager runs the registered loaders in one of three modes:
+
+    eager       all loaders run concurrently and start() waits for them. With
+                gunicorn's preload_app this happens once in the master, and the
+                forked workers share the loaded forest copy-on-write.
+    background  start() returns at once and the loaders run on threads; a
+                request that needs a resource still loading waits for it.
+    lazy        nothing is loaded until a request first asks for it.
+
+ready()/status() back the /ready endpoint.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+EAGER = 'eager'
+BACKGROUND = 'background'
+LAZY = 'lazy'
+STARTUP_MODES = (EAGER, BACKGROUND, LAZY)
+
+PENDING = 'pending'
+LOADING = 'loading'
+LOADED = 'loaded'
+FAILED = 'failed'
+
+# How long a request waits for a resource that is still loading
+DEFAULT_WAIT_TIMEOUT = 30.0
+
+
+class ResourceUnavailable(Exception):
+    """
+    Raised when a resource failed to load or is still loading after the wait timeout.
+    """
+
+
+class _Resource:
+
+    def __init__(self, name, loader, required):
+        self.name = name
+        self.loader = loader
+        self.required = required
+        self.reset()
+
+    def reset(self):
+        self.state = PENDING
+        self.value = None
+        self.error = None
+        self.seconds = None
+        self.lock = threading.Lock()
+        self.loaded = threading.Event()
+
+
+class StartupManager:
+    """
+    Registry of named resources and their loaders.
+
+    Optional resources (required=False) are loaded like the others, but a
+    failure does not make the app unready; use them for work such as index
+    creation that the app can run without.
+    """
+
+    def __init__(self, mode=EAGER, wait_timeout=DEFAULT_WAIT_TIMEOUT):
+        if mode not in STARTUP_MODES:
+            raise ValueError(f"Unknown startup mode {mode!r}, expected one of {', '.join(STARTUP_MODES)}")
+        self.mode = mode
+        self.wait_timeout = wait_timeout
+        self._resources = {}
+        self.started_at = time.time()
+        self.ready_seconds = None
+        # A loader thread does not survive fork; anything it left unfinished
+        # loads on first use in the child
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def register(self, name, loader, required=True):
+        self._resources[name] = _Resource(name, loader, required)
+
+    def start(self):
+        resources = [r for r in self._resources.values() if r.state == PENDING]
+        if self.mode == EAGER:
+            # The pool is shut down before returning, so no thread is left
+            # running when a preloading gunicorn master forks its workers
+            with ThreadPoolExecutor(max_workers=max(1, len(resources)), thread_name_prefix='startup') as pool:
+                list(pool.map(self._load, resources))
+        elif self.mode == BACKGROUND:
+            for resource in resources:
+                threading.Thread(target=self._load, args=(resource,), name=f'startup-{resource.name}', daemon=True).start()
+        self._check_ready()
+
+    def _load(self, resource):
+        with resource.lock:
+            if resource.state != PENDING:
+                return
+            resource.state = LOADING
+            start = time.perf_counter()
+            try:
+                resource.value = resource.loader()
+                resource.state = LOADED
+            except Exception as e:
+                print(f"Loading {resource.name} failed: {e}")
+                resource.error = str(e)
+                resource.state = FAILED
+            resource.seconds = round(time.perf_counter() - start, 4)
+            resource.loaded.set()
+        self._check_ready()
+
+    def get(self, name, timeout=None):
+        """
+        Value returned by the resource's loader, loading it in the calling
+        thread if nothing has started it yet.
+        """
+        resource = self._resources[name]
+        if resource.state == PENDING:
+            self._load(resource)
+        if not resource.loaded.wait(self.wait_timeout if timeout is None else timeout):
+            raise ResourceUnavailable(f"{name} is still loading")
+        if resource.state == FAILED:
+            raise ResourceUnavailable(f"{name} failed to load: {resource.error}")
+        return resource.value
+
+    def _is_ready(self):
+        for resource in self._resources.values():
+            if not resource.required or resource.state == LOADED:
+                continue
+            # In lazy mode a resource nobody asked for yet will load on demand
+            if self.mode == LAZY and resource.state == PENDING:
+                continue
+            return False
+        return True
+
+    def _check_ready(self):
+        if self.ready_seconds is None and self._is_ready():
+            self.ready_seconds = round(time.time() - self.started_at, 4)
+
+    def ready(self):
+        return self._is_ready()
+
+    def status(self):
+        return {
+            'ready': self._is_ready(),
+            'mode': self.mode,
+            'pid': os.getpid(),
+            'ready_seconds': self.ready_seconds,
+            'resources': {
+                name: {
+                    'state': r.state,
+                    'required': r.required,
+                    'seconds': r.seconds,
+                    **({'error': r.error} if r.error else {}),
+                }
+                for name, r in self._resources.items()
+            },
+        }
+
+    def _after_fork(self):
+        for resource in self._resources.values():
+            if resource.state == LOADING:
+                resource.reset()
+            else:
+                # Locks may have been held by a thread that no longer exists
+                resource.lock = threading.Lock()
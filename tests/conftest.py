@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The app modules and the Lambda handlers are flat modules, imported by name
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'aws_lambda_code')]
+
+# The Lambda modules create boto3 clients at import; no call reaches AWS
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
@@ -0,0 +1,55 @@
+import io
+import json
+import re
+import time
+
+import bedrock_handler
+
+PROMPTS = {'a': 'prompt a', 'b': 'prompt b', 'c': 'prompt c', 'd': 'prompt d'}
+SLEEPS = {'a': 0.1, 'b': 0.2, 'c': 0.3, 'd': 0.4}
+
+
+class SlowBedrock:
+    """
+    Fake bedrock-runtime client: each prompt takes its own time to answer,
+    and the prompts in `failing` raise instead.
+    """
+
+    def __init__(self, sleeps, failing=()):
+        self.sleeps = sleeps
+        self.failing = set(failing)
+
+    def invoke_model(self, body, **kwargs):
+        key = re.search(r'prompt (\w+)', json.loads(body)['prompt']).group(1)
+        time.sleep(self.sleeps[key])
+        if key in self.failing:
+            raise RuntimeError(f"prompt {key} broke")
+        return {'body': io.BytesIO(json.dumps({'completion': f' answer {key} '}).encode())}
+
+
+def test_prompts_run_concurrently():
+    start = time.perf_counter()
+    responses, errors = bedrock_handler.run_prompts(PROMPTS, 'resume', 'job', client=SlowBedrock(SLEEPS), max_workers=4)
+    elapsed = time.perf_counter() - start
+
+    assert errors == {}
+    assert responses == {key: f'answer {key}' for key in PROMPTS}
+    # Close to the slowest prompt, far from the sum of all four (1.0s)
+    assert max(SLEEPS.values()) <= elapsed < max(SLEEPS.values()) + 0.25
+
+
+def test_one_failing_prompt_keeps_the_other_sections():
+    responses, errors = bedrock_handler.run_prompts(PROMPTS, 'resume', 'job', client=SlowBedrock(SLEEPS, failing={'b'}))
+
+    assert set(responses) == {'a', 'c', 'd'}
+    assert errors == {'b': 'prompt b broke'}
+
+
+def test_slow_prompt_times_out_without_holding_the_rest():
+    sleeps = dict(SLEEPS, d=1.2)
+    start = time.perf_counter()
+    responses, errors = bedrock_handler.run_prompts(PROMPTS, 'resume', 'job', client=SlowBedrock(sleeps), timeout=0.6)
+
+    assert time.perf_counter() - start < 1.0
+    assert set(responses) == {'a', 'b', 'c'}
+    assert errors == {'d': 'Timed out after 0.6 seconds'}
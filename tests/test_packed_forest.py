@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+
+from packed_forest import PackedForest
+
+
+@pytest.fixture(scope='module')
+def forest():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(400, 5))
+    y = (X[:, 0] + X[:, 1] * X[:, 2] > 0).astype(int)
+    # Rounded values make ties, and NaNs in training give learned missing directions
+    X = np.round(X, 1)
+    X[rng.random(X.shape) < 0.1] = np.nan
+    rf = RandomForestClassifier(n_estimators=25, max_depth=8, random_state=0).fit(X, y)
+    return rf, PackedForest.from_sklearn(rf), X
+
+
+def threshold_rows(rf, n_features):
+    # Every split threshold, cast to float32 the way sklearn casts X, and its
+    # float32 neighbours on both sides
+    rows = []
+    for est in rf.estimators_:
+        tree = est.tree_
+        for feature, threshold in zip(tree.feature, tree.threshold):
+            # Splits that only separate NaNs from the rest have an infinite threshold
+            if feature < 0 or not np.isfinite(threshold):
+                continue
+            on = np.float32(threshold)
+            for value in (on, np.nextafter(on, np.float32(-np.inf)), np.nextafter(on, np.float32(np.inf))):
+                row = np.zeros(n_features, dtype=np.float32)
+                row[feature] = value
+                rows.append(row)
+    return np.array(rows)
+
+
+def assert_same(rf, packed, X):
+    np.testing.assert_array_equal(packed.predict_proba(X), rf.predict_proba(X))
+    np.testing.assert_array_equal(packed.predict(X), rf.predict(X))
+
+
+def test_matches_sklearn_on_training_rows(forest):
+    rf, packed, X = forest
+    assert_same(rf, packed, X)
+
+
+def test_matches_sklearn_on_nan_rows(forest):
+    rf, packed, X = forest
+    rng = np.random.default_rng(1)
+    rows = rng.normal(size=(200, X.shape[1]))
+    rows[rng.random(rows.shape) < 0.3] = np.nan
+    rows[0] = np.nan
+    assert_same(rf, packed, rows)
+
+
+def test_matches_sklearn_on_split_thresholds(forest):
+    rf, packed, X = forest
+    rows = threshold_rows(rf, X.shape[1])
+    assert len(rows)
+    assert_same(rf, packed, rows)
+
+
+def test_save_load_round_trip(forest, tmp_path):
+    rf, packed, X = forest
+    path = tmp_path / 'forest.npz'
+    packed.save(path)
+    assert_same(rf, PackedForest.load(path), X)
@@ -0,0 +1,169 @@
+import hashlib
+import io
+import json
+import threading
+
+import pytest
+from botocore.exceptions import ClientError
+
+import bedrock_handler
+import document_status
+import result_index
+import textract_handler
+from local_queue import LocalQueue
+from local_textract import LocalTextract
+
+RESUME_BUCKET = 'resume-upload-bucket'
+JOB_DESCRIPTION = 'Python developer with Flask and AWS experience'
+RESUME_PAGES = [['Jane Doe', 'Python developer'], ['Flask, AWS Lambda, S3']]
+
+
+class FakeS3:
+    """
+    Fake S3 client with the conditional writes the claims rely on
+    (IfNoneMatch='*' and IfMatch=<ETag>).
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _error(code, operation):
+        return ClientError({'Error': {'Code': code}}, operation)
+
+    def put_object(self, Bucket, Key, Body=b'', IfNoneMatch=None, IfMatch=None, **kwargs):
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        with self.lock:
+            existing = self.objects.get((Bucket, Key))
+            if IfNoneMatch == '*' and existing is not None:
+                raise self._error('PreconditionFailed', 'PutObject')
+            if IfMatch is not None and (existing is None or existing[1] != IfMatch):
+                raise self._error('PreconditionFailed', 'PutObject')
+            etag = f'"{hashlib.md5(Body).hexdigest()}"'
+            self.objects[(Bucket, Key)] = (Body, etag)
+        return {'ETag': etag}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        if (Bucket, Key) not in self.objects:
+            raise self._error('NoSuchKey', 'GetObject')
+        body, etag = self.objects[(Bucket, Key)]
+        return {'Body': io.BytesIO(body), 'ETag': etag}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        if (Bucket, Key) not in self.objects:
+            raise self._error('404', 'HeadObject')
+        body, etag = self.objects[(Bucket, Key)]
+        return {'ContentLength': len(body), 'ETag': etag}
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        self.objects[(Bucket, Key)] = self.objects[(CopySource['Bucket'], CopySource['Key'])]
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def read_json(self, bucket, key):
+        return json.loads(self.objects[(bucket, key)][0])
+
+
+class CountingBedrock:
+    def __init__(self):
+        self.calls = []
+
+    def invoke_model(self, body, **kwargs):
+        self.calls.append(json.loads(body)['prompt'])
+        return {'body': io.BytesIO(json.dumps({'completion': ' fine '}).encode())}
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    s3 = FakeS3()
+    for module in (textract_handler, result_index, document_status, bedrock_handler):
+        monkeypatch.setattr(module, 's3_client', s3)
+    textract = LocalTextract()
+    queue = LocalQueue()
+    bedrock = CountingBedrock()
+    monkeypatch.setattr(textract_handler, 'textract_client', textract)
+    monkeypatch.setattr(textract_handler, 'sqs_client', queue)
+    monkeypatch.setattr(textract_handler, 'ANALYSIS_QUEUE_URL', 'local')
+    monkeypatch.setattr(textract_handler, 'TEXTRACT_SNS_TOPIC_ARN', 'arn:aws:sns:us-east-1:0:textract')
+    monkeypatch.setattr(textract_handler, 'TEXTRACT_ROLE_ARN', 'arn:aws:iam::0:role/textract')
+    monkeypatch.setattr(bedrock_handler, 'bedrock_client', bedrock)
+    return s3, textract, queue, bedrock
+
+
+def upload(s3, textract, name, pages=RESUME_PAGES, sequencer='0001'):
+    s3.put_object(Bucket=textract_handler.JOB_DESCRIPTION_BUCKET, Key=name.replace('.pdf', '.txt'), Body=JOB_DESCRIPTION)
+    s3.put_object(Bucket=RESUME_BUCKET, Key=name, Body=f'%PDF {name}'.encode())
+    textract.documents[name] = pages
+    return {'Records': [{'s3': {
+        'bucket': {'name': RESUME_BUCKET},
+        'object': {'key': name, 'sequencer': sequencer},
+    }}]}
+
+
+def job_for(textract, name):
+    return [job_id for job_id, job in textract.jobs.items() if job['key'] == name]
+
+
+def test_duplicate_completion_hands_off_once(pipeline):
+    s3, textract, queue, bedrock = pipeline
+    event = upload(s3, textract, 'jane.pdf')
+    # A redelivered upload event reuses the running job
+    textract_handler.lambda_handler(event, None)
+    textract_handler.lambda_handler(event, None)
+    [job_id] = job_for(textract, 'jane.pdf')
+
+    completion = textract.completion_event(job_id)
+    textract_handler.lambda_handler(completion, None)
+    textract_handler.lambda_handler(completion, None)
+    assert len(queue.pending()) == 1
+
+    assert queue.drain(bedrock_handler.lambda_handler) == 1
+    assert queue.dead_letters == []
+    assert len(bedrock.calls) == len(bedrock_handler.PROMPTS)
+    assert 'Jane Doe\nPython developer\nFlask, AWS Lambda, S3' in bedrock.calls[0]
+    status = document_status.read_status('jane.pdf')
+    assert status['status'] == document_status.DONE
+    responses = s3.read_json(bedrock_handler.RESULTS_BUCKET, status['result_key'])
+    assert responses['skills'] == 'fine'
+
+    # A late redelivery after the analysis finished queues nothing
+    textract_handler.lambda_handler(completion, None)
+    assert queue.pending() == []
+    assert len(bedrock.calls) == len(bedrock_handler.PROMPTS)
+
+
+def test_each_job_is_handed_off_once(pipeline):
+    s3, textract, queue, bedrock = pipeline
+    names = ['a.pdf', 'b.pdf', 'c.pdf']
+    for i, name in enumerate(names):
+        pages = [[f'Candidate {name}', f'Python project {i}']]
+        textract_handler.lambda_handler(upload(s3, textract, name, pages, sequencer=f'000{i}'), None)
+
+    # Completions arrive twice and out of order
+    job_ids = [job_id for name in names for job_id in job_for(textract, name)]
+    assert len(job_ids) == len(names)
+    for job_id in job_ids + job_ids[::-1]:
+        textract_handler.lambda_handler(textract.completion_event(job_id), None)
+
+    assert sorted(message['idempotency_key'] for message in queue.pending()) == sorted(job_ids)
+    assert queue.drain(bedrock_handler.lambda_handler) == len(names)
+    assert len(bedrock.calls) == len(names) * len(bedrock_handler.PROMPTS)
+    for name in names:
+        assert document_status.read_status(name)['status'] == document_status.DONE
+
+
+def test_failed_job_is_not_handed_off(pipeline):
+    s3, textract, queue, bedrock = pipeline
+    event = upload(s3, textract, 'broken.pdf')
+    del textract.documents['broken.pdf']
+    textract_handler.lambda_handler(event, None)
+    [job_id] = job_for(textract, 'broken.pdf')
+
+    textract_handler.lambda_handler(textract.completion_event(job_id), None)
+    assert queue.pending() == []
+    assert document_status.read_status('broken.pdf')['status'] == document_status.FAILED
@@ -0,0 +1,191 @@
+"""
+Cached verification of Firebase ID tokens.
+
+auth.verify_id_token goes through an HTTP cache lookup for Google's signing
+certificates, parses them and checks an RSA signature on every call, and the
+SPA sends the same token to /login, /signup and /verify-token over and over.
+IdTokenVerifier keeps the parsed certificates for as long as their
+Cache-Control header allows and remembers tokens it has already verified
+until they expire, so a repeat verification is a dictionary lookup.
+
+The checks match firebase_admin's (RS256, kid, aud, iss, sub, exp/iat), and
+failures raise the same firebase_admin.auth exception types.
+"""
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import google.auth.exceptions
+import google.auth.jwt
+import requests
+from firebase_admin import auth
+
+ID_TOKEN_CERT_URI = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
+ID_TOKEN_ISSUER_PREFIX = 'https://securetoken.google.com/'
+
+DEFAULT_MAX_TOKENS = 10000
+# Used when the certificate response has no usable Cache-Control max-age
+DEFAULT_CERT_TTL = 300
+# Unknown key ids trigger a refetch at most this often, so forged tokens can't hammer Google
+MIN_REFRESH_INTERVAL = 30
+CERT_FETCH_TIMEOUT = 10
+
+_MAX_AGE = re.compile(r'max-age=(\d+)')
+
+
+def fetch_certificates(url=ID_TOKEN_CERT_URI):
+    """
+    Download Google's signing certificates. Returns ({kid: PEM}, seconds they may be cached).
+    """
+    response = requests.get(url, timeout=CERT_FETCH_TIMEOUT)
+    response.raise_for_status()
+    return response.json(), cache_lifetime(response.headers)
+
+
+def cache_lifetime(headers):
+    """
+    Freshness lifetime from Cache-Control max-age minus Age (RFC 9111).
+    """
+    cache_control = headers.get('Cache-Control', '')
+    if 'no-store' in cache_control or 'no-cache' in cache_control:
+        return 0
+    match = _MAX_AGE.search(cache_control)
+    if not match:
+        return DEFAULT_CERT_TTL
+    age = int(headers.get('Age', 0) or 0)
+    return max(0, int(match.group(1)) - age)
+
+
+class CertificateCache:
+    """
+    Google's public certificates, refetched when their cache lifetime ends
+    or when a token names a key id that is not in the current set (rotation).
+    """
+
+    def __init__(self, fetch=fetch_certificates, clock=time.time, min_refresh_interval=MIN_REFRESH_INTERVAL):
+        self.fetch = fetch
+        self.clock = clock
+        self.min_refresh_interval = min_refresh_interval
+        self._certs = {}
+        self._expires_at = 0.0
+        self._fetched_at = None
+        self._lock = threading.Lock()
+        self.fetches = 0
+
+    def get(self, kid=None):
+        with self._lock:
+            now = self.clock()
+            stale = now >= self._expires_at
+            rotated = (
+                kid is not None and kid not in self._certs
+                and (self._fetched_at is None or now - self._fetched_at >= self.min_refresh_interval)
+            )
+            if stale or rotated:
+                certs, lifetime = self.fetch()
+                self._certs = dict(certs)
+                self._fetched_at = self.clock()
+                self._expires_at = self._fetched_at + lifetime
+                self.fetches += 1
+            return self._certs
+
+
+class IdTokenVerifier:
+    """
+    Verifies Firebase ID tokens for one project, with a bounded LRU of
+    verified tokens that holds each entry until the token's exp.
+    """
+
+    def __init__(self, project_id, certificates=None, max_tokens=DEFAULT_MAX_TOKENS,
+                 clock=time.time, clock_skew_seconds=0):
+        self.project_id = project_id
+        self.issuer = ID_TOKEN_ISSUER_PREFIX + project_id
+        self.certificates = certificates or CertificateCache(clock=clock)
+        self.max_tokens = max_tokens
+        self.clock = clock
+        self.clock_skew_seconds = clock_skew_seconds
+        self._verified = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def verify(self, id_token):
+        """
+        Decoded claims of a valid token, with 'uid' set like verify_id_token does.
+        """
+        if isinstance(id_token, str):
+            id_token = id_token.encode('utf-8')
+        if not isinstance(id_token, bytes) or not id_token:
+            raise ValueError('Illegal ID token provided. ID token must be a non-empty string.')
+
+        # Tokens are bearer credentials; index them by digest rather than keep them
+        key = hashlib.sha256(id_token).digest()
+        now = self.clock()
+        with self._lock:
+            entry = self._verified.get(key)
+            if entry is not None and now < entry[0]:
+                self._verified.move_to_end(key)
+                self.hits += 1
+                return dict(entry[1])
+            if entry is not None:
+                del self._verified[key]
+            self.misses += 1
+
+        claims = self._verify_uncached(id_token)
+        with self._lock:
+            self._verified[key] = (claims['exp'] + self.clock_skew_seconds, claims)
+            self._verified.move_to_end(key)
+            while len(self._verified) > self.max_tokens:
+                self._verified.popitem(last=False)
+        return dict(claims)
+
+    def _verify_uncached(self, id_token):
+        try:
+            header = google.auth.jwt.decode_header(id_token)
+            payload = google.auth.jwt.decode(id_token, verify=False)
+        except ValueError as e:
+            raise auth.InvalidIdTokenError(str(e), cause=e)
+
+        subject = payload.get('sub')
+        error_message = None
+        if not header.get('kid'):
+            error_message = 'Firebase ID token has no "kid" claim.'
+        elif header.get('alg') != 'RS256':
+            error_message = f'Firebase ID token has incorrect algorithm. Expected "RS256" but got "{header.get("alg")}".'
+        elif payload.get('aud') != self.project_id:
+            error_message = f'Firebase ID token has incorrect "aud" (audience) claim. Expected "{self.project_id}" but got "{payload.get("aud")}".'
+        elif payload.get('iss') != self.issuer:
+            error_message = f'Firebase ID token has incorrect "iss" (issuer) claim. Expected "{self.issuer}" but got "{payload.get("iss")}".'
+        elif not isinstance(subject, str) or not subject or len(subject) > 128:
+            error_message = 'Firebase ID token has a missing, empty or too long "sub" (subject) claim.'
+        if error_message:
+            raise auth.InvalidIdTokenError(error_message)
+
+        try:
+            certs = self.certificates.get(header['kid'])
+            claims = google.auth.jwt.decode(
+                id_token,
+                certs=certs,
+                audience=self.project_id,
+                clock_skew_in_seconds=self.clock_skew_seconds,
+            )
+        except (google.auth.exceptions.TransportError, requests.RequestException) as e:
+            raise auth.CertificateFetchError(str(e), cause=e)
+        except ValueError as e:
+            if 'Token expired' in str(e):
+                raise auth.ExpiredIdTokenError(str(e), cause=e)
+            raise auth.InvalidIdTokenError(str(e), cause=e)
+        claims['uid'] = claims['sub']
+        return claims
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._verified),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'certificate_fetches': self.certificates.fetches,
+            }
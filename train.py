@@ -0,0 +1,265 @@
+"""
+Training entry point: cross-validated hyperparameter search for the
+retention forest, with model selection under a serving budget.
+
+preprocess_data/train_model in 272_project.py read the CSV twice, fit one
+single-threaded forest with hardcoded parameters and kept whatever came out.
+Here the dataset is parsed once with fixed dtypes, every (parameters, fold)
+pair of the grid is fitted on a process pool across all cores with fixed
+seeds, and each fit's training and scoring times are recorded.
+
+The winner is the most accurate candidate whose single-row latency (as the
+app serves it, a packed forest) and artifact size fit the budgets; accuracy
+alone would always pick the biggest forest. It is refit on the training
+split, checked on the holdout split train_model uses, and published like a
+retraining cycle (rf_model, scaler, X_columns and fused_model, renamed into
+place), optionally also to the model registry.
+
+Usage:
+    python train.py [--dataset HR_comma_sep.csv] [--latency-budget-ms 2] [--size-budget-mb 20]
+"""
+import argparse
+import itertools
+import json
+import os
+import pickle
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import joblib
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import StratifiedKFold
+from sklearn.preprocessing import StandardScaler
+
+from packed_forest import PackedForest
+from retention_model import DEPARTMENT_PREFIX, SALARY_MAPPING
+from retraining import (
+    CANARY_SIZE, COLUMNS_PATH, DATASET_PATH, HOLDOUT_FRACTION, RANDOM_STATE, holdout_split, publish, read_dataset,
+)
+
+DEFAULT_N_ESTIMATORS = (50, 100, 200)
+DEFAULT_MAX_DEPTH = (None, 12, 20)
+DEFAULT_MIN_SAMPLES_LEAF = (1, 2, 4)
+DEFAULT_FOLDS = 5
+DEFAULT_LATENCY_BUDGET_MS = 2.0
+DEFAULT_SIZE_BUDGET_MB = 20.0
+# Single-row predictions timed per candidate; the median is reported
+LATENCY_SAMPLES = 200
+
+NUMERIC_COLUMNS = [
+    'satisfaction_level', 'last_evaluation', 'number_project', 'average_montly_hours',
+    'time_spend_company', 'work_accident', 'promotion_last_5years',
+]
+
+
+def feature_matrix(df):
+    """
+    (X, X_columns) in the layout train_model produced: the numeric columns,
+    salary as 0/1/2, then one-hot departments in sorted order. The same
+    layout FeatureEncoder builds from request records.
+    """
+    departments = sorted(df['department'].dropna().unique())
+    X_columns = NUMERIC_COLUMNS + ['salary'] + [DEPARTMENT_PREFIX + d for d in departments]
+    X = np.zeros((len(df), len(X_columns)), dtype=np.float64)
+    for i, column in enumerate(NUMERIC_COLUMNS):
+        X[:, i] = df[column].to_numpy(dtype=np.float64)
+    X[:, len(NUMERIC_COLUMNS)] = df['salary'].astype(object).map(SALARY_MAPPING).to_numpy(dtype=np.float64)
+    department = df['department'].astype(object).to_numpy()
+    for j, name in enumerate(departments):
+        X[:, len(NUMERIC_COLUMNS) + 1 + j] = department == name
+    return X, X_columns
+
+
+# Training data of the pool's worker processes, set once by the initializer
+_X = None
+_y = None
+
+
+def _init_worker(X, y):
+    global _X, _y
+    _X, _y = X, y
+
+
+def _fit_fold(params, fold, train_index, test_index, keep_model):
+    """
+    Fit one candidate on one fold. Returns the fold's accuracy and timings,
+    plus the packed forest when keep_model is set (for the latency and size checks).
+    """
+    model = RandomForestClassifier(random_state=RANDOM_STATE, n_jobs=1, **params)
+    start = time.perf_counter()
+    model.fit(_X[train_index], _y[train_index])
+    fit_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    accuracy = float(np.mean(model.predict(_X[test_index]) == _y[test_index]))
+    score_seconds = time.perf_counter() - start
+
+    result = {
+        'fold': fold,
+        'accuracy': accuracy,
+        'fit_seconds': round(fit_seconds, 4),
+        'score_seconds': round(score_seconds, 4),
+    }
+    return result, PackedForest.from_sklearn(model) if keep_model else None
+
+
+def parameter_grid(n_estimators, max_depth, min_samples_leaf):
+    return [
+        {'n_estimators': n, 'max_depth': d, 'min_samples_leaf': leaf}
+        for n, d, leaf in itertools.product(n_estimators, max_depth, min_samples_leaf)
+    ]
+
+
+def serving_cost(packed, X, samples=LATENCY_SAMPLES):
+    """
+    (median single-row predict latency in ms, serialized size in bytes) of a packed forest.
+    """
+    rows = X[np.random.default_rng(RANDOM_STATE).integers(len(X), size=samples)]
+    timings = []
+    for row in rows:
+        row = row[np.newaxis, :]
+        start = time.perf_counter()
+        packed.predict_with_proba(row)
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings) * 1000), len(pickle.dumps(packed, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def search(X, y, grid, folds=DEFAULT_FOLDS, workers=None):
+    """
+    Cross-validate every candidate on a process pool. Returns one summary per
+    candidate with its per-fold results, and the packed fold-0 forest of each.
+    """
+    splits = list(StratifiedKFold(n_splits=folds, shuffle=True, random_state=RANDOM_STATE).split(X, y))
+    results = {i: [] for i in range(len(grid))}
+    packed = {}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_worker, initargs=(X, y)) as pool:
+        futures = {
+            pool.submit(_fit_fold, params, fold, train_index, test_index, fold == 0): i
+            for i, params in enumerate(grid)
+            for fold, (train_index, test_index) in enumerate(splits)
+        }
+        for future, i in futures.items():
+            fold_result, model = future.result()
+            results[i].append(fold_result)
+            if model is not None:
+                packed[i] = model
+    print(f"Cross-validated {len(grid)} candidates x {folds} folds in {time.perf_counter() - start:.1f}s")
+
+    candidates = []
+    for i, params in enumerate(grid):
+        accuracies = [r['accuracy'] for r in results[i]]
+        candidates.append({
+            'params': params,
+            'mean_accuracy': float(np.mean(accuracies)),
+            'std_accuracy': float(np.std(accuracies)),
+            'mean_fit_seconds': round(float(np.mean([r['fit_seconds'] for r in results[i]])), 4),
+            'folds': sorted(results[i], key=lambda r: r['fold']),
+        })
+    return candidates, packed
+
+
+def select(candidates, latency_budget_ms, size_budget_bytes):
+    """
+    Most accurate candidate within both budgets (ties go to the smaller
+    artifact), or None if no candidate fits.
+    """
+    eligible = [
+        c for c in candidates
+        if c['latency_ms'] <= latency_budget_ms and c['size_bytes'] <= size_budget_bytes
+    ]
+    if not eligible:
+        return None
+    return max(eligible, key=lambda c: (round(c['mean_accuracy'], 4), -c['size_bytes']))
+
+
+def main(argv):
+    def int_list(value):
+        return tuple(None if v == 'none' else int(v) for v in value.split(','))
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--dataset', default=DATASET_PATH)
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--n-estimators', type=int_list, default=DEFAULT_N_ESTIMATORS)
+    parser.add_argument('--max-depth', type=int_list, default=DEFAULT_MAX_DEPTH, help="comma-separated, 'none' for unlimited")
+    parser.add_argument('--min-samples-leaf', type=int_list, default=DEFAULT_MIN_SAMPLES_LEAF)
+    parser.add_argument('--folds', type=int, default=DEFAULT_FOLDS)
+    parser.add_argument('--workers', type=int, default=None, help='processes for the search (default: all cores)')
+    parser.add_argument('--latency-budget-ms', type=float, default=DEFAULT_LATENCY_BUDGET_MS)
+    parser.add_argument('--size-budget-mb', type=float, default=DEFAULT_SIZE_BUDGET_MB)
+    parser.add_argument('--report', default='training_report.json')
+    parser.add_argument('--registry', default=os.environ.get('MODEL_REGISTRY'),
+                        help='also publish to this model registry (directory or s3://bucket/prefix)')
+    parser.add_argument('--dry-run', action='store_true', help='search and report, but do not publish')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    df = read_dataset(args.dataset)
+    X, X_columns = feature_matrix(df)
+    y = df['left'].to_numpy(dtype=np.int64)
+    train, holdout = holdout_split(len(y))
+    print(f"Loaded {len(y)} rows x {len(X_columns)} features in {time.perf_counter() - start:.2f}s")
+
+    grid = parameter_grid(args.n_estimators, args.max_depth, args.min_samples_leaf)
+    candidates, packed = search(X[train], y[train], grid, args.folds, args.workers)
+
+    # Serving cost is measured one candidate at a time, not while the pool keeps every core busy
+    for i, candidate in enumerate(candidates):
+        candidate['latency_ms'], candidate['size_bytes'] = serving_cost(packed[i], X[holdout])
+
+    size_budget_bytes = args.size_budget_mb * 1024 * 1024
+    print(f"{'n_estimators':>12} {'max_depth':>9} {'min_leaf':>8} {'cv accuracy':>15} {'fit s':>7} {'latency ms':>10} {'size MB':>8}")
+    for c in sorted(candidates, key=lambda c: -c['mean_accuracy']):
+        p = c['params']
+        within = c['latency_ms'] <= args.latency_budget_ms and c['size_bytes'] <= size_budget_bytes
+        print(f"{p['n_estimators']:>12} {str(p['max_depth']):>9} {p['min_samples_leaf']:>8} "
+              f"{c['mean_accuracy']:>8.4f} ±{c['std_accuracy']:.4f} {c['mean_fit_seconds']:>7.2f} "
+              f"{c['latency_ms']:>10.3f} {c['size_bytes'] / 1024 / 1024:>8.2f}{'' if within else '  over budget'}")
+
+    best = select(candidates, args.latency_budget_ms, size_budget_bytes)
+    report = {
+        'dataset': args.dataset,
+        'rows': int(len(y)),
+        'holdout_fraction': HOLDOUT_FRACTION,
+        'folds': args.folds,
+        'latency_budget_ms': args.latency_budget_ms,
+        'size_budget_mb': args.size_budget_mb,
+        'candidates': candidates,
+        'selected': best and best['params'],
+    }
+    if best is None:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+        raise SystemExit("No candidate fits the latency and size budgets; see " + args.report)
+    print(f"Selected {best['params']}")
+
+    scaler = StandardScaler().fit(X[train])
+    model = RandomForestClassifier(random_state=RANDOM_STATE, n_jobs=-1, **best['params'])
+    fit_start = time.perf_counter()
+    model.fit(scaler.transform(X[train]), y[train])
+    report['final_fit_seconds'] = round(time.perf_counter() - fit_start, 3)
+    report['holdout_accuracy'] = float(np.mean(model.predict(scaler.transform(X[holdout])) == y[holdout]))
+    print(f"Holdout accuracy {report['holdout_accuracy']:.4f} (fit in {report['final_fit_seconds']}s)")
+
+    if not args.dry_run:
+        joblib.dump(X_columns, os.path.join(args.output_dir, COLUMNS_PATH))
+        fused = publish(model, scaler, X_columns, args.output_dir, check_rows=X[holdout][:500])
+        print(f"Published model to {os.path.abspath(args.output_dir)}")
+        if args.registry:
+            from model_registry import ModelRegistry, open_store
+            records = df.drop(columns='left').iloc[holdout[:CANARY_SIZE]].astype({'department': str, 'salary': str}).to_dict('records')
+            report['model_version'] = ModelRegistry(open_store(args.registry)).publish(
+                {'fused_model.joblib': fused, COLUMNS_PATH: X_columns, 'rf_model.joblib': model, 'scaler.joblib': scaler},
+                metadata={'params': best['params'], 'holdout_accuracy': report['holdout_accuracy']},
+                canary=[{'record': r, 'left': int(left)} for r, left in zip(records, y[holdout[:CANARY_SIZE]])],
+            )
+            print(f"Published {report['model_version']} to {args.registry}")
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,87 @@
+import os
+
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+# MongoClient settings read from the environment, with the name of the
+# variable, the client option and its default. Timeouts are in milliseconds.
+MONGO_CLIENT_SETTINGS = [
+    ('MONGO_MAX_POOL_SIZE', 'maxPoolSize', 50),
+    ('MONGO_MIN_POOL_SIZE', 'minPoolSize', 0),
+    ('MONGO_MAX_IDLE_TIME_MS', 'maxIdleTimeMS', 60000),
+    ('MONGO_WAIT_QUEUE_TIMEOUT_MS', 'waitQueueTimeoutMS', 2000),
+    ('MONGO_CONNECT_TIMEOUT_MS', 'connectTimeoutMS', 5000),
+    ('MONGO_SERVER_SELECTION_TIMEOUT_MS', 'serverSelectionTimeoutMS', 5000),
+    ('MONGO_SOCKET_TIMEOUT_MS', 'socketTimeoutMS', 10000),
+]
+
+EMAIL_INDEX_NAME = 'email_unique'
+
+
+def mongo_client_options(environ=os.environ):
+    """
+    Pool sizing and timeouts for MongoClient. A login storm then waits at
+    most waitQueueTimeoutMS for a pooled connection instead of piling up
+    behind an unbounded queue, and a slow server fails fast.
+    """
+    options = {}
+    for variable, option, default in MONGO_CLIENT_SETTINGS:
+        options[option] = int(environ.get(variable, default))
+    # Connect on first use, so forked gunicorn workers each open their own pool
+    options['connect'] = False
+    return options
+
+
+class UserStore:
+    """
+    Email/password accounts in the users collection.
+
+    Every lookup goes through the unique email index and fetches only the
+    fields the caller needs.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def ensure_indexes(self):
+        """
+        Create the unique email index at startup (a no-op when it exists).
+        Returns False if it could not be created, e.g. because existing
+        duplicate emails prevent it or the server is unreachable; the app
+        still starts and lookups fall back to a collection scan.
+        """
+        try:
+            self.collection.create_index([('email', ASCENDING)], unique=True, name=EMAIL_INDEX_NAME)
+            return True
+        except PyMongoError as e:
+            print(f"Could not create unique index on users.email: {e}")
+            return False
+
+    def password_hash(self, email):
+        """
+        Stored password hash for an email, or None if there is no such user.
+        """
+        user = self.collection.find_one({'email': email}, {'_id': 0, 'password': 1})
+        return user.get('password') if user else None
+
+    def exists(self, email):
+        return self.collection.find_one({'email': email}, {'_id': 1}) is not None
+
+    def create(self, name, email, password_hash):
+        """
+        Insert a new user. Returns False if the email is already registered,
+        including when a concurrent signup for it won the race.
+        """
+        try:
+            self.collection.insert_one({
+                'name': name,
+                'email': email,
+                'password': password_hash
+            })
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def update_password(self, email, password_hash):
+        # Used to upgrade a hash made with outdated parameters after a successful login
+        self.collection.update_one({'email': email}, {'$set': {'password': password_hash}})